@@ -0,0 +1,235 @@
+"""JSON API, version 1, mounted at /api/v1.
+
+Same login session as the HTML pages. Lists are keyset-paginated like the
+pages (see pagination.py) and return
+
+    {"data": [...], "paging": {"older": ..., "newer": ..., "since": ...}}
+
+- `?older=<cursor>` fetches the next (older) page.
+- `?since=<cursor>` fetches only what was added after a cursor; pass the
+  `since` of the previous response to poll for deltas. While `newer` is
+  set there are more deltas to fetch.
+- `?fields=id,text` picks the fields returned (see the *_FIELDS maps).
+- `?limit=` sets the page size, up to MAX_PER_PAGE.
+
+Only the selected columns are queried, and rows are serialized straight
+from the result tuples; no ORM objects are built.
+"""
+
+from datetime import datetime
+from functools import wraps
+
+from flask import Blueprint, abort, current_app, g, jsonify, request
+from werkzeug.exceptions import HTTPException
+
+from models import db, User, Message, Follows, Likes, DirectMessage, TimelineEntry
+from pagination import encode_cursor, paginate
+
+bp = Blueprint('api', __name__, url_prefix='/api/v1')
+
+MAX_PER_PAGE = 100
+
+MESSAGE_FIELDS = {
+    'id': Message.id,
+    'text': Message.text,
+    'timestamp': Message.timestamp,
+    'likes_count': Message.likes_count,
+    'user_id': Message.user_id,
+    'username': User.username,
+    'image_url': User.image_url,
+}
+
+USER_FIELDS = {
+    'id': User.id,
+    'username': User.username,
+    'image_url': User.image_url,
+    'header_image_url': User.header_image_url,
+    'bio': User.bio,
+    'location': User.location,
+    'messages_count': User.messages_count,
+    'following_count': User.following_count,
+    'followers_count': User.followers_count,
+    'likes_count': User.likes_count,
+}
+
+USER_CARD_FIELDS = {name: USER_FIELDS[name] for name in ('id', 'username', 'image_url', 'bio')}
+
+DIRECT_MESSAGE_FIELDS = {
+    'id': DirectMessage.id,
+    'text': DirectMessage.message_text,
+    'timestamp': DirectMessage.timestamp,
+    'sender_id': DirectMessage.sender_id,
+    'sender_username': User.username,
+    'sender_image_url': User.image_url,
+}
+
+
+# the app's own 404 page would win over a handler for HTTPException alone
+@bp.errorhandler(404)
+@bp.errorhandler(HTTPException)
+def json_error(error):
+    return jsonify(error=error.description), error.code
+
+
+def login_required(view):
+    """Answer 401 unless someone is logged in."""
+
+    @wraps(view)
+    def wrapper(*args, **kwargs):
+        if not g.get('user'):
+            abort(401, "Log in first.")
+        return view(*args, **kwargs)
+    return wrapper
+
+
+def jsonable(value):
+    return value.isoformat() if isinstance(value, datetime) else value
+
+
+def selected_fields(available):
+    """The field names asked for with `?fields=`, or all of `available`."""
+
+    fields = request.args.get('fields')
+    if not fields:
+        return list(available)
+
+    names = [name.strip() for name in fields.split(',') if name.strip()]
+    unknown = [name for name in names if name not in available]
+    if unknown or not names:
+        abort(400, f"Unknown fields: {', '.join(unknown)}. Choose from: {', '.join(available)}.")
+    return names
+
+
+def per_page():
+    try:
+        limit = int(request.args.get('limit', current_app.config['API_PER_PAGE']))
+    except ValueError:
+        abort(400, "limit must be a number.")
+    return min(max(limit, 1), MAX_PER_PAGE)
+
+
+def list_response(query, available, cursor_columns):
+    """Page through `query` by `cursor_columns`, returning the selected fields as JSON.
+
+    `query` supplies the joins and filters; its select list is replaced by
+    just the selected columns plus the cursor columns.
+    """
+
+    names = selected_fields(available)
+    size = len(cursor_columns)
+    since = request.args.get('since')
+
+    query = query.with_entities(*[available[name] for name in names], *cursor_columns)
+    page = paginate(query, cursor_columns,
+                    older=request.args.get('older'), newer=since,
+                    per_page=per_page(), key=lambda row: tuple(row[-size:]))
+
+    data = [{name: jsonable(value) for name, value in zip(names, row)} for row in page.items]
+
+    return jsonify(data=data, paging=dict(
+        older=page.older,
+        newer=page.newer if since else None,
+        since=encode_cursor(page.items[0][-size:]) if page.items else since,
+    ))
+
+
+@bp.route('/timeline')
+@login_required
+def timeline():
+    """Messages from the users the logged-in user follows, newest first."""
+
+    query = (db.session
+             .query(TimelineEntry)
+             .join(Message, Message.id == TimelineEntry.message_id)
+             .join(User, User.id == Message.user_id)
+             .filter(TimelineEntry.user_id == g.user.id))
+
+    return list_response(query, MESSAGE_FIELDS, (TimelineEntry.timestamp, TimelineEntry.message_id))
+
+
+@bp.route('/users/<int:user_id>')
+def profile(user_id):
+    """A user's profile and counters."""
+
+    names = selected_fields(USER_FIELDS)
+    row = (db.session
+           .query(*[USER_FIELDS[name] for name in names])
+           .filter(User.id == user_id)
+           .first())
+    if row is None:
+        abort(404, "No such user.")
+
+    return jsonify(data={name: jsonable(value) for name, value in zip(names, row)})
+
+
+@bp.route('/users/<int:user_id>/messages')
+def user_messages(user_id):
+    """A user's messages, newest first."""
+
+    query = (db.session
+             .query(Message)
+             .join(User, User.id == Message.user_id)
+             .filter(Message.user_id == user_id))
+
+    return list_response(query, MESSAGE_FIELDS, (Message.timestamp, Message.id))
+
+
+@bp.route('/users/<int:user_id>/followers')
+@login_required
+def followers(user_id):
+    """The users following `user_id`, by descending user id."""
+
+    query = (db.session
+             .query(User)
+             .join(Follows, Follows.user_following_id == User.id)
+             .filter(Follows.user_being_followed_id == user_id))
+
+    # paginated on follows' own column: a seek on its primary key
+    return list_response(query, USER_CARD_FIELDS, (Follows.user_following_id,))
+
+
+@bp.route('/users/<int:user_id>/following')
+@login_required
+def following(user_id):
+    """The users `user_id` follows, by descending user id."""
+
+    query = (db.session
+             .query(User)
+             .join(Follows, Follows.user_being_followed_id == User.id)
+             .filter(Follows.user_following_id == user_id))
+
+    return list_response(query, USER_CARD_FIELDS, (Follows.user_being_followed_id,))
+
+
+@bp.route('/users/<int:user_id>/likes')
+@login_required
+def likes(user_id):
+    """The messages `user_id` has liked, newest first."""
+
+    query = (db.session
+             .query(Message)
+             .join(Likes, Likes.message_id == Message.id)
+             .join(User, User.id == Message.user_id)
+             .filter(Likes.user_id == user_id))
+
+    return list_response(query, MESSAGE_FIELDS, (Message.timestamp, Message.id))
+
+
+@bp.route('/dms')
+@login_required
+def direct_messages():
+    """Direct messages received by the logged-in user, newest first."""
+
+    query = (db.session
+             .query(DirectMessage)
+             .join(User, User.id == DirectMessage.sender_id)
+             .filter(DirectMessage.receiver_id == g.user.id))
+
+    return list_response(query, DIRECT_MESSAGE_FIELDS, (DirectMessage.timestamp, DirectMessage.id))
+
+
+def init_app(app):
+    """Mount the API on `app`."""
+
+    app.config.setdefault('API_PER_PAGE', 50)
+    app.register_blueprint(bp)
@@ -1,11 +1,31 @@
+import json
 import os
+from time import monotonic
 
-from flask import Flask, render_template, request, flash, redirect, session, g, url_for
+from flask import Flask, Response, render_template, request, flash, redirect, session, g, url_for, abort
 from flask_debugtoolbar import DebugToolbarExtension
 from sqlalchemy.exc import IntegrityError
-
+from sqlalchemy.orm import joinedload, load_only
+
+import api
+import assets
+import conditional
+import dbpool
+import fragments
+import identity
+import jobs
+import metrics
+import passwords
+import pubsub
+import querycount
+import replicas
+
+from commands import (backfill_conversations, backfill_timelines, build_assets, db_upgrade, load_seed,
+                      reconcile_counters, run_worker)
 from forms import UserAddForm, LoginForm, UserEditForm, MessageForm, UserEditPswForm
-from models import db, connect_db, User, Message, Likes, DirectMessage
+from models import db, connect_db, User, Message, Likes, Follows, DirectMessage, Conversation, TimelineEntry, AccountDeletion
+from pagination import paginate, cursor_args
+from search import search_users, search_messages
 
 CURR_USER_KEY = "curr_user"
 
@@ -17,27 +37,95 @@ app.config['SQLALCHEMY_DATABASE_URI'] = (
     os.environ.get('DATABASE_URL', 'postgresql:///warbler'))
 app.config['SQLALCHEMY_TRACK_MODIFICATIONS'] = False
 app.config['SQLALCHEMY_ECHO'] = False
+# Connection pools (see dbpool.py); replicas get the same settings
+app.config['SQLALCHEMY_ENGINE_OPTIONS'] = {
+    'poolclass': dbpool.InstrumentedQueuePool,
+    'pool_logging_name': 'primary',
+    'pool_pre_ping': True,
+    'pool_size': int(os.environ.get('DB_POOL_SIZE', 5)),
+    'max_overflow': int(os.environ.get('DB_MAX_OVERFLOW', 10)),
+    'pool_timeout': float(os.environ.get('DB_POOL_TIMEOUT', 5)),
+    'pool_recycle': int(os.environ.get('DB_POOL_RECYCLE', 1800)),
+}
+# Postgres statement_timeout (ms) for requests, by endpoint: searches give
+# up early rather than hold connections the timeline needs
+app.config['STATEMENT_TIMEOUT'] = int(os.environ.get('STATEMENT_TIMEOUT', 5000))
+app.config['STATEMENT_TIMEOUTS'] = {
+    'list_users': 1000,
+    'messages_search': 1000,
+}
+# Read replicas for GET requests, comma-separated (see replicas.py)
+app.config['REPLICA_DATABASE_URIS'] = [
+    uri for uri in os.environ.get('DATABASE_REPLICA_URLS', '').split(',') if uri]
 app.config['DEBUG_TB_INTERCEPT_REDIRECTS'] = False
 app.config['SECRET_KEY'] = os.environ.get('SECRET_KEY', "it's a secret")
+app.config['MESSAGES_PER_PAGE'] = 100
+app.config['USERS_PER_PAGE'] = 60
+# Fail requests that run more SQL statements than this (catches N+1 queries
+# in development and tests); unset in production.
+app.config['SQL_STATEMENT_LIMIT'] = (
+    int(os.environ['SQL_STATEMENT_LIMIT']) if os.environ.get('SQL_STATEMENT_LIMIT') else None)
+# Cached snapshots of logged-in users (see identity.py)
+app.config['IDENTITY_CACHE_SIZE'] = 10000
+app.config['IDENTITY_CACHE_TTL'] = 60
+# bcrypt cost and the process pool that runs it (see passwords.py)
+app.config['BCRYPT_LOG_ROUNDS'] = int(os.environ.get('BCRYPT_LOG_ROUNDS', 12))
+app.config['BCRYPT_POOL_SIZE'] = int(os.environ.get('BCRYPT_POOL_SIZE', os.cpu_count() or 1))
+app.config['BCRYPT_MAX_PENDING'] = int(os.environ.get('BCRYPT_MAX_PENDING', 4 * app.config['BCRYPT_POOL_SIZE']))
+# Run background jobs inside the request instead of queueing them for
+# `flask --app app run-worker` (see jobs.py)
+app.config['JOBS_INLINE'] = os.environ.get('JOBS_INLINE') == '1'
 toolbar = DebugToolbarExtension(app)
 
 connect_db(app)
+querycount.init_app(app)
+replicas.init_app(app)
+metrics.init_app(app)
+dbpool.init_app(app)
+identity.init_app(app)
+conditional.init_app(app)
+assets.init_app(app)
+fragments.init_app(app)
+passwords.init_app(app)
+pubsub.init_app(app)
+jobs.init_app(app)
+api.init_app(app)
+app.cli.add_command(backfill_conversations)
+app.cli.add_command(backfill_timelines)
+app.cli.add_command(build_assets)
+app.cli.add_command(db_upgrade)
+app.cli.add_command(load_seed)
+app.cli.add_command(reconcile_counters)
+app.cli.add_command(run_worker)
 
 
 @app.errorhandler(404)
 def page_not_found(e):
     return render_template('404.html'), 404
 
+
+@app.errorhandler(passwords.PasswordHashingBusy)
+def password_hashing_busy(e):
+    """Too many logins/signups at once: ask the client to retry shortly."""
+
+    db.session.rollback()
+    return render_template('503.html'), 503, {'Retry-After': '1'}
+
 ##############################################################################
 # User signup/login/logout
 
 
 @app.before_request
 def add_user_to_g():
-    """If we're logged in, add curr user to Flask global."""
+    """If we're logged in, add curr user to Flask global.
 
-    if CURR_USER_KEY in session:
-        g.user = User.query.get(session[CURR_USER_KEY])
+    g.user is an identity.CurrentUser: the basics come from a cache and the
+    full User row is only loaded if the route needs it. Static files don't
+    need a user at all.
+    """
+
+    if CURR_USER_KEY in session and request.endpoint not in ('static', 'assets'):
+        g.user = identity.load(session[CURR_USER_KEY])
 
     else:
         g.user = None
@@ -102,6 +190,8 @@ def login():
         user = User.authenticate(form.username.data, form.password.data)
 
         if user:
+            # keep a password hash upgraded by authenticate()
+            db.session.commit()
             do_login(user)
             flash(f"Hello, {user.username}!", "success")
             return redirect("/")
@@ -128,34 +218,47 @@ def logout():
 def list_users():
     """Page with listing of users.
 
-    Can take a 'q' param in querystring to search by that username.
+    Can take a 'q' param in querystring to search by that username (or by
+    words in the bio and location); results are ranked and paginated.
     """
 
     search = request.args.get('q')
 
     if not search:
-        users = User.query.all()
+        page = paginate(User.query, (User.id,), per_page=app.config['USERS_PER_PAGE'], **cursor_args())
+        results = None
+        users = page.items
     else:
-        users = User.query.filter(User.username.like(f"%{search}%")).all()
+        page = None
+        results = search_users(search, request.args.get('page'))
+        users = results.items
+
+    following_ids = g.user.following_ids(user.id for user in users) if g.user else set()
 
-    return render_template('users/index.html', users=users)
+    return render_template('users/index.html', users=users, following_ids=following_ids,
+                           page=page, results=results, search=search)
 
 
 @app.route('/users/<int:user_id>')
 def users_show(user_id):
     """Show user profile."""
 
-    user = User.query.get_or_404(user_id)
+    version = User.version_of(user_id) or abort(404)
 
     # snagging messages in order from the database;
     # user.messages won't be in order by default
-    messages = (Message
-                .query
-                .filter(Message.user_id == user_id)
-                .order_by(Message.timestamp.desc())
-                .limit(100)
-                .all())
-    return render_template('users/show.html', user=user, messages=messages)
+    page = paginate(Message.query.filter(Message.user_id == user_id),
+                    (Message.timestamp, Message.id),
+                    **cursor_args())
+
+    # likes don't bump the author's version, so the page's own like counts
+    # go into the validator (and there's no Last-Modified to go by)
+    not_modified = conditional.validate(*version, *((msg.id, msg.likes_count) for msg in page.items))
+    if not_modified:
+        return not_modified
+
+    user = User.query.get_or_404(user_id)
+    return render_template('users/show.html', user=user, messages=page.items, page=page)
 
 @app.route('/users/<int:user_id>/following')
 def show_following(user_id):
@@ -166,7 +269,17 @@ def show_following(user_id):
         return redirect("/")
 
     user = User.query.get_or_404(user_id)
-    return render_template('users/following.html', user=user)
+    listed, member = User.follow_list(user_id, 'following')
+    page = paginate(listed, (member,), per_page=app.config['USERS_PER_PAGE'],
+                    key=lambda listed_user: (listed_user.id,), **cursor_args())
+
+    # the page shows the user and these cards, so their versions are enough
+    not_modified = conditional.validate(user.version, *((card.id, card.version) for card in page.items))
+    if not_modified:
+        return not_modified
+
+    following_ids = g.user.following_ids(card.id for card in page.items)
+    return render_template('users/following.html', user=user, users=page.items, following_ids=following_ids, page=page)
 
 
 @app.route('/users/<int:user_id>/followers')
@@ -178,7 +291,17 @@ def users_followers(user_id):
         return redirect("/")
 
     user = User.query.get_or_404(user_id)
-    return render_template('users/followers.html', user=user)
+    listed, member = User.follow_list(user_id, 'followers')
+    page = paginate(listed, (member,), per_page=app.config['USERS_PER_PAGE'],
+                    key=lambda listed_user: (listed_user.id,), **cursor_args())
+
+    # the page shows the user and these cards, so their versions are enough
+    not_modified = conditional.validate(user.version, *((card.id, card.version) for card in page.items))
+    if not_modified:
+        return not_modified
+
+    following_ids = g.user.following_ids(card.id for card in page.items)
+    return render_template('users/followers.html', user=user, users=page.items, following_ids=following_ids, page=page)
 
 
 @app.route('/users/follow/<int:follow_id>', methods=['POST'])
@@ -191,6 +314,9 @@ def add_follow(follow_id):
 
     followed_user = User.query.get_or_404(follow_id)
     g.user.following.append(followed_user)
+    jobs.enqueue('add_follow', follower_id=g.user.id, followed_id=followed_user.id)
+    User.adjust_counts(g.user.id, following_count=1)
+    User.adjust_counts(followed_user.id, followers_count=1)
     db.session.commit()
 
     #return redirect(f"/users/{g.user.id}/following")
@@ -207,6 +333,9 @@ def stop_following(follow_id):
 
     followed_user = User.query.get(follow_id)
     g.user.following.remove(followed_user)
+    jobs.enqueue('remove_follow', follower_id=g.user.id, followed_id=follow_id)
+    User.adjust_counts(g.user.id, following_count=-1)
+    User.adjust_counts(follow_id, followers_count=-1)
     db.session.commit()
 
     #return redirect(f"/users/{g.user.id}/following") 
@@ -232,10 +361,13 @@ def sent_message(user_id):
                 receiver_id = user_id,
                 message_text = form.text.data,
         )
+        jobs.enqueue('add_direct_message', message_id=direct_msg.id)
         db.session.commit()
+        # the receiver's navbar shows their unread count
+        identity.forget(user_id)
     
         flash("You have successfully sent the message out.", "success")
-        return redirect( url_for('users_show', user_id=g.user.id) )
+        return redirect( url_for('messages_show_thread', user_id=user_id) )
     
     return render_template('messages/new.html', form=form)
 
@@ -260,6 +392,7 @@ def change_psw(user_id):
                 
                 user = User.changepws(g.user.username, form.new_password.data)
                 db.session.commit()
+                identity.forget(user.id)
                 
                 return render_template('users/detail.html', user=user)
                 
@@ -293,9 +426,11 @@ def profile(user_id):
             g.user.image_url =form.image_url.data
             g.user.header_image_url = form.header_image_url.data
             g.user.bio = form.bio.data
+            User.touch([g.user.id])
             
             #db.session.add(user)
             db.session.commit()
+            identity.forget(g.user.id)
             
             return render_template('users/detail.html', user=g.user)
         
@@ -315,8 +450,11 @@ def delete_user():
 
     do_logout()
 
-    db.session.delete(g.user)
+    # hidden from now on; the rows are purged in batches by a job
+    AccountDeletion.start(g.user.id)
+    jobs.enqueue('purge_account', user_id=g.user.id)
     db.session.commit()
+    identity.forget(g.user.id)
 
     #return redirect("/signup")
     return redirect( url_for('signup') )
@@ -328,14 +466,8 @@ def add_like(message_id):
         flash("Access unauthorized.", "danger")
         return redirect("/")
 
-    liked_message = Message.query.get_or_404(message_id)
-    list_likes = g.user.likes
-    
-    if liked_message in list_likes:
-        g.user.likes = [like for like in list_likes if like != liked_message]
-    else:
-        g.user.likes.append(liked_message)
-
+    Message.query.get_or_404(message_id)
+    Likes.toggle(g.user.id, message_id)
     db.session.commit()
     
     return redirect("/")
@@ -361,6 +493,10 @@ def messages_add():
     if form.validate_on_submit():
         msg = Message(text=form.text.data)
         g.user.messages.append(msg)
+        db.session.flush()
+        jobs.enqueue('fan_out', message_id=msg.id)
+        User.adjust_counts(g.user.id, messages_count=1)
+        pubsub.notify_message(msg)
         db.session.commit()
 
         #return redirect(f"/users/{g.user.id}")
@@ -369,10 +505,28 @@ def messages_add():
     return render_template('messages/new.html', form=form)
 
 
+@app.route('/messages/search', methods=["GET"])
+def messages_search():
+    """Search messages by text.
+
+    Takes a 'q' param in querystring; supports quoted phrases and -word.
+    """
+
+    search = request.args.get('q', '')
+    results = search_messages(search, request.args.get('page')) if search else None
+
+    return render_template('messages/search.html', results=results, search=search)
+
+
 @app.route('/messages/<int:message_id>', methods=["GET"])
 def messages_show(message_id):
     """Show a message."""
 
+    version = Message.version_of(message_id) or abort(404)
+    not_modified = conditional.validate(*version, last_modified=version.updated_at)
+    if not_modified:
+        return not_modified
+
     msg = Message.query.get_or_404(message_id)
     return render_template('messages/show.html', message=msg)
 
@@ -390,6 +544,10 @@ def messages_destroy(message_id):
         flash("Access unauthorized.", "danger")
         return redirect("/")
     
+    # timeline entries and likes for this message go with it (ON DELETE
+    # CASCADE), so settle the counters first
+    User.release_likes([msg.id])
+    User.adjust_counts(g.user.id, messages_count=-1)
     db.session.delete(msg)
     db.session.commit()
 
@@ -404,23 +562,55 @@ def messages_show_likes(user_id):
         return redirect("/")
     
     user = User.query.get_or_404(user_id)
-    
-    msg_likes = [likes.id for likes in user.likes]
-    messages = Message.query.filter(Message.id.in_(msg_likes)).order_by(Message.timestamp.desc()).all()
-        
-    return render_template('messages/show_likes.html', messages=messages, likes=msg_likes)
+
+    liked = (Message
+             .query
+             .join(Likes, Likes.message_id == Message.id)
+             .filter(Likes.user_id == user.id)
+             .options(joinedload(Message.user).load_only(User.username, User.image_url, User.version)))
+    page = paginate(liked, (Message.timestamp, Message.id), **cursor_args())
+    msg_likes = g.user.liked_ids(message.id for message in page.items)
+
+    return render_template('messages/show_likes.html', messages=page.items, likes=msg_likes, page=page)
 
 @app.route('/messages/private', methods=["GET"])
 def messages_show_private():
-    """Show the private messages received."""
+    """Show the conversations of the logged-in user, latest first."""
 
     if not g.user:
         flash("Access unauthorized.", "danger")
         return redirect("/")
     
-    msg_direct = DirectMessage.query.filter(DirectMessage.receiver_id == g.user.id).order_by(DirectMessage.timestamp.desc()).all()
-        
-    return render_template('messages/show_direct.html', msg_direct=msg_direct)
+    conversations = (Conversation
+                     .query
+                     .filter(Conversation.user_id == g.user.id)
+                     .options(joinedload(Conversation.other).load_only(User.username, User.image_url),
+                              joinedload(Conversation.last_message).load_only(DirectMessage.sender_id,
+                                                                              DirectMessage.message_text)))
+    page = paginate(conversations, (Conversation.last_message_at, Conversation.other_id),
+                    per_page=app.config['USERS_PER_PAGE'], **cursor_args())
+
+    return render_template('messages/show_direct.html', conversations=page.items, page=page)
+
+@app.route('/messages/private/<int:user_id>', methods=["GET"])
+def messages_show_thread(user_id):
+    """Show the direct messages between the logged-in user and another user,
+    and mark them read."""
+
+    if not g.user:
+        flash("Access unauthorized.", "danger")
+        return redirect("/")
+
+    other = User.query.options(load_only(User.username, User.image_url)).get_or_404(user_id)
+    page = paginate(DirectMessage.thread(g.user.id, user_id), (DirectMessage.timestamp, DirectMessage.id),
+                    **cursor_args())
+
+    if Conversation.mark_read(g.user.id, user_id):
+        db.session.commit()
+        identity.forget(g.user.id)
+        g.user = identity.load(g.user.id)
+
+    return render_template('messages/thread.html', other=other, msg_direct=page.items, page=page)
 
 
 
@@ -433,33 +623,63 @@ def homepage():
     """Show homepage:
 
     - anon users: no messages
-    - logged in: 100 most recent messages of followed_users
+    - logged in: most recent messages of followed_users, a page at a time
     """
 
     if g.user:
         
-        curr_following = [ubfi.id for ubfi in g.user.following]
-        messages = Message.query.filter(Message.user_id.in_(curr_following)).order_by(Message.timestamp.desc()).limit(100).all()
-        likes = [likes.id for likes in g.user.likes]
-        return render_template('home.html', messages=messages, likes=likes)
+        timeline = (TimelineEntry
+                    .messages_for(g.user.id)
+                    .options(joinedload(Message.user).load_only(User.username, User.image_url, User.version)))
+        page = paginate(timeline,
+                        (TimelineEntry.timestamp, TimelineEntry.message_id),
+                        key=lambda msg: (msg.timestamp, msg.id),
+                        **cursor_args())
+        likes = g.user.liked_ids(msg.id for msg in page.items)
+        # the profile card's columns only, not the whole User
+        card = (db.session
+                .query(User.header_image_url, User.messages_count, User.following_count, User.followers_count)
+                .filter(User.id == g.user.id)
+                .one())
+        return render_template('home.html', messages=page.items, likes=likes, page=page, card=card)
 
     else:
         return render_template('home-anon.html')
 
 
+@app.route('/stream/timeline')
+def timeline_stream():
+    """Stream new messages from followed users as Server-Sent Events (see pubsub.py)."""
+
+    if not g.user:
+        return Response(status=401)
+
+    followed = [user_id for (user_id,) in (db.session
+                                           .query(Follows.user_being_followed_id)
+                                           .filter(Follows.user_following_id == g.user.id))]
+    # don't hold a database connection for the life of the stream
+    db.session.remove()
+
+    pubsub.listen(app)
+    subscription = pubsub.hub.subscribe(g.user.id, followed, app.config['EVENTS_QUEUE_SIZE'])
+    heartbeat = app.config['EVENTS_HEARTBEAT']
+    deadline = monotonic() + app.config['EVENTS_STREAM_TIMEOUT']
+
+    def events():
+        try:
+            yield "retry: 3000\n\n"
+            while not subscription.closed and monotonic() < deadline:
+                event = subscription.get(timeout=min(heartbeat, max(deadline - monotonic(), 0)))
+                if event is None:
+                    yield ": keep-alive\n\n"
+                else:
+                    yield f"id: {event['id']}\nevent: warble\ndata: {json.dumps(event)}\n\n"
+        finally:
+            pubsub.hub.unsubscribe(subscription)
+
+    return Response(events(), mimetype='text/event-stream', headers={'X-Accel-Buffering': 'no'})
+
+
 ##############################################################################
-# Turn off all caching in Flask
-#   (useful for dev; in production, this kind of stuff is typically
-#   handled elsewhere)
-#
-# https://stackoverflow.com/questions/34066804/disabling-caching-in-flask
-
-@app.after_request
-def add_header(req):
-    """Add non-caching headers on every request."""
-
-    req.headers["Cache-Control"] = "no-cache, no-store, must-revalidate"
-    req.headers["Pragma"] = "no-cache"
-    req.headers["Expires"] = "0"
-    req.headers['Cache-Control'] = 'public, max-age=0'
-    return req
+# Caching: Cache-Control headers are set per class of route, and ETags for
+# profile, follow-list and message pages, by conditional.py
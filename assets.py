@@ -0,0 +1,159 @@
+"""Fingerprinted, precompressed static assets.
+
+`flask --app app build-assets` copies every file under static/ into dist/
+with a hash of its content in the name (style.css -> style.3f2a9c1b7d4e.css),
+writes .gz (and, with the optional `brotli` package, .br) variants of text
+files, and records the names in dist/manifest.json. References to /static/
+files inside CSS are rewritten to the fingerprinted names too.
+
+Templates link to assets with `static_url('stylesheets/style.css')`. With a
+manifest, that points at /assets/<fingerprinted name>, which is served with
+the best precompressed variant the client accepts and cached as immutable
+for a year (see conditional.POLICIES). A new build changes the names, so
+clients never need to revalidate. Without a manifest (development), `static_url` falls back to
+the plain /static/ file.
+"""
+
+import gzip
+import hashlib
+import json
+import mimetypes
+import os
+import re
+import shutil
+
+from flask import current_app, request, send_from_directory, url_for
+
+try:
+    import brotli
+except ImportError:  # optional: only .gz variants are built without it
+    brotli = None
+
+ASSETS_URL = '/assets/'
+MANIFEST = 'manifest.json'
+
+# Worth precompressing; images are already compressed
+COMPRESSIBLE = {'.css', '.js', '.svg', '.ico', '.txt', '.json', '.map'}
+
+# Content-Encoding: file suffix, best first
+ENCODINGS = [('br', '.br'), ('gzip', '.gz')]
+
+STATIC_REF = re.compile(r'''url\((["']?)/static/([^"')]+)\1\)''')
+
+manifest = {}
+
+
+def fingerprinted_name(path, content):
+    """`path` with a hash of `content` before its extension."""
+
+    stem, ext = os.path.splitext(path)
+    return f"{stem}.{hashlib.sha256(content).hexdigest()[:12]}{ext}"
+
+
+def rewrite_css(content, names):
+    """Point url(/static/...) references in CSS at fingerprinted names."""
+
+    def fingerprinted(match):
+        quote, path = match.groups()
+        if path not in names:
+            return match.group(0)
+        return f"url({quote}{ASSETS_URL}{names[path]}{quote})"
+
+    return STATIC_REF.sub(fingerprinted, content.decode('utf-8')).encode('utf-8')
+
+
+def write_variants(path, content):
+    """Write `content` to `path`, plus compressed variants if it's compressible."""
+
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(path, 'wb') as out:
+        out.write(content)
+
+    if os.path.splitext(path)[1] not in COMPRESSIBLE:
+        return
+
+    with open(path + '.gz', 'wb') as out:
+        out.write(gzip.compress(content, compresslevel=9, mtime=0))
+
+    if brotli is not None:
+        with open(path + '.br', 'wb') as out:
+            out.write(brotli.compress(content, quality=11))
+
+
+def build(static_dir, dist_dir):
+    """Fingerprint and precompress every file in `static_dir` into `dist_dir`.
+
+    Returns the manifest, mapping each static path to its fingerprinted name.
+    """
+
+    paths = sorted(os.path.relpath(os.path.join(directory, filename), static_dir).replace(os.sep, '/')
+                   for directory, _, filenames in os.walk(static_dir)
+                   for filename in filenames)
+
+    if os.path.isdir(dist_dir):
+        shutil.rmtree(dist_dir)
+
+    names = {}
+    # CSS last: it refers to the other files by their fingerprinted names
+    for path in sorted(paths, key=lambda path: path.endswith('.css')):
+        with open(os.path.join(static_dir, path), 'rb') as source:
+            content = source.read()
+        if path.endswith('.css'):
+            content = rewrite_css(content, names)
+
+        names[path] = fingerprinted_name(path, content)
+        write_variants(os.path.join(dist_dir, names[path]), content)
+
+    with open(os.path.join(dist_dir, MANIFEST), 'w') as out:
+        json.dump(names, out, indent=2, sort_keys=True)
+
+    return names
+
+
+def load_manifest(dist_dir):
+    """Read the manifest written by `build`, or {} if there's no build."""
+
+    try:
+        with open(os.path.join(dist_dir, MANIFEST)) as source:
+            return json.load(source)
+    except FileNotFoundError:
+        return {}
+
+
+def static_url(path):
+    """URL of static file `path`: fingerprinted if built, else under /static/."""
+
+    name = manifest.get(path)
+    if name is None:
+        return url_for('static', filename=path)
+    return url_for('assets', filename=name)
+
+
+def serve_asset(filename):
+    """Serve a fingerprinted asset, precompressed if the client accepts it."""
+
+    dist_dir = current_app.config['ASSETS_DIST_DIR']
+    mimetype = mimetypes.guess_type(filename)[0] or 'application/octet-stream'
+
+    for encoding, suffix in ENCODINGS:
+        if request.accept_encodings[encoding] and os.path.isfile(os.path.join(dist_dir, filename + suffix)):
+            response = send_from_directory(dist_dir, filename + suffix, mimetype=mimetype)
+            response.headers['Content-Encoding'] = encoding
+            break
+    else:
+        response = send_from_directory(dist_dir, filename, mimetype=mimetype)
+
+    response.vary.add('Accept-Encoding')
+    return response
+
+
+def init_app(app):
+    """Serve built assets at /assets/ and give templates `static_url`."""
+
+    app.config.setdefault('ASSETS_DIST_DIR', os.path.join(app.root_path, 'dist'))
+
+    manifest.clear()
+    manifest.update(load_manifest(app.config['ASSETS_DIST_DIR']))
+
+    app.add_url_rule(ASSETS_URL + '<path:filename>', 'assets', serve_asset)
+    app.jinja_env.globals['static_url'] = static_url
@@ -0,0 +1,354 @@
+"""Route-level load benchmark for Warbler.
+
+Seeds a database of a given size with the generator and load-seed, then
+runs concurrent simulated users against the app in-process. Each user
+loops over a weighted mix of homepage, profile, follow/unfollow, like,
+post and DM-inbox requests. For every route it reports p50/p95/p99
+latency, throughput and SQL statements per request (from the /metrics
+histograms). Results are written as JSON and can be compared against a
+saved baseline.
+
+Run it like:
+
+    createdb warbler_bench
+    python benchmark.py --dataset small --output bench.json
+    cp bench.json baseline.json                    # after a known-good run
+    python benchmark.py --skip-seed --baseline baseline.json
+
+The database is BENCHMARK_DATABASE_URL (default warbler_bench), never
+DATABASE_URL: seeding drops every table. It refuses to run against a
+database whose name doesn't end in _bench. Each simulated user takes back
+its follows, likes and posts when the run ends, so runs on the same seed
+start from the same data.
+
+It exits with status 1 if a route regressed past --threshold against the
+baseline. Simulated users run on threads and share the GIL, so compare
+runs made on the same machine with the same settings.
+"""
+
+import argparse
+import json
+import os
+import subprocess
+import sys
+import tempfile
+import threading
+from random import Random
+from time import perf_counter, time
+
+os.environ['DATABASE_URL'] = os.environ.get('BENCHMARK_DATABASE_URL', "postgresql:///warbler_bench")
+
+from sqlalchemy import func
+from sqlalchemy.engine import make_url
+
+from app import app, CURR_USER_KEY
+from commands import load_seed
+import jobs
+from metrics import SQL_STATEMENTS
+from models import db, User, Message, Follows
+
+BASE_DIR = os.path.dirname(os.path.abspath(__file__))
+
+# generator sizes: --users, --messages, --follows, --likes, --dms
+DATASETS = {
+    'small': dict(users=1000, messages=10000, follows=20000, likes=10000, dms=1000),
+    'medium': dict(users=10000, messages=100000, follows=300000, likes=100000, dms=10000),
+    'large': dict(users=100000, messages=1000000, follows=3000000, likes=1000000, dms=100000),
+}
+
+# action: (weight, endpoint whose SQL statements are counted)
+MIX = {
+    'homepage': (40, 'homepage'),
+    'profile': (20, 'users_show'),
+    'follow': (5, 'add_follow'),
+    'unfollow': (5, 'stop_following'),
+    'like': (10, 'add_like'),
+    'post': (10, 'messages_add'),
+    'dm_inbox': (10, 'messages_show_private'),
+}
+
+
+def check_database():
+    """Refuse to touch anything but a benchmark database."""
+
+    name = make_url(app.config['SQLALCHEMY_DATABASE_URI']).database or ''
+    if not name.endswith('_bench'):
+        raise SystemExit(f"Refusing to benchmark against {name!r}: "
+                         "point BENCHMARK_DATABASE_URL at a database named *_bench.")
+
+
+def seed(dataset, seed_value):
+    """Generate CSVs of the `dataset` size and load them with load-seed."""
+
+    with tempfile.TemporaryDirectory() as out:
+        args = [sys.executable, os.path.join(BASE_DIR, 'generator', 'create_csvs.py'),
+                '--seed', str(seed_value), '--out', out]
+        for option, value in DATASETS[dataset].items():
+            args += [f'--{option}', str(value)]
+        subprocess.run(args, check=True)
+
+        result = app.test_cli_runner().invoke(load_seed, ['--yes', '--directory', out])
+        print(result.output, end='')
+        if result.exit_code:
+            raise SystemExit(f"load-seed failed: {result.exception!r}")
+
+
+class SimulatedUser:
+    """One logged-in user making requests with its own test client."""
+
+    def __init__(self, user_id, following, max_user_id, max_message_id, rng):
+        self.user_id = user_id
+        self.following = following
+        self.max_user_id = max_user_id
+        self.max_message_id = max_message_id
+        self.rng = rng
+        self.followed_here = []
+        # messages whose like this run toggled an odd number of times
+        self.toggled_here = set()
+
+        self.client = app.test_client()
+        with self.client.session_transaction() as sess:
+            sess[CURR_USER_KEY] = user_id
+
+    def other_user_id(self):
+        while True:
+            user_id = self.rng.randint(1, self.max_user_id)
+            if user_id != self.user_id:
+                return user_id
+
+    def choose(self):
+        """Pick the next action; unfollow only what this run followed."""
+
+        actions = [action for action in MIX if action != 'unfollow' or self.followed_here]
+        return self.rng.choices(actions, weights=[MIX[action][0] for action in actions])[0]
+
+    def request(self, action):
+        """Make the request for `action`; returns the response status, or
+        None if there was nothing to do."""
+
+        client = self.client
+
+        if action == 'homepage':
+            return client.get('/').status_code
+        if action == 'profile':
+            return client.get(f'/users/{self.other_user_id()}').status_code
+        if action == 'follow':
+            followed_id = self.other_user_id()
+            if followed_id in self.following:
+                return None
+            self.following.add(followed_id)
+            self.followed_here.append(followed_id)
+            return client.post(f'/users/follow/{followed_id}').status_code
+        if action == 'unfollow':
+            followed_id = self.followed_here.pop()
+            self.following.discard(followed_id)
+            return client.post(f'/users/stop-following/{followed_id}').status_code
+        if action == 'like':
+            message_id = self.rng.randint(1, self.max_message_id)
+            self.toggled_here ^= {message_id}
+            return client.post(f'/users/add_like/{message_id}').status_code
+        if action == 'post':
+            return client.post('/messages/new', data={'text': f"benchmark warble {self.rng.random()}"}).status_code
+        if action == 'dm_inbox':
+            return client.get('/messages/private').status_code
+
+        raise ValueError(action)
+
+    def undo(self):
+        """Take back this run's follows, likes and posts, through the same
+        routes so counters stay right."""
+
+        while self.followed_here:
+            self.request('unfollow')
+
+        for message_id in sorted(self.toggled_here):
+            self.client.post(f'/users/add_like/{message_id}')
+        self.toggled_here.clear()
+
+        with app.app_context():
+            posted = [message_id for (message_id,) in (db.session
+                                                       .query(Message.id)
+                                                       .filter(Message.user_id == self.user_id,
+                                                               Message.id > self.max_message_id))]
+        for message_id in posted:
+            self.client.post(f'/messages/{message_id}/delete')
+
+
+def percentile(ordered, fraction):
+    """Nearest-rank percentile of an ascending list."""
+
+    if not ordered:
+        return None
+    return ordered[min(len(ordered) - 1, max(0, round(fraction * len(ordered)) - 1))]
+
+
+def run(concurrency, duration, seed_value):
+    """Drive the app with `concurrency` simulated users for `duration` seconds.
+
+    Returns `{action: [(latency, status), ...]}` and the elapsed time.
+    """
+
+    max_user_id = db.session.query(func.max(User.id)).scalar()
+    max_message_id = db.session.query(func.max(Message.id)).scalar() or 1
+    if not max_user_id or max_user_id < 2:
+        raise SystemExit("The database needs seeding first (drop --skip-seed).")
+
+    rng = Random(seed_value)
+    users = []
+    # distinct users, so no two undo each other's likes
+    for i, user_id in enumerate(rng.sample(range(1, max_user_id + 1), concurrency)):
+        following = {followed_id for (followed_id,) in (db.session
+                                                         .query(Follows.user_being_followed_id)
+                                                         .filter(Follows.user_following_id == user_id))}
+        users.append(SimulatedUser(user_id, following, max_user_id, max_message_id, Random(seed_value + i)))
+    db.session.remove()
+
+    samples = {action: [] for action in MIX}
+    lock = threading.Lock()
+    deadline = perf_counter() + duration
+
+    def loop(user):
+        mine = {action: [] for action in MIX}
+        while perf_counter() < deadline:
+            action = user.choose()
+            start = perf_counter()
+            status = user.request(action)
+            if status is not None:
+                mine[action].append((perf_counter() - start, status))
+
+        # so runs on the same data stay comparable
+        user.undo()
+
+        with lock:
+            for action, results in mine.items():
+                samples[action].extend(results)
+
+    # deferred work (timeline fan-out, follow backfills) runs alongside, as
+    # it would in production
+    worker = jobs.Worker(app, threads=1, poll_interval=.1)
+    worker_thread = threading.Thread(target=worker.run)
+    worker_thread.start()
+
+    threads = [threading.Thread(target=loop, args=(user,)) for user in users]
+    start = perf_counter()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    elapsed = perf_counter() - start
+
+    # drain what's left, so the next run starts with an empty queue
+    worker.stop()
+    worker_thread.join()
+    jobs.Worker(app, threads=1).run(burst=True)
+
+    return samples, elapsed
+
+
+def summarize(samples, elapsed, sql_before, sql_after):
+    """Per-route latency percentiles (ms), throughput and SQL statements per request."""
+
+    routes = {}
+    for action, results in samples.items():
+        endpoint = MIX[action][1]
+        latencies = sorted(latency * 1000 for latency, status in results)
+        count_before, sum_before = sql_before.get(endpoint, (0, 0))
+        count_after, sum_after = sql_after.get(endpoint, (0, 0))
+        requests = count_after - count_before
+
+        routes[action] = dict(
+            endpoint=endpoint,
+            requests=len(results),
+            errors=sum(1 for latency, status in results if status >= 400),
+            throughput=round(len(results) / elapsed, 2),
+            p50_ms=percentile(latencies, .50),
+            p95_ms=percentile(latencies, .95),
+            p99_ms=percentile(latencies, .99),
+            sql_per_request=round((sum_after - sum_before) / requests, 2) if requests else None,
+        )
+
+    total = sum(route['requests'] for route in routes.values())
+    return dict(routes=routes, total=dict(requests=total, throughput=round(total / elapsed, 2)))
+
+
+def compare(results, baseline, threshold):
+    """Print each route against the baseline; return the routes that regressed."""
+
+    regressions = []
+    print(f"\n{'route':<10} {'p95 ms':>9} {'baseline':>9} {'change':>8} {'sql/req':>8} {'baseline':>9}")
+
+    for action, route in results['routes'].items():
+        before = baseline['routes'].get(action)
+        if not before or route['p95_ms'] is None or before['p95_ms'] is None:
+            continue
+
+        change = route['p95_ms'] / before['p95_ms'] - 1 if before['p95_ms'] else 0
+        # some routes vary a little (a like vs an unlike); N+1 queries don't
+        more_sql = (route['sql_per_request'] or 0) > (before['sql_per_request'] or 0) * (1 + threshold) + 0.5
+        flag = ''
+        if change > threshold or more_sql:
+            regressions.append(action)
+            flag = '  REGRESSION'
+
+        print(f"{action:<10} {route['p95_ms']:>9.1f} {before['p95_ms']:>9.1f} {change:>+8.0%} "
+              f"{route['sql_per_request'] or 0:>8} {before['sql_per_request'] or 0:>9}{flag}")
+
+    return regressions
+
+
+def report(results):
+    print(f"\n{'route':<10} {'reqs':>6} {'errors':>6} {'req/s':>8} {'p50 ms':>8} {'p95 ms':>8} {'p99 ms':>8} {'sql/req':>8}")
+    for action, route in results['routes'].items():
+        if not route['requests']:
+            continue
+        print(f"{action:<10} {route['requests']:>6} {route['errors']:>6} {route['throughput']:>8} "
+              f"{route['p50_ms']:>8.1f} {route['p95_ms']:>8.1f} {route['p99_ms']:>8.1f} "
+              f"{route['sql_per_request'] or 0:>8}")
+    print(f"total: {results['total']['requests']} requests, {results['total']['throughput']} req/s")
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+    parser.add_argument('--dataset', choices=DATASETS, default='small')
+    parser.add_argument('--skip-seed', action='store_true', help="reuse the data already loaded")
+    parser.add_argument('--concurrency', type=int, default=8, help="simulated users")
+    parser.add_argument('--duration', type=float, default=30, help="seconds to run")
+    parser.add_argument('--seed', type=int, default=1)
+    parser.add_argument('--output', help="write the results to this JSON file")
+    parser.add_argument('--baseline', help="compare against the results in this JSON file")
+    parser.add_argument('--threshold', type=float, default=.2,
+                        help="p95 slowdown or SQL growth (fraction) counted as a regression")
+    return parser.parse_args()
+
+
+def main():
+    options = parse_args()
+
+    app.config['WTF_CSRF_ENABLED'] = False
+    app.config['SQL_STATEMENT_LIMIT'] = None
+
+    check_database()
+    if not options.skip_seed:
+        seed(options.dataset, options.seed)
+
+    sql_before = SQL_STATEMENTS.totals()
+    samples, elapsed = run(options.concurrency, options.duration, options.seed)
+    results = summarize(samples, elapsed, sql_before, SQL_STATEMENTS.totals())
+    results['run'] = dict(dataset=options.dataset, concurrency=options.concurrency,
+                          duration=round(elapsed, 2), seed=options.seed, finished_at=int(time()))
+
+    report(results)
+
+    if options.output:
+        with open(options.output, 'w') as out:
+            json.dump(results, out, indent=2)
+
+    if options.baseline:
+        with open(options.baseline) as saved:
+            regressions = compare(results, json.load(saved), options.threshold)
+        if regressions:
+            raise SystemExit(f"Regressed: {', '.join(regressions)}")
+
+
+if __name__ == '__main__':
+    main()
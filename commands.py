@@ -0,0 +1,290 @@
+"""Flask CLI commands for maintaining Warbler's data.
+
+Run these like:
+
+    flask --app app backfill-timelines
+"""
+
+import csv
+import os
+import signal
+from time import perf_counter
+
+import click
+from flask import current_app
+from flask.cli import with_appcontext
+from sqlalchemy import text
+from sqlalchemy.schema import AddConstraint, CreateIndex, CreateTable
+
+import assets
+import jobs
+from models import db, create_pg_trgm, create_username_trgm_index, pg_trgm_available, User, Message, Conversation, TimelineEntry
+
+BASE_DIR = os.path.dirname(os.path.abspath(__file__))
+MIGRATIONS_DIR = os.path.join(BASE_DIR, 'migrations')
+SEED_DIR = os.path.join(BASE_DIR, 'generator')
+
+
+def id_batches(column, batch_size):
+    """Yield every value of the integer key `column` in ascending batches of `batch_size`."""
+
+    last_id = 0
+
+    while True:
+        ids = [row_id for (row_id,) in (db.session
+                                        .query(column)
+                                        .filter(column > last_id)
+                                        .order_by(column)
+                                        .limit(batch_size))]
+        if not ids:
+            return
+
+        yield ids
+        last_id = ids[-1]
+
+
+@click.command('backfill-timelines')
+@click.option('--batch-size', default=500, show_default=True,
+              help="Number of users rebuilt per transaction.")
+@with_appcontext
+def backfill_timelines(batch_size):
+    """Rebuild every user's home timeline from follows and messages."""
+
+    total = 0
+
+    for user_ids in id_batches(User.id, batch_size):
+        total += TimelineEntry.rebuild(user_ids)
+        db.session.commit()
+
+    click.echo(f"Backfilled {total} timeline entries.")
+
+
+@click.command('backfill-conversations')
+@click.option('--batch-size', default=1000, show_default=True,
+              help="Number of users rebuilt per transaction.")
+@with_appcontext
+def backfill_conversations(batch_size):
+    """Rebuild every user's conversation list from direct messages, marking
+    them all read."""
+
+    total = 0
+
+    for user_ids in id_batches(User.id, batch_size):
+        total += Conversation.rebuild(user_ids)
+        db.session.commit()
+
+    click.echo(f"Backfilled {total} conversations.")
+
+
+@click.command('reconcile-counters')
+@click.option('--batch-size', default=1000, show_default=True,
+              help="Number of users (or messages) recomputed per transaction.")
+@with_appcontext
+def reconcile_counters(batch_size):
+    """Recompute every user's message/follow/like counters and every message's
+    like count from the source tables."""
+
+    users = messages = 0
+
+    for user_ids in id_batches(User.id, batch_size):
+        users += User.reconcile_counts(user_ids)
+        db.session.commit()
+
+    for message_ids in id_batches(Message.id, batch_size):
+        messages += Message.reconcile_counts(message_ids)
+        db.session.commit()
+
+    click.echo(f"Reconciled counters for {users} users and {messages} messages.")
+
+
+def create_bare_tables(conn):
+    """Create every table with its primary key and unique constraints, but
+    without secondary indexes or foreign keys (see `add_deferred_schema`)."""
+
+    create_pg_trgm(db.metadata, conn)
+    for table in db.metadata.sorted_tables:
+        conn.execute(CreateTable(table, include_foreign_key_constraints=[]))
+
+
+def add_deferred_schema(conn):
+    """Build the indexes and foreign keys `create_bare_tables` left out."""
+
+    for table in db.metadata.sorted_tables:
+        for index in table.indexes:
+            conn.execute(CreateIndex(index))
+        for foreign_key in table.foreign_key_constraints:
+            conn.execute(AddConstraint(foreign_key))
+    create_username_trgm_index(User.__table__, conn)
+
+
+def copy_csv(cursor, table, path):
+    """Stream the CSV file at `path` into `table` with COPY FROM STDIN.
+
+    The header row names the columns. psycopg2 sends the file in fixed-size
+    chunks, so memory use doesn't grow with the file. Returns the number of
+    rows copied.
+    """
+
+    quote = db.engine.dialect.identifier_preparer.quote
+
+    with open(path, newline='') as source:
+        columns = next(csv.reader([source.readline()]))
+        unknown = set(columns) - set(table.c.keys())
+        if unknown:
+            raise click.ClickException(f"{path}: no such columns in {table.name}: {', '.join(sorted(unknown))}")
+
+        cursor.copy_expert(f"COPY {quote(table.name)} ({', '.join(quote(column) for column in columns)}) "
+                           f"FROM STDIN WITH (FORMAT csv)", source)
+
+    return cursor.rowcount
+
+
+def reset_sequences(conn):
+    """Move each serial id sequence past the largest id loaded."""
+
+    for table in db.metadata.sorted_tables:
+        column = table.autoincrement_column
+        if column is None:
+            continue
+        conn.execute(text(f"SELECT setval(pg_get_serial_sequence(:table, :column), "
+                          f"coalesce(max({column.name}), 0) + 1, false) FROM {table.name}"),
+                     dict(table=table.name, column=column.name))
+
+
+@click.command('load-seed')
+@click.option('--directory', default=SEED_DIR, show_default=True, type=click.Path(exists=True, file_okay=False),
+              help="Directory holding <table>.csv files.")
+@click.option('--batch-size', default=1000, show_default=True,
+              help="Batch size for rebuilding timelines and counters afterwards.")
+@click.confirmation_option(prompt="This drops every table and reloads them. Continue?")
+@with_appcontext
+@click.pass_context
+def load_seed(ctx, directory, batch_size):
+    """Recreate the database from the CSV files in generator/ using COPY.
+
+    Each table with a <table>.csv file (users, messages, follows, likes,
+    direct_msg) is streamed in with COPY FROM STDIN. Secondary indexes and
+    foreign keys are only built once the data is in, serial sequences are
+    moved past the loaded ids, and then timelines, conversations and
+    counters are derived as by backfill-timelines, backfill-conversations
+    and reconcile-counters.
+    """
+
+    db.drop_all()
+    with db.engine.begin() as conn:
+        create_bare_tables(conn)
+
+    raw = db.engine.raw_connection()
+    try:
+        cursor = raw.cursor()
+        for table in db.metadata.sorted_tables:
+            path = os.path.join(directory, f"{table.name}.csv")
+            if not os.path.exists(path):
+                continue
+
+            start = perf_counter()
+            rows = copy_csv(cursor, table, path)
+            raw.commit()
+            elapsed = perf_counter() - start
+            click.echo(f"{table.name}: {rows} rows in {elapsed:.1f}s ({rows / max(elapsed, 1e-6):,.0f} rows/s)")
+    finally:
+        raw.close()
+
+    start = perf_counter()
+    with db.engine.begin() as conn:
+        reset_sequences(conn)
+        add_deferred_schema(conn)
+    click.echo(f"Built indexes and foreign keys in {perf_counter() - start:.1f}s")
+
+    ctx.invoke(backfill_timelines, batch_size=batch_size)
+    ctx.invoke(backfill_conversations, batch_size=batch_size)
+    ctx.invoke(reconcile_counters, batch_size=batch_size)
+
+
+@click.command('build-assets')
+@with_appcontext
+def build_assets():
+    """Fingerprint and precompress static/ into dist/ (see assets.py)."""
+
+    static_dir = current_app.static_folder
+    dist_dir = current_app.config['ASSETS_DIST_DIR']
+
+    names = assets.build(static_dir, dist_dir)
+    click.echo(f"Built {len(names)} assets into {dist_dir}"
+               + ("" if assets.brotli else " (install brotli for .br variants)"))
+
+
+@click.command('run-worker')
+@click.option('--threads', default=4, show_default=True, help="Number of jobs run at once.")
+@click.option('--poll-interval', default=1.0, show_default=True,
+              help="Seconds a thread waits before polling an empty queue again.")
+@click.option('--burst', is_flag=True, help="Exit once the queue is empty.")
+@click.option('--metrics-port', type=int, help="Serve this worker's /metrics on this port.")
+@with_appcontext
+def run_worker(threads, poll_interval, burst, metrics_port):
+    """Run queued background jobs (see jobs.py).
+
+    SIGTERM or Ctrl-C lets the jobs in progress finish, then exits.
+    """
+
+    worker = jobs.Worker(current_app._get_current_object(), threads, poll_interval)
+    signal.signal(signal.SIGTERM, worker.stop)
+    signal.signal(signal.SIGINT, worker.stop)
+
+    if metrics_port:
+        jobs.serve_metrics(metrics_port)
+
+    click.echo(f"Running jobs on {threads} threads" + (" until the queue is empty" if burst else ""))
+    worker.run(burst=burst)
+
+
+def read_migration(path):
+    """Split a migration file into its SQL statements, dropping comments."""
+
+    with open(path) as migration:
+        lines = [line for line in migration if not line.lstrip().startswith('--')]
+
+    return [statement.strip() for statement in ''.join(lines).split(';') if statement.strip()]
+
+
+def apply_migrations(conn):
+    """Apply the migrations in migrations/ that `conn`'s database hasn't had,
+    in version order, yielding each filename before applying it.
+
+    `conn` must be in AUTOCOMMIT, so migrations can use
+    CREATE INDEX CONCURRENTLY; write them to be safe to re-run.
+
+    Like create_all(), it leaves out the statements that need pg_trgm
+    where the server doesn't ship the extension.
+    """
+
+    conn.execute(text("CREATE TABLE IF NOT EXISTS schema_migrations ("
+                      "version TEXT PRIMARY KEY, "
+                      "applied_at TIMESTAMP NOT NULL DEFAULT now())"))
+    applied = {version for (version,) in conn.execute(text("SELECT version FROM schema_migrations"))}
+    trigrams = pg_trgm_available(None, None, conn)
+
+    for filename in sorted(os.listdir(MIGRATIONS_DIR)):
+        version, ext = os.path.splitext(filename)
+        if ext != '.sql' or version in applied:
+            continue
+
+        yield filename
+        for statement in read_migration(os.path.join(MIGRATIONS_DIR, filename)):
+            if 'trgm' in statement and not trigrams:
+                continue
+            conn.execute(text(statement))
+        conn.execute(text("INSERT INTO schema_migrations (version) VALUES (:version)"),
+                     dict(version=version))
+
+
+@click.command('db-upgrade')
+@with_appcontext
+def db_upgrade():
+    """Apply pending SQL migrations from migrations/, in version order."""
+
+    with db.engine.connect().execution_options(isolation_level='AUTOCOMMIT') as conn:
+        for filename in apply_migrations(conn):
+            click.echo(f"Applying {filename}")
+
+    click.echo("Database is up to date.")
@@ -0,0 +1,118 @@
+"""Conditional GET and per-route Cache-Control.
+
+Pages built from versioned data (a user's `version`, a message's like
+count, ...) call `validate` with those values before doing any other work.
+It derives an ETag from them, from the URL, from who is viewing (the
+navbar shows them) and from the templates. If the client already has that
+page, `validate` returns a 304 response and the route returns it without
+loading or rendering anything else.
+
+Last-Modified is sent too, but it only reflects the page's data, not who
+is viewing it, so If-Modified-Since on its own is only trusted for
+anonymous viewers.
+
+Every response gets a Cache-Control policy for its class of route:
+validated pages must be revalidated, static files may be cached for a
+while, fingerprinted assets forever, and everything else (errors
+included) isn't stored.
+"""
+
+import hashlib
+import os
+from datetime import timezone
+
+from flask import current_app, g, request, session
+
+REVALIDATE = 'private, no-cache'
+STATIC = 'public, max-age=3600'
+IMMUTABLE = 'public, max-age=31536000, immutable'
+NO_STORE = 'no-store'
+
+# Cache-Control by endpoint, for 200 and 304 responses without validators
+POLICIES = {
+    'static': STATIC,
+    # fingerprinted: a changed file gets a new name (see assets.py)
+    'assets': IMMUTABLE,
+}
+
+
+def template_version(app):
+    """A token that changes whenever a template file changes."""
+
+    latest = 0
+    for directory, _, filenames in os.walk(os.path.join(app.root_path, app.template_folder)):
+        for filename in filenames:
+            latest = max(latest, os.path.getmtime(os.path.join(directory, filename)))
+    return str(int(latest))
+
+
+def viewer():
+    """What the page shows of the logged-in user (the navbar)."""
+
+    if not g.get('user'):
+        return None
+    return (g.user.id, g.user.username, g.user.image_url, g.user.unread_count)
+
+
+def validate(*version, last_modified=None):
+    """Set validators for this page from `version`; get a 304 response if
+    the client's copy is current, else None.
+
+    `last_modified` is a naive UTC datetime of the latest change, if known.
+    """
+
+    if '_flashes' in session:
+        # the page has to show (and consume) the flashed messages
+        return None
+
+    key = (current_app.config['TEMPLATE_VERSION'], request.full_path, viewer(), version)
+    etag = hashlib.sha1(repr(key).encode()).hexdigest()
+
+    if last_modified is not None:
+        last_modified = last_modified.replace(tzinfo=timezone.utc, microsecond=0)
+    g.validators = (etag, last_modified)
+
+    if request.if_none_match:
+        fresh = request.if_none_match.contains(etag)
+    else:
+        fresh = (last_modified is not None
+                 and viewer() is None
+                 and request.if_modified_since is not None
+                 and last_modified <= request.if_modified_since)
+
+    if fresh:
+        return current_app.response_class(status=304)
+    return None
+
+
+def set_cache_headers(response):
+    """After-request hook: validators and Cache-Control for the response."""
+
+    validators = g.pop('validators', None)
+
+    if validators is not None and response.status_code in (200, 304):
+        etag, last_modified = validators
+        response.set_etag(etag)
+        if last_modified is not None:
+            response.last_modified = last_modified
+        response.headers['Cache-Control'] = REVALIDATE
+        response.vary.add('Cookie')
+    elif response.status_code in (200, 304):
+        response.headers['Cache-Control'] = POLICIES.get(request.endpoint, NO_STORE)
+    else:
+        # e.g. a missing asset's 404 mustn't be cached for a year
+        response.headers['Cache-Control'] = NO_STORE
+
+    return response
+
+
+def init_app(app):
+    """Send validators and Cache-Control headers from `app`."""
+
+    app.config.setdefault('TEMPLATE_VERSION', template_version(app))
+
+    @app.before_request
+    def reset_validators():
+        g.pop('validators', None)
+
+    app.after_request(set_cache_headers)
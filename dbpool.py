@@ -0,0 +1,150 @@
+"""Connection pools: telemetry and per-route statement timeouts.
+
+Engines are created with `InstrumentedQueuePool` (see
+SQLALCHEMY_ENGINE_OPTIONS in app.py), which records for each pool:
+
+- how long each checkout took, including waiting for a free connection
+  and the pre-ping;
+- how many overflow connections it opened beyond pool_size;
+- how many checkouts timed out after pool_timeout.
+
+It also reports how many connections are checked out and overflowing
+right now. The pool label is the engine's pool_logging_name ('primary',
+'replica').
+
+Every transaction a request begins first sets a Postgres
+statement_timeout. The timeout comes from STATEMENT_TIMEOUTS for the
+request's endpoint, or from STATEMENT_TIMEOUT, in milliseconds. A slow
+search is then cancelled instead of holding its connection while the
+timeline waits for one. Cancelled statements and pool timeouts answer 503
+with Retry-After.
+"""
+
+import threading
+import weakref
+from time import perf_counter
+
+from flask import current_app, has_request_context, render_template, request
+from psycopg2.errors import QueryCanceled
+from sqlalchemy import event, exc
+from sqlalchemy.orm import Session
+from sqlalchemy.pool import QueuePool
+
+import metrics
+
+_pools = weakref.WeakSet()
+_pools_lock = threading.Lock()
+
+
+def pool_stats(stat):
+    """Sum `stat(pool)` over the live pools, by label."""
+
+    totals = {}
+    with _pools_lock:
+        pools = list(_pools)
+    for pool in pools:
+        totals[pool.label] = totals.get(pool.label, 0) + stat(pool)
+    return totals
+
+
+CHECKOUT_DURATION = metrics.Histogram('warbler_db_pool_checkout_seconds',
+                                      "Time to check a connection out of the pool, waiting included.",
+                                      metrics.TIME_BUCKETS, label='pool')
+OVERFLOWS = metrics.Counter('warbler_db_pool_overflow_total',
+                            "Connections opened beyond pool_size.", label='pool')
+TIMEOUTS = metrics.Counter('warbler_db_pool_timeouts_total',
+                           "Checkouts that gave up after pool_timeout.", label='pool')
+CHECKED_OUT = metrics.Gauge('warbler_db_pool_checked_out', "Connections checked out now.",
+                            lambda: pool_stats(QueuePool.checkedout), label='pool')
+OVERFLOWING = metrics.Gauge('warbler_db_pool_overflowing', "Overflow connections open now.",
+                            lambda: pool_stats(lambda pool: max(pool.overflow(), 0)), label='pool')
+STATEMENT_TIMEOUTS = metrics.Counter('warbler_statement_timeouts_total',
+                                     "Requests whose SQL was cancelled by statement_timeout.")
+
+
+class InstrumentedQueuePool(QueuePool):
+    """A QueuePool that records checkout time, overflow and timeouts."""
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.label = kwargs.get('logging_name') or 'default'
+        event.listen(self, 'connect', self._opened)
+        with _pools_lock:
+            _pools.add(self)
+
+    def recreate(self):
+        # the new pool copies this one's listeners; it adds its own
+        event.remove(self, 'connect', self._opened)
+        return super().recreate()
+
+    def connect(self):
+        start = perf_counter()
+        try:
+            return super().connect()
+        except exc.TimeoutError:
+            TIMEOUTS.inc(self.label)
+            raise
+        finally:
+            CHECKOUT_DURATION.observe(self.label, perf_counter() - start)
+
+    def _opened(self, dbapi_connection, connection_record):
+        """Pool hook: count a new connection that takes the pool past pool_size.
+
+        The overflow is raised before the connection is made. A pooled
+        connection replaced after recycling or invalidation connects again
+        under the same record, so only a record's first connection counts.
+        """
+
+        if connection_record.record_info.setdefault('opened', False):
+            return
+        connection_record.record_info['opened'] = True
+        if self.overflow() > 0:
+            OVERFLOWS.inc(self.label)
+
+
+def set_statement_timeout(session, transaction, connection):
+    """Session hook: limit the statements of a request's transaction."""
+
+    if not has_request_context():
+        return
+
+    config = current_app.config
+    timeout = config['STATEMENT_TIMEOUTS'].get(request.endpoint, config['STATEMENT_TIMEOUT'])
+    if not timeout:
+        return
+
+    # on the DBAPI connection, so it isn't counted as one of the request's
+    # statements; is_local: it ends with the transaction
+    cursor = connection.connection.cursor()
+    try:
+        cursor.execute("SELECT set_config('statement_timeout', %s, true)", (str(timeout),))
+    finally:
+        cursor.close()
+
+
+def init_app(app):
+    """Apply statement timeouts to `app`'s requests, and answer 503 when the
+    database is too busy."""
+
+    app.config.setdefault('STATEMENT_TIMEOUT', None)
+    app.config.setdefault('STATEMENT_TIMEOUTS', {})
+
+    if not event.contains(Session, 'after_begin', set_statement_timeout):
+        event.listen(Session, 'after_begin', set_statement_timeout)
+
+    db_session = app.extensions['sqlalchemy'].session
+
+    def busy():
+        db_session.rollback()
+        return render_template('503.html'), 503, {'Retry-After': '1'}
+
+    @app.errorhandler(exc.OperationalError)
+    def statement_timeout(e):
+        if not isinstance(e.orig, QueryCanceled):
+            raise e
+        STATEMENT_TIMEOUTS.inc(request.endpoint or 'none')
+        return busy()
+
+    @app.errorhandler(exc.TimeoutError)
+    def pool_timeout(e):
+        return busy()
@@ -0,0 +1,98 @@
+"""Cached HTML fragments for message list items and user cards.
+
+The same message `<li>` or user card is rendered on many pages for many
+viewers. Templates call the `fragment` Jinja global instead of inlining
+that markup:
+
+    {{ fragment('fragments/user_card.html', (user.id, user.version), user=user,
+                slot=follow_button(user, following_ids)) }}
+
+The fragment template is rendered once per key and its HTML kept in a
+bounded LRU cache. Keys carry the entity id plus whatever versions what it
+shows (`users.version`, a message's like count where the fragment prints
+it), so an entry is never stale, just unused. Viewer-specific markup (like and follow buttons) is
+rendered per request and passed as `slot`; it replaces the `{{ slot }}`
+marker in the cached HTML.
+"""
+
+import threading
+from collections import OrderedDict
+
+from flask import current_app
+from markupsafe import Markup, escape
+
+SLOT = Markup('<!--slot-->')
+
+
+class FragmentCache:
+    """A thread-safe LRU of rendered HTML, holding at most `maxsize` entries."""
+
+    def __init__(self, maxsize=20000):
+        self.maxsize = maxsize
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key):
+        """Get the HTML cached under `key`, or None."""
+
+        with self._lock:
+            html = self._entries.get(key)
+            if html is None:
+                self.misses += 1
+                return None
+            self.hits += 1
+            self._entries.move_to_end(key)
+            return html
+
+    def put(self, key, html):
+        """Cache `html` under `key`, evicting the least recently used entries if full."""
+
+        if not self.maxsize:
+            return
+
+        with self._lock:
+            self._entries[key] = html
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.maxsize:
+                self._entries.popitem(last=False)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self.hits = self.misses = 0
+
+
+cache = FragmentCache()
+
+
+def fragment(name, key, slot='', **context):
+    """Render template `name` with `context`, or reuse the HTML cached under `key`.
+
+    `slot` (per-viewer markup) fills the template's `{{ slot }}` marker.
+    """
+
+    cache_key = (name, *key)
+    html = cache.get(cache_key)
+
+    if html is None:
+        html = current_app.jinja_env.get_template(name).render(context, slot=SLOT)
+        cache.put(cache_key, html)
+
+    return Markup(html.replace(SLOT, escape(slot)))
+
+
+def clear():
+    """Empty the cache (used by tests)."""
+
+    cache.clear()
+
+
+def init_app(app):
+    """Make `fragment` available to templates; size the cache from FRAGMENT_CACHE_SIZE."""
+
+    app.config.setdefault('FRAGMENT_CACHE_SIZE', 20000)
+    cache.maxsize = app.config['FRAGMENT_CACHE_SIZE']
+
+    app.jinja_env.globals['fragment'] = fragment
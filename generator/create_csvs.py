@@ -3,75 +3,218 @@
 Students won't need to run this for the exercise; they will just use the CSV
 files that this generates. You should only need to run this if you wanted to
 tweak the CSV formats or generate fewer/more rows.
+
+Run it from the repository root, e.g. for a large staging dataset:
+
+    python generator/create_csvs.py --users 1000000 --messages 10000000
+
+and load the result with `flask --app app load-seed` (or `python seed.py`
+for small datasets).
+
+Everything is generated offline and depends only on --seed and
+--chunk-size: users are split into chunks, every chunk draws from its own
+seeded RNGs, and worker processes write chunks to part files that are
+then concatenated in order. Memory use depends on the chunk size, not on
+the number of rows.
+
+Who follows whom, whose messages get liked and who gets DMs follow a power
+law: a few users and messages are very popular, most are not. How many
+accounts a user follows, messages, likes or DMs is Pareto-distributed too.
 """
 
+import argparse
 import csv
-from random import choice, randint, sample
-from itertools import permutations
-import requests
-from faker import Faker
-from helpers import get_random_datetime
+import os
+import shutil
+import tempfile
+from multiprocessing import Pool
+from random import Random
+
+from helpers import (END_DATE, HEADER_IMAGE_URL, IMAGE_URLS, WORDS, SkewedIds,
+                     paragraph, place, power_law_count, random_datetime, sentence)
 
 MAX_WARBLER_LENGTH = 140
+MAX_DIRECT_MESSAGE_LENGTH = 300
+
+# Every seeded user shares this bcrypt hash.
+PASSWORD_HASH = '$2b$12$Q1PUFjhN/AWRQ21LbGYvjeLpZZB6lfZ1BPwifHALGO6oIbyC3CmJe'
+
+# One CSV per table, named so `flask --app app load-seed` finds them
+CSV_HEADERS = {
+    'users': ['id', 'email', 'username', 'image_url', 'password', 'bio', 'header_image_url', 'location'],
+    'messages': ['id', 'text', 'timestamp', 'user_id'],
+    'follows': ['user_being_followed_id', 'user_following_id'],
+    'likes': ['user_id', 'message_id'],
+    'direct_msg': ['sender_id', 'receiver_id', 'message_text', 'timestamp'],
+}
+
+# Cap on what a single user follows / likes, however the power law draws
+MAX_FOLLOWING = 5000
+MAX_LIKES = 5000
+MAX_MESSAGES = 20000
+MAX_DIRECT_MESSAGES = 1000
+
+
+def chunk_user_ids(options, chunk):
+    """The user ids in chunk number `chunk`."""
+
+    first = chunk * options.chunk_size + 1
+    return range(first, min(first + options.chunk_size, options.users + 1))
+
+
+def rng_for(options, purpose, chunk):
+    """The RNG for one kind of data in one chunk; str seeds are stable across runs."""
+
+    return Random(f"{options.seed}:{purpose}:{chunk}")
+
+
+def message_counts(options, chunk):
+    """How many messages each user of `chunk` posts."""
+
+    rng = rng_for(options, 'message-counts', chunk)
+    mean = options.messages / options.users
+    return [power_law_count(rng, mean, MAX_MESSAGES) for _ in chunk_user_ids(options, chunk)]
+
+
+def count_chunk_messages(job):
+    options, chunk = job
+    return sum(message_counts(options, chunk))
+
+
+def distinct_draws(rng, sampler, count, exclude=None):
+    """Up to `count` different ids from `sampler`, never `exclude`.
+
+    Popular ids come up again and again, so give up after a bounded number
+    of tries rather than loop forever on tiny datasets.
+    """
+
+    drawn = set()
+    for _ in range(4 * count + 10):
+        if len(drawn) >= count:
+            break
+        drawn.add(sampler.draw(rng))
+    drawn.discard(exclude)
+    return drawn
 
-USERS_CSV_HEADERS = ['email', 'username', 'image_url', 'password', 'bio', 'header_image_url', 'location']
-MESSAGES_CSV_HEADERS = ['text', 'timestamp', 'user_id']
-FOLLOWS_CSV_HEADERS = ['user_being_followed_id', 'user_following_id']
 
-NUM_USERS = 300
-NUM_MESSAGES = 1000
-NUM_FOLLWERS = 5000
+def write_chunk(job):
+    """Write every table's rows for one chunk of users to part files.
 
-fake = Faker()
+    Returns the number of rows written per table.
+    """
 
-# Generate random profile image URLs to use for users
+    options, chunk, first_message_id, total_messages, part_dir = job
 
-image_urls = [
-    f"https://randomuser.me/api/portraits/{kind}/{i}.jpg"
-    for kind, count in [("lego", 10), ("men", 100), ("women", 100)]
-    for i in range(count)
-]
+    user_ids = chunk_user_ids(options, chunk)
+    popular_users = SkewedIds(options.users, salt=1)
+    popular_messages = SkewedIds(max(total_messages, 1), salt=2)
+    counts = dict.fromkeys(CSV_HEADERS, 0)
+
+    files = {table: open(os.path.join(part_dir, f"{table}.{chunk:06d}.csv"), 'w', newline='')
+             for table in CSV_HEADERS}
+    try:
+        writers = {table: csv.writer(part) for table, part in files.items()}
 
-# Generate random header image URLs to use for users
+        def write(table, row):
+            writers[table].writerow(row)
+            counts[table] += 1
 
-header_image_urls = [
-    requests.get(f"http://www.splashbase.co/api/v1/images/{i}").json()['url']
-    for i in range(1, 46)
-]
+        rng = rng_for(options, 'users', chunk)
+        for user_id in user_ids:
+            username = f"{rng.choice(WORDS)}{rng.choice(WORDS)}{user_id}"
+            write('users', [user_id, f"{username}@example.com", username, rng.choice(IMAGE_URLS),
+                            PASSWORD_HASH, sentence(rng), HEADER_IMAGE_URL, place(rng)])
 
-with open('generator/users.csv', 'w') as users_csv:
-    users_writer = csv.DictWriter(users_csv, fieldnames=USERS_CSV_HEADERS)
-    users_writer.writeheader()
+        rng = rng_for(options, 'messages', chunk)
+        message_id = first_message_id
+        for user_id, count in zip(user_ids, message_counts(options, chunk)):
+            for _ in range(count):
+                write('messages', [message_id, paragraph(rng, MAX_WARBLER_LENGTH),
+                                   random_datetime(rng, END_DATE), user_id])
+                message_id += 1
 
-    for i in range(NUM_USERS):
-        users_writer.writerow(dict(
-            email=fake.email(),
-            username=fake.user_name(),
-            image_url=choice(image_urls),
-            password='$2b$12$Q1PUFjhN/AWRQ21LbGYvjeLpZZB6lfZ1BPwifHALGO6oIbyC3CmJe',
-            bio=fake.sentence(),
-            header_image_url=choice(header_image_urls),
-            location=fake.city()
-        ))
+        rng = rng_for(options, 'follows', chunk)
+        mean = options.follows / options.users
+        for user_id in user_ids:
+            count = power_law_count(rng, mean, min(MAX_FOLLOWING, options.users - 1))
+            for followed_id in sorted(distinct_draws(rng, popular_users, count, exclude=user_id)):
+                write('follows', [followed_id, user_id])
 
-with open('generator/messages.csv', 'w') as messages_csv:
-    messages_writer = csv.DictWriter(messages_csv, fieldnames=MESSAGES_CSV_HEADERS)
-    messages_writer.writeheader()
+        rng = rng_for(options, 'likes', chunk)
+        mean = options.likes / options.users if total_messages else 0
+        for user_id in user_ids:
+            count = power_law_count(rng, mean, min(MAX_LIKES, total_messages))
+            for message_id in sorted(distinct_draws(rng, popular_messages, count)):
+                write('likes', [user_id, message_id])
 
-    for i in range(NUM_MESSAGES):
-        messages_writer.writerow(dict(
-            text=fake.paragraph()[:MAX_WARBLER_LENGTH],
-            timestamp=get_random_datetime(),
-            user_id=randint(1, NUM_USERS)
-        ))
+        rng = rng_for(options, 'direct-messages', chunk)
+        mean = options.dms / options.users if options.users > 1 else 0
+        for user_id in user_ids:
+            for _ in range(power_law_count(rng, mean, MAX_DIRECT_MESSAGES)):
+                receiver_id = popular_users.draw(rng)
+                if receiver_id != user_id:
+                    write('direct_msg', [user_id, receiver_id, paragraph(rng, MAX_DIRECT_MESSAGE_LENGTH),
+                                         random_datetime(rng, END_DATE)])
+    finally:
+        for part in files.values():
+            part.close()
 
-# Generate follows.csv from random pairings of users
+    return counts
 
-with open('generator/follows.csv', 'w') as follows_csv:
-    all_pairs = list(permutations(range(1, NUM_USERS + 1), 2))
 
-    users_writer = csv.DictWriter(follows_csv, fieldnames=FOLLOWS_CSV_HEADERS)
-    users_writer.writeheader()
+def concatenate(out_dir, part_dir, chunks):
+    """Join the part files of each table, in chunk order, under a header row."""
 
-    for followed_user, follower in sample(all_pairs, NUM_FOLLWERS):
-        users_writer.writerow(dict(user_being_followed_id=followed_user, user_following_id=follower))
+    for table, headers in CSV_HEADERS.items():
+        with open(os.path.join(out_dir, f"{table}.csv"), 'w', newline='') as out:
+            csv.writer(out).writerow(headers)
+            for chunk in range(chunks):
+                with open(os.path.join(part_dir, f"{table}.{chunk:06d}.csv"), newline='') as part:
+                    shutil.copyfileobj(part, out)
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+    parser.add_argument('--users', type=int, default=300)
+    parser.add_argument('--messages', type=int, default=1000, help="about how many messages")
+    parser.add_argument('--follows', type=int, default=5000, help="about how many follows")
+    parser.add_argument('--likes', type=int, default=1500, help="about how many likes")
+    parser.add_argument('--dms', type=int, default=300, help="about how many direct messages")
+    parser.add_argument('--seed', type=int, default=1)
+    parser.add_argument('--chunk-size', type=int, default=10000, help="users per chunk")
+    parser.add_argument('--workers', type=int, default=os.cpu_count())
+    parser.add_argument('--out', default=os.path.dirname(os.path.abspath(__file__)))
+    return parser.parse_args()
+
+
+def main():
+    options = parse_args()
+    if options.users < 1:
+        raise SystemExit("--users must be at least 1")
+
+    chunks = (options.users + options.chunk_size - 1) // options.chunk_size
+
+    with Pool(options.workers) as pool:
+        # message ids run on from one chunk to the next, so count them first
+        chunk_messages = pool.map(count_chunk_messages, [(options, chunk) for chunk in range(chunks)])
+        total_messages = sum(chunk_messages)
+
+        first_ids = [1]
+        for count in chunk_messages[:-1]:
+            first_ids.append(first_ids[-1] + count)
+
+        totals = dict.fromkeys(CSV_HEADERS, 0)
+        with tempfile.TemporaryDirectory(dir=options.out) as part_dir:
+            jobs = [(options, chunk, first_ids[chunk], total_messages, part_dir) for chunk in range(chunks)]
+            for counts in pool.imap_unordered(write_chunk, jobs):
+                for table, count in counts.items():
+                    totals[table] += count
+
+            concatenate(options.out, part_dir, chunks)
+
+    for table, count in totals.items():
+        print(f"{table}.csv: {count} rows")
+
+
+if __name__ == '__main__':
+    main()
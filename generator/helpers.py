@@ -1,14 +1,140 @@
 """Support functions for CSV generation."""
 
-from datetime import datetime
-from random import uniform
+from datetime import datetime, timedelta
+from math import gcd
 
+WORDS = """
+    able about above across act add afraid after again against age ago agree air all
+    allow almost alone along already also always amount angle animal answer any appear
+    apple area arm around arrive art ask atom baby back bad ball band bank base basic
+    bear beat beauty bed before begin behind bell best better between big bird bit
+    black block blood blow blue board boat body bone book born both bottom box boy
+    branch bread break bright bring broad brother brown build burn busy buy call camp
+    capital captain car card care carry case cat catch cause cell center century chair
+    chance change character charge chart check chick chief child choose chord circle
+    city claim class clean clear climb clock close cloth cloud coast coat cold collect
+    colony color column come common company compare complete condition connect consider
+    contain continent control cook cool copy corn corner cost cotton country course
+    cover cow crease create crop cross crowd cry current cut dance danger dark day dead
+    deal dear death decide deep degree depend describe desert design detail develop
+    dictionary differ direct discuss distant divide doctor dog dollar door double down
+    draw dream dress drink drive drop dry duck during early earth east easy eat edge
+    effect egg eight either electric element else end enemy energy engine enough enter
+    equal even evening event ever every exact example except excite exercise expect
+    experience experiment eye face fact fair fall family famous far farm fast fat
+    father favor fear feed feel field fight figure fill final find fine finger finish
+    fire first fish fit five flat floor flow flower fly follow food foot force forest
+    form forward found fraction free fresh friend front fruit full fun game garden gas
+    gather gentle get girl give glad glass gold good govern grand grass gray great green
+    ground group grow guess guide gun hair half hand happen happy hard hat heard heart
+    heat heavy help high hill history hold hole home hope horse hot hour house huge
+    human hunt hurry ice idea inch industry insect instrument interest invent iron
+    island job join joy jump keep key kind king kitchen knew lady lake land language
+    large last laugh law lay lead learn leave left leg letter level lie life lift light
+    line liquid list listen little live locate long look lost loud love low machine
+    magnet main major make man many map mark market mass master match material matter
+    meal mean measure meat meet melody memory metal method middle might mile milk mind
+    minute miss modern moment money month moon morning mother motion mount mountain
+    mouth move music name nation natural nature near need neighbor never new night
+    noise north nose note notice noun number object ocean offer office often oil old
+    open opposite orange order organ original oxygen page paint pair paper parent park
+    part party pass past path pattern pay people perhaps period person phrase pick
+    picture piece place plain plan planet plant play please poem point poor populate
+    port position possible post pound power practice prepare present press pretty
+    print probable problem process produce product protect proud prove provide pull
+    push quick quiet quite race radio rain raise reach read ready real reason receive
+    record red region remember repeat reply rest result rich ride right ring rise river
+    road rock roll room root rope rose round row rule run safe sail salt sand save say
+    scale school science score sea search season seat second section see seed select
+    sell send sense sentence serve settle shape share sharp sheet shell shine ship
+    shoe shop shore short shoulder shout show side sight sign silent silver simple
+    sing single sister sit size skill skin sky sleep slow small smell smile snow soft
+    soil soldier solution song sound south space speak special speech speed spell
+    spend spoke spot spread spring square stand star start state station stay stead
+    steam steel step stick still stone stop store story straight strange stream street
+    stretch string strong student study subject success sudden suffix sugar suit
+    summer sun supply support sure surface surprise swim symbol system table tail take
+    talk tall teach team teeth tell temperature test thank thick thin thing think
+    third thought thousand three through throw thus tie time tiny tire together tone
+    tool top total touch toward town track trade train travel tree triangle trip
+    trouble truck true try tube turn type uncle under unit until use usual valley
+    value vary verb very view village visit voice vowel wait walk wall want war warm
+    wash watch water wave wear weather week weight west wheel while white whole wide
+    wife wild win wind window wing winter wire wish woman wonder wood word work world
+    write wrong yard year yellow young
+""".split()
 
-def get_random_datetime(year_gap=2):
-    """Get a random datetime within the last few years."""
+PLACE_SUFFIXES = ['ton', 'ville', 'burgh', 'field', 'port', 'mouth', 'ford', ' City', ' Springs', ' Falls']
 
-    now = datetime.now()
-    then = now.replace(year=now.year - year_gap)
-    random_timestamp = uniform(then.timestamp(), now.timestamp())
+IMAGE_URLS = [
+    f"https://randomuser.me/api/portraits/{kind}/{i}.jpg"
+    for kind, count in [("lego", 10), ("men", 100), ("women", 100)]
+    for i in range(count)
+]
+
+# Timestamps fall before a fixed date, so output only depends on the seed.
+END_DATE = datetime(2023, 9, 1)
+
+# Shipped with the app, so seeded profiles render without network access.
+HEADER_IMAGE_URL = "/static/images/warbler-hero.jpg"
+
+
+class SkewedIds:
+    """Draw ids 1..`n` with a power-law (Zipf-like) preference for a few of them.
+
+    `u ** exponent` concentrates uniform draws near 0, so the rank r of a
+    draw has density ~ r^(1/exponent - 1). Ranks are then scattered over
+    the ids with a multiplicative permutation, so popular ids aren't simply
+    the lowest ones. Uses O(1) memory however large `n` is.
+    """
+
+    def __init__(self, n, exponent=2.0, salt=0):
+        self.n = n
+        self.exponent = exponent
+        self.stride = coprime_stride(n, salt)
+
+    def draw(self, rng):
+        rank = min(int(self.n * rng.random() ** self.exponent), self.n - 1)
+        return rank * self.stride % self.n + 1
+
+
+def coprime_stride(n, salt):
+    """A large multiplier coprime to `n`, so `rank * stride % n` permutes 0..n-1."""
+
+    stride = (2654435761 + 2 * salt) % max(n, 1) or 1
+    while gcd(stride, n) != 1:
+        stride += 1
+    return stride
+
+
+def power_law_count(rng, mean, cap, alpha=2.0):
+    """A Pareto-distributed count with roughly the given `mean`, at most `cap`."""
+
+    if mean <= 0:
+        return 0
+    # paretovariate(alpha) is >= 1 with mean alpha / (alpha - 1); round
+    # at random so small means aren't truncated to 0
+    scale = mean * (alpha - 1) / alpha
+    return min(int(scale * rng.paretovariate(alpha) + rng.random()), cap)
+
+
+def random_datetime(rng, end, days=730):
+    """A datetime within the `days` days before `end`."""
+
+    return end - timedelta(seconds=rng.uniform(0, days * 86400))
+
+
+def sentence(rng, min_words=4, max_words=12):
+    words = rng.choices(WORDS, k=rng.randint(min_words, max_words))
+    return ' '.join(words).capitalize() + '.'
+
+
+def paragraph(rng, max_length):
+    """A few sentences, cut to `max_length` characters."""
+
+    return ' '.join(sentence(rng) for _ in range(rng.randint(1, 3)))[:max_length]
+
+
+def place(rng):
+    return rng.choice(WORDS).capitalize() + rng.choice(PLACE_SUFFIXES)
 
-    return datetime.fromtimestamp(random_timestamp)
@@ -0,0 +1,160 @@
+"""Cached snapshots of the logged-in user.
+
+Every request needs to know who is logged in, but most only render the
+navbar (id, username, image_url, unread direct messages). Instead of loading the full User row
+before each request, `load` returns a `CurrentUser` built from a small
+snapshot held in a bounded, TTL-based in-process cache. The ORM User is
+only loaded the first time a route touches anything else.
+
+Routes that change what the snapshot holds (or remove the user) call
+`forget`. Other worker processes keep their copy until it expires, so
+IDENTITY_CACHE_TTL bounds how stale a username or avatar can be there.
+
+Unread counts mostly change in the job worker, a process of its own. The
+model methods that change them call `User.identity_changed`, which
+pg_notifies every process; their pubsub listener calls `forget`.
+"""
+
+import threading
+from collections import OrderedDict, namedtuple
+from time import monotonic
+
+from flask import abort, redirect, url_for
+
+from models import db, User
+
+Identity = namedtuple('Identity', ['id', 'username', 'image_url', 'unread_count'], defaults=[0])
+
+
+class IdentityCache:
+    """A thread-safe LRU of `Identity` snapshots whose entries expire after `ttl` seconds."""
+
+    def __init__(self, maxsize=10000, ttl=60):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, user_id):
+        """Get the cached snapshot for `user_id`, or None."""
+
+        with self._lock:
+            entry = self._entries.get(user_id)
+            if entry is None:
+                return None
+
+            expires, identity = entry
+            if expires < monotonic():
+                del self._entries[user_id]
+                return None
+
+            self._entries.move_to_end(user_id)
+            return identity
+
+    def put(self, identity):
+        """Cache `identity`, evicting the least recently used entries if full."""
+
+        if not self.ttl or not self.maxsize:
+            return
+
+        with self._lock:
+            self._entries[identity.id] = (monotonic() + self.ttl, identity)
+            self._entries.move_to_end(identity.id)
+            while len(self._entries) > self.maxsize:
+                self._entries.popitem(last=False)
+
+    def forget(self, user_id):
+        """Drop the snapshot for `user_id`, if cached."""
+
+        with self._lock:
+            self._entries.pop(user_id, None)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+
+cache = IdentityCache()
+
+
+class CurrentUser:
+    """The logged-in user: snapshot fields up front, the ORM `User` on demand.
+
+    Reading any other attribute (or calling a method) loads the full User
+    once per request and delegates to it; so does setting an attribute.
+    Pass `.orm` where SQLAlchemy needs the real object (e.g. session.delete).
+
+    The follow and like lookups only need the id, so they run without it.
+    """
+
+    following_ids = User.following_ids
+    liked_ids = User.liked_ids
+    is_following = User.is_following
+
+    def __init__(self, identity):
+        object.__setattr__(self, '_identity', identity)
+        object.__setattr__(self, '_user', None)
+
+    @property
+    def orm(self):
+        """The full `User`, loaded on first use."""
+
+        if self._user is None:
+            user = User.query.get(self._identity.id)
+            if user is None:
+                # deleted since it was cached (e.g. by another worker)
+                cache.forget(self._identity.id)
+                abort(redirect(url_for('logout')))
+            object.__setattr__(self, '_user', user)
+        return self._user
+
+    def __getattr__(self, name):
+        if self._user is None and name in Identity._fields:
+            return getattr(self._identity, name)
+        return getattr(self.orm, name)
+
+    def __setattr__(self, name, value):
+        setattr(self.orm, name, value)
+
+    def __repr__(self):
+        return f"<CurrentUser #{self._identity.id}: {self._identity.username}>"
+
+
+def load(user_id):
+    """Get a `CurrentUser` for `user_id`, or None if there's no such user."""
+
+    identity = cache.get(user_id)
+
+    if identity is None:
+        row = (db.session
+               .query(User.id, User.username, User.image_url, User.unread_count)
+               .filter(User.id == user_id)
+               .first())
+        if row is None:
+            return None
+        identity = Identity(*row)
+        cache.put(identity)
+
+    return CurrentUser(identity)
+
+
+def forget(user_id):
+    """Invalidate the cached snapshot of `user_id` in this process."""
+
+    cache.forget(user_id)
+
+
+def clear():
+    """Empty the cache (used by tests)."""
+
+    cache.clear()
+
+
+def init_app(app):
+    """Size the identity cache from IDENTITY_CACHE_SIZE / IDENTITY_CACHE_TTL."""
+
+    app.config.setdefault('IDENTITY_CACHE_SIZE', 10000)
+    app.config.setdefault('IDENTITY_CACHE_TTL', 60)
+
+    cache.maxsize = app.config['IDENTITY_CACHE_SIZE']
+    cache.ttl = app.config['IDENTITY_CACHE_TTL']
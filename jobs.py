@@ -0,0 +1,278 @@
+"""Background jobs, queued in Postgres.
+
+Routes defer side effects that needn't finish before the response
+(timeline fan-out, follow backfills, conversation updates, purging deleted
+accounts) with
+
+    jobs.enqueue('fan_out', message_id=msg.id)
+
+The job row is inserted in the request's transaction, so it exists only
+if the request commits. `flask --app app run-worker` runs the queue.
+
+- Each worker thread claims the oldest due job with
+  SELECT ... FOR UPDATE SKIP LOCKED, so concurrent workers never pick
+  the same job and never wait on each other.
+- The thread runs the job's handler and deletes the row in that same
+  transaction, so a job's effects commit together with its removal.
+- A job that raises is retried with exponential backoff until it has
+  failed `max_attempts` times. After that it is kept with status
+  'failed' and its last error, for inspection.
+
+With JOBS_INLINE set (tests, development without a worker), `enqueue`
+runs the handler right away in the current transaction instead.
+
+Handlers are registered with `@handler(kind)` and take the payload as
+keyword arguments. They may run after the data they refer to has changed
+or gone, so they check.
+"""
+
+import random
+import threading
+import traceback
+from datetime import datetime, timedelta
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from time import perf_counter
+
+from flask import current_app
+
+import metrics
+from models import db, AccountDeletion, Conversation, DirectMessage, Job, Message, TimelineEntry
+
+JOB_DURATION = metrics.Histogram('warbler_job_duration_seconds',
+                                 "Time spent running a job, successful or not.", metrics.TIME_BUCKETS, label='kind')
+JOBS_SUCCEEDED = metrics.Counter('warbler_jobs_succeeded_total', "Jobs run successfully.", label='kind')
+JOBS_FAILED = metrics.Counter('warbler_jobs_failed_total', "Job attempts that raised (and will be retried).",
+                              label='kind')
+JOBS_DEAD = metrics.Counter('warbler_jobs_dead_total', "Jobs given up on after max_attempts.", label='kind')
+PURGED_ROWS = metrics.Counter('warbler_account_purge_rows_total', "Rows deleted purging deleted accounts.",
+                              label='step')
+
+HANDLERS = {}
+
+
+def handler(kind):
+    """Register the decorated function as the handler for jobs of `kind`."""
+
+    def register(function):
+        HANDLERS[kind] = function
+        return function
+    return register
+
+
+def enqueue(kind, **payload):
+    """Queue a `kind` job with `payload` in the current transaction (or run
+    it now, if JOBS_INLINE is set). Returns the `Job`, or None if run inline.
+    """
+
+    if kind not in HANDLERS:
+        raise ValueError(f"No handler for {kind!r} jobs")
+
+    if current_app.config['JOBS_INLINE']:
+        HANDLERS[kind](**payload)
+        return None
+
+    job = Job(kind=kind, payload=payload, max_attempts=current_app.config['JOBS_MAX_ATTEMPTS'])
+    db.session.add(job)
+    return job
+
+
+def backoff(attempts):
+    """Seconds to wait before retrying a job that has failed `attempts` times."""
+
+    delay = current_app.config['JOBS_BACKOFF_BASE'] * 2 ** (attempts - 1)
+    delay = min(delay, current_app.config['JOBS_BACKOFF_MAX'])
+    # jitter, so jobs that failed together don't all retry together
+    return delay * random.uniform(.5, 1)
+
+
+def claim():
+    """Lock the oldest due job, skipping jobs other workers hold; None if none."""
+
+    return (Job
+            .query
+            .filter(Job.status == 'queued', Job.run_at <= datetime.utcnow())
+            .order_by(Job.run_at, Job.id)
+            .with_for_update(skip_locked=True)
+            .first())
+
+
+def record_failure(job_id, error):
+    """Count a failed attempt of job `job_id`: schedule a retry or give up."""
+
+    job = Job.query.get(job_id)
+    job.attempts += 1
+    job.last_error = error
+
+    if job.attempts >= job.max_attempts:
+        job.status = 'failed'
+        JOBS_DEAD.inc(job.kind)
+    else:
+        job.run_at = datetime.utcnow() + timedelta(seconds=backoff(job.attempts))
+        JOBS_FAILED.inc(job.kind)
+
+    db.session.commit()
+
+
+def run_one():
+    """Run the next due job, if any. Returns whether there was one.
+
+    Call in an app context of its own (one per thread).
+    """
+
+    job = claim()
+    if job is None:
+        db.session.rollback()
+        return False
+
+    job_id, kind = job.id, job.kind
+    start = perf_counter()
+    try:
+        HANDLERS[kind](**job.payload)
+        db.session.delete(job)
+        db.session.commit()
+    except Exception:
+        db.session.rollback()
+        current_app.logger.exception("Job %s (%s) failed", job_id, kind)
+        record_failure(job_id, traceback.format_exc(limit=5))
+    else:
+        JOBS_SUCCEEDED.inc(kind)
+    finally:
+        JOB_DURATION.observe(kind, perf_counter() - start)
+
+    return True
+
+
+class Worker:
+    """Runs queued jobs on `threads` threads until stopped."""
+
+    def __init__(self, app, threads=4, poll_interval=1.0):
+        self.app = app
+        self.threads = threads
+        self.poll_interval = poll_interval
+        self.stopping = threading.Event()
+
+    def loop(self, burst):
+        while not self.stopping.is_set():
+            with self.app.app_context():
+                ran = run_one()
+            if not ran:
+                if burst:
+                    return
+                self.stopping.wait(self.poll_interval)
+
+    def run(self, burst=False):
+        """Work until `stop` is called (or, with `burst`, until the queue is empty)."""
+
+        threads = [threading.Thread(target=self.loop, args=(burst,), name=f"worker-{i}", daemon=True)
+                   for i in range(self.threads)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            # a timeout keeps the main thread responsive to signals
+            while thread.is_alive():
+                thread.join(timeout=1)
+
+    def stop(self, *args):
+        """Finish the jobs in progress, then stop."""
+
+        self.stopping.set()
+
+
+class MetricsHandler(BaseHTTPRequestHandler):
+    """Serves /metrics from a worker process, which has no Flask server."""
+
+    def do_GET(self):
+        body = metrics.expose().encode()
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/plain; version=0.0.4')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+def serve_metrics(port):
+    """Serve the metrics of this process on `port`, in a background thread."""
+
+    server = ThreadingHTTPServer(('', port), MetricsHandler)
+    threading.Thread(target=server.serve_forever, name='metrics', daemon=True).start()
+    return server
+
+
+def init_app(app):
+    """Configure retries, inline mode and purge batches for `app`."""
+
+    app.config.setdefault('JOBS_INLINE', False)
+    app.config.setdefault('JOBS_MAX_ATTEMPTS', 5)
+    app.config.setdefault('JOBS_BACKOFF_BASE', 5)
+    app.config.setdefault('JOBS_BACKOFF_MAX', 3600)
+    app.config.setdefault('ACCOUNT_PURGE_BATCH_SIZE', 1000)
+
+
+##############################################################################
+# Handlers
+
+
+@handler('fan_out')
+def fan_out(message_id):
+    """Copy a new message into its author's followers' timelines."""
+
+    message = Message.query.get(message_id)
+    if message is not None:
+        TimelineEntry.lock_author(message.user_id)
+        TimelineEntry.fan_out(message)
+
+
+@handler('add_follow')
+def add_follow(follower_id, followed_id):
+    """Backfill a new follow into the follower's timeline."""
+
+    TimelineEntry.lock(follower_id)
+    TimelineEntry.lock_author(followed_id, shared=True)
+    TimelineEntry.add_follow(follower_id, followed_id)
+
+
+@handler('remove_follow')
+def remove_follow(follower_id, followed_id):
+    """Take an ended follow out of the follower's timeline."""
+
+    TimelineEntry.lock(follower_id)
+    TimelineEntry.lock_author(followed_id, shared=True)
+    TimelineEntry.remove_follow(follower_id, followed_id)
+
+
+@handler('add_direct_message')
+def add_direct_message(message_id):
+    """Record a sent direct message in both sides' conversations."""
+
+    message = DirectMessage.query.get(message_id)
+    if message is not None:
+        Conversation.add_message(message)
+
+
+@handler('purge_account')
+def purge_account(user_id):
+    """Delete the next batch of a deleted account's rows, then queue the
+    batch after it (see `AccountDeletion`).
+
+    Run inline, it deletes every batch now, one after another, rather than
+    recursing through `enqueue` once per batch.
+    """
+
+    deletion = AccountDeletion.query.filter_by(user_id=user_id).with_for_update().first()
+    if deletion is None or deletion.finished_at is not None:
+        return
+
+    while True:
+        progress = deletion.purge(current_app.config['ACCOUNT_PURGE_BATCH_SIZE'])
+        if progress is None:
+            current_app.logger.info("Purged account %s: %s rows", user_id, deletion.rows_deleted)
+            return
+
+        step, deleted = progress
+        PURGED_ROWS.inc(step, deleted)
+        if not current_app.config['JOBS_INLINE']:
+            enqueue('purge_account', user_id=user_id)
+            return
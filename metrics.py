@@ -0,0 +1,281 @@
+"""Request instrumentation, exported in the Prometheus text format.
+
+For every request, per endpoint, we record:
+
+- the number of SQL statements run, and their total and slowest time
+- Jinja render time
+- bcrypt time
+- response size
+- overall handling time
+
+Each value goes into a fixed-bucket histogram. `init_app` wires up the
+SQLAlchemy engine events and Flask hooks and serves the aggregate at
+/metrics. Statements are counted by querycount.py; this module only times
+them. Recording costs a few perf_counter() calls and one short lock
+per observation, so it stays on in production and doesn't depend on
+flask_debugtoolbar.
+"""
+
+import threading
+from contextlib import contextmanager
+from time import perf_counter
+
+from flask import Response, before_render_template, g, has_request_context, request, template_rendered
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+
+import querycount
+
+TIME_BUCKETS = (.001, .0025, .005, .01, .025, .05, .1, .25, .5, 1, 2.5, 5, 10)
+COUNT_BUCKETS = (0, 1, 2, 3, 5, 8, 13, 21, 34, 55, 89)
+SIZE_BUCKETS = (1000, 5000, 10000, 50000, 100000, 500000, 1000000, 5000000)
+
+REGISTRY = []
+
+
+def escape_label(value):
+    """Escape a label value for the Prometheus text format."""
+
+    return str(value).replace('\\', r'\\').replace('"', r'\"').replace('\n', r'\n')
+
+
+class Histogram:
+    """A histogram with fixed buckets, one series per label value."""
+
+    def __init__(self, name, help, buckets, label='endpoint'):
+        self.name = name
+        self.help = help
+        self.buckets = buckets
+        self.label = label
+        self._series = {}
+        self._lock = threading.Lock()
+        REGISTRY.append(self)
+
+    def observe(self, label_value, value):
+        """Record one observation of `value` for `label_value`."""
+
+        with self._lock:
+            series = self._series.get(label_value)
+            if series is None:
+                # a count per bucket (plus +Inf), then the sum
+                series = self._series[label_value] = [0] * (len(self.buckets) + 1) + [0]
+
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    series[i] += 1
+                    break
+            else:
+                series[len(self.buckets)] += 1
+            series[-1] += value
+
+    def totals(self):
+        """Get `{label_value: (count, sum)}` of everything observed so far."""
+
+        with self._lock:
+            return {label_value: (sum(series[:-1]), series[-1]) for label_value, series in self._series.items()}
+
+    def expose(self):
+        """Yield the lines of this histogram in the Prometheus text format."""
+
+        yield f"# HELP {self.name} {self.help}"
+        yield f"# TYPE {self.name} histogram"
+
+        with self._lock:
+            snapshot = {key: list(series) for key, series in self._series.items()}
+
+        for label_value, series in sorted(snapshot.items()):
+            label = f'{self.label}="{escape_label(label_value)}"'
+            cumulative = 0
+            for bound, count in zip(self.buckets + ('+Inf',), series):
+                cumulative += count
+                yield f'{self.name}_bucket{{{label},le="{bound}"}} {cumulative}'
+            yield f"{self.name}_sum{{{label}}} {series[-1]}"
+            yield f"{self.name}_count{{{label}}} {cumulative}"
+
+
+class Counter:
+    """A monotonically increasing count, one series per label value."""
+
+    def __init__(self, name, help, label='endpoint'):
+        self.name = name
+        self.help = help
+        self.label = label
+        self._series = {}
+        self._lock = threading.Lock()
+        REGISTRY.append(self)
+
+    def inc(self, label_value, amount=1):
+        """Add `amount` to the series for `label_value`."""
+
+        with self._lock:
+            self._series[label_value] = self._series.get(label_value, 0) + amount
+
+    def expose(self):
+        """Yield the lines of this counter in the Prometheus text format."""
+
+        yield f"# HELP {self.name} {self.help}"
+        yield f"# TYPE {self.name} counter"
+
+        with self._lock:
+            snapshot = dict(self._series)
+
+        for label_value, value in sorted(snapshot.items()):
+            yield f'{self.name}{{{self.label}="{escape_label(label_value)}"}} {value}'
+
+
+class Gauge:
+    """A current value, one series per label value, read when scraped.
+
+    `collect` returns `{label_value: value}`.
+    """
+
+    def __init__(self, name, help, collect, label='endpoint'):
+        self.name = name
+        self.help = help
+        self.collect = collect
+        self.label = label
+        REGISTRY.append(self)
+
+    def expose(self):
+        """Yield the lines of this gauge in the Prometheus text format."""
+
+        yield f"# HELP {self.name} {self.help}"
+        yield f"# TYPE {self.name} gauge"
+
+        for label_value, value in sorted(self.collect().items()):
+            yield f'{self.name}{{{self.label}="{escape_label(label_value)}"}} {value}'
+
+
+REQUEST_DURATION = Histogram('warbler_request_duration_seconds',
+                             "Time spent handling a request.", TIME_BUCKETS)
+SQL_STATEMENTS = Histogram('warbler_request_sql_statements',
+                           "SQL statements run by a request.", COUNT_BUCKETS)
+SQL_DURATION = Histogram('warbler_request_sql_seconds',
+                         "Total SQL time of a request.", TIME_BUCKETS)
+SQL_MAX_DURATION = Histogram('warbler_request_sql_max_seconds',
+                             "Slowest single SQL statement of a request.", TIME_BUCKETS)
+RENDER_DURATION = Histogram('warbler_request_render_seconds',
+                            "Jinja template render time of a request.", TIME_BUCKETS)
+BCRYPT_DURATION = Histogram('warbler_request_bcrypt_seconds',
+                            "Password hashing/checking time of a request.", TIME_BUCKETS)
+RESPONSE_SIZE = Histogram('warbler_response_size_bytes',
+                          "Size of the response body.", SIZE_BUCKETS)
+
+
+class RequestStats:
+    """Timings collected while handling one request."""
+
+    __slots__ = ('start', 'sql_time', 'sql_max', 'render_time', 'render_starts', 'bcrypt_time')
+
+    def __init__(self):
+        self.start = perf_counter()
+        self.sql_time = 0.0
+        self.sql_max = 0.0
+        self.render_time = 0.0
+        self.render_starts = []
+        self.bcrypt_time = 0.0
+
+
+def current_stats():
+    """Get the RequestStats of the request being handled, if any."""
+
+    if has_request_context():
+        return g.get('request_stats')
+    return None
+
+
+@contextmanager
+def timed(kind):
+    """Add the time spent in the block to the current request's `kind`_time.
+
+    Used around work we want broken out, like bcrypt:
+
+        with timed('bcrypt'):
+            ...
+    """
+
+    start = perf_counter()
+    try:
+        yield
+    finally:
+        stats = current_stats()
+        if stats is not None:
+            attr = f"{kind}_time"
+            setattr(stats, attr, getattr(stats, attr) + perf_counter() - start)
+
+
+def before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    if context is not None:
+        context.metrics_start = perf_counter()
+
+
+def after_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    stats = current_stats()
+    start = getattr(context, 'metrics_start', None)
+    if stats is None or start is None:
+        return
+
+    elapsed = perf_counter() - start
+    stats.sql_time += elapsed
+    stats.sql_max = max(stats.sql_max, elapsed)
+
+
+def before_render(sender, template, context, **extra):
+    stats = current_stats()
+    if stats is not None:
+        stats.render_starts.append(perf_counter())
+
+
+def after_render(sender, template, context, **extra):
+    stats = current_stats()
+    if stats is not None and stats.render_starts:
+        start = stats.render_starts.pop()
+        # only count the outermost render, nested ones are part of it
+        if not stats.render_starts:
+            stats.render_time += perf_counter() - start
+
+
+def expose():
+    """Render every registered metric in the Prometheus text format."""
+
+    return '\n'.join(line for metric in REGISTRY for line in metric.expose()) + '\n'
+
+
+def init_app(app):
+    """Record request metrics for `app` and serve them at /metrics."""
+
+    @app.before_request
+    def start_request_stats():
+        g.request_stats = RequestStats()
+
+    @app.after_request
+    def record_request_stats(response):
+        stats = g.pop('request_stats', None)
+        if stats is None:
+            return response
+
+        endpoint = request.endpoint or 'none'
+        REQUEST_DURATION.observe(endpoint, perf_counter() - stats.start)
+        SQL_STATEMENTS.observe(endpoint, querycount.statement_count())
+        SQL_DURATION.observe(endpoint, stats.sql_time)
+        SQL_MAX_DURATION.observe(endpoint, stats.sql_max)
+        RENDER_DURATION.observe(endpoint, stats.render_time)
+        BCRYPT_DURATION.observe(endpoint, stats.bcrypt_time)
+
+        if not response.is_streamed:
+            RESPONSE_SIZE.observe(endpoint, response.calculate_content_length() or 0)
+
+        return response
+
+    @app.route('/metrics')
+    def metrics():
+        """Serve the collected metrics for Prometheus to scrape."""
+
+        return Response(expose(), mimetype='text/plain; version=0.0.4')
+
+    if not event.contains(Engine, 'before_cursor_execute', before_cursor_execute):
+        event.listen(Engine, 'before_cursor_execute', before_cursor_execute)
+        event.listen(Engine, 'after_cursor_execute', after_cursor_execute)
+
+    before_render_template.connect(before_render, app)
+    template_rendered.connect(after_render, app)
@@ -0,0 +1,18 @@
+-- Home timelines: one row per (follower, message) written when a message is
+-- posted (see models.TimelineEntry). Older databases only got this table
+-- from db.create_all(); later migrations index it.
+--
+-- Populate it afterwards with:
+--
+--     flask --app app backfill-timelines
+
+CREATE TABLE IF NOT EXISTS home_timeline (
+    user_id INTEGER NOT NULL REFERENCES users (id) ON DELETE CASCADE,
+    message_id INTEGER NOT NULL REFERENCES messages (id) ON DELETE CASCADE,
+    author_id INTEGER NOT NULL REFERENCES users (id) ON DELETE CASCADE,
+    timestamp TIMESTAMP NOT NULL,
+    PRIMARY KEY (user_id, message_id)
+);
+
+CREATE INDEX CONCURRENTLY IF NOT EXISTS ix_home_timeline_user_id_timestamp
+    ON home_timeline (user_id, timestamp, message_id);
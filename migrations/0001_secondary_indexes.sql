@@ -0,0 +1,21 @@
+-- Secondary indexes for the hot read paths.
+--
+-- messages(user_id, timestamp, id)           users_show, homepage backfill
+-- direct_msg(receiver_id, timestamp, id)     messages_show_private
+-- likes(user_id)                             messages_show_likes, User.likes
+-- follows(user_following_id, ...)            User.following
+--
+-- follows lookups by user_being_followed_id (User.followers) are served by
+-- the primary key, which leads with that column.
+
+CREATE INDEX CONCURRENTLY IF NOT EXISTS ix_messages_user_id_timestamp
+    ON messages (user_id, timestamp, id);
+
+CREATE INDEX CONCURRENTLY IF NOT EXISTS ix_direct_msg_receiver_id_timestamp
+    ON direct_msg (receiver_id, timestamp, id);
+
+CREATE INDEX CONCURRENTLY IF NOT EXISTS ix_likes_user_id
+    ON likes (user_id);
+
+CREATE INDEX CONCURRENTLY IF NOT EXISTS ix_follows_user_following_id
+    ON follows (user_following_id, user_being_followed_id);
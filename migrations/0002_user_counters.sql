@@ -0,0 +1,13 @@
+-- Denormalized counters on users, maintained by the write routes.
+--
+-- Populate them for existing rows afterwards with:
+--
+--     flask --app app reconcile-counters
+
+ALTER TABLE users ADD COLUMN IF NOT EXISTS messages_count INTEGER NOT NULL DEFAULT 0;
+
+ALTER TABLE users ADD COLUMN IF NOT EXISTS following_count INTEGER NOT NULL DEFAULT 0;
+
+ALTER TABLE users ADD COLUMN IF NOT EXISTS followers_count INTEGER NOT NULL DEFAULT 0;
+
+ALTER TABLE users ADD COLUMN IF NOT EXISTS likes_count INTEGER NOT NULL DEFAULT 0;
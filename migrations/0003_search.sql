@@ -0,0 +1,21 @@
+-- Full-text and trigram search over users and messages.
+--
+-- The generated tsvector columns rewrite their tables once when added.
+
+CREATE EXTENSION IF NOT EXISTS pg_trgm;
+
+ALTER TABLE users ADD COLUMN IF NOT EXISTS search_vector tsvector
+    GENERATED ALWAYS AS (to_tsvector('simple'::regconfig,
+        coalesce(username, '') || ' ' || coalesce(bio, '') || ' ' || coalesce(location, ''))) STORED;
+
+ALTER TABLE messages ADD COLUMN IF NOT EXISTS search_vector tsvector
+    GENERATED ALWAYS AS (to_tsvector('english'::regconfig, text)) STORED;
+
+CREATE INDEX CONCURRENTLY IF NOT EXISTS ix_users_search_vector
+    ON users USING gin (search_vector);
+
+CREATE INDEX CONCURRENTLY IF NOT EXISTS ix_users_username_trgm
+    ON users USING gin (username gin_trgm_ops);
+
+CREATE INDEX CONCURRENTLY IF NOT EXISTS ix_messages_search_vector
+    ON messages USING gin (search_vector);
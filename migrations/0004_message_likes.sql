@@ -0,0 +1,21 @@
+-- Likes: one row per (user, message), and a like count on messages.
+--
+-- likes.message_id used to be UNIQUE, which let only one user ever like a
+-- message. The unique index on (user_id, message_id) replaces both it and
+-- ix_likes_user_id, and is what Likes.toggle's ON CONFLICT relies on.
+--
+-- Populate messages.likes_count afterwards with:
+--
+--     flask --app app reconcile-counters
+
+CREATE UNIQUE INDEX CONCURRENTLY IF NOT EXISTS ix_likes_user_id_message_id
+    ON likes (user_id, message_id);
+
+CREATE INDEX CONCURRENTLY IF NOT EXISTS ix_likes_message_id
+    ON likes (message_id);
+
+ALTER TABLE likes DROP CONSTRAINT IF EXISTS likes_message_id_key;
+
+DROP INDEX CONCURRENTLY IF EXISTS ix_likes_user_id;
+
+ALTER TABLE messages ADD COLUMN IF NOT EXISTS likes_count INTEGER NOT NULL DEFAULT 0;
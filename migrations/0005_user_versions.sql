@@ -0,0 +1,7 @@
+-- Per-user version counters, for ETags on profile, follow-list and message
+-- pages (see conditional.py). Bumped by every change to what those pages
+-- show.
+
+ALTER TABLE users ADD COLUMN IF NOT EXISTS version INTEGER NOT NULL DEFAULT 0;
+
+ALTER TABLE users ADD COLUMN IF NOT EXISTS updated_at TIMESTAMP NOT NULL DEFAULT now();
@@ -0,0 +1,25 @@
+-- Conversations: one row per participant of each direct-message thread,
+-- pointing at its latest message and counting what that side hasn't read
+-- (see models.Conversation), plus the per-user unread total shown in the
+-- navbar. Thread pages read direct_msg by the (unordered) pair of users.
+--
+-- Populate conversations afterwards with:
+--
+--     flask --app app backfill-conversations
+
+ALTER TABLE users ADD COLUMN IF NOT EXISTS unread_count INTEGER NOT NULL DEFAULT 0;
+
+CREATE TABLE IF NOT EXISTS conversations (
+    user_id INTEGER NOT NULL REFERENCES users (id) ON DELETE CASCADE,
+    other_id INTEGER NOT NULL REFERENCES users (id) ON DELETE CASCADE,
+    last_message_id INTEGER REFERENCES direct_msg (id) ON DELETE SET NULL,
+    last_message_at TIMESTAMP NOT NULL,
+    unread_count INTEGER NOT NULL DEFAULT 0,
+    PRIMARY KEY (user_id, other_id)
+);
+
+CREATE INDEX CONCURRENTLY IF NOT EXISTS ix_conversations_user_id_last_message_at
+    ON conversations (user_id, last_message_at, other_id);
+
+CREATE INDEX CONCURRENTLY IF NOT EXISTS ix_direct_msg_pair_timestamp
+    ON direct_msg (least(sender_id, receiver_id), greatest(sender_id, receiver_id), timestamp, id);
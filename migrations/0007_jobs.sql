@@ -0,0 +1,17 @@
+-- Background jobs: side effects routes defer to `flask --app app run-worker`
+-- (see jobs.py). Workers poll the due, queued jobs through the partial index.
+
+CREATE TABLE IF NOT EXISTS jobs (
+    id BIGSERIAL PRIMARY KEY,
+    kind TEXT NOT NULL,
+    payload JSONB NOT NULL,
+    status TEXT NOT NULL DEFAULT 'queued',
+    attempts INTEGER NOT NULL DEFAULT 0,
+    max_attempts INTEGER NOT NULL DEFAULT 5,
+    run_at TIMESTAMP NOT NULL,
+    last_error TEXT,
+    created_at TIMESTAMP NOT NULL
+);
+
+CREATE INDEX CONCURRENTLY IF NOT EXISTS ix_jobs_queued_run_at
+    ON jobs (run_at, id) WHERE status = 'queued';
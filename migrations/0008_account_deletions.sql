@@ -0,0 +1,26 @@
+-- Background account deletion: users.deleted_at hides an account at once,
+-- and the purge_account job deletes its rows in batches, recording progress
+-- in account_deletions (see models.AccountDeletion). The new indexes serve
+-- the deletes that cascade from messages and direct messages.
+
+ALTER TABLE users ADD COLUMN IF NOT EXISTS deleted_at TIMESTAMP;
+
+CREATE TABLE IF NOT EXISTS account_deletions (
+    user_id INTEGER PRIMARY KEY,
+    step TEXT,
+    rows_deleted BIGINT NOT NULL DEFAULT 0,
+    requested_at TIMESTAMP NOT NULL,
+    finished_at TIMESTAMP
+);
+
+CREATE INDEX CONCURRENTLY IF NOT EXISTS ix_users_deleted
+    ON users (id) WHERE deleted_at IS NOT NULL;
+
+CREATE INDEX CONCURRENTLY IF NOT EXISTS ix_home_timeline_message_id
+    ON home_timeline (message_id);
+
+CREATE INDEX CONCURRENTLY IF NOT EXISTS ix_direct_msg_sender_id
+    ON direct_msg (sender_id);
+
+CREATE INDEX CONCURRENTLY IF NOT EXISTS ix_conversations_last_message_id
+    ON conversations (last_message_id);
@@ -1,12 +1,39 @@
 """SQLAlchemy models for Warbler."""
 
+from collections import Counter, defaultdict
 from datetime import datetime
 
-from flask_bcrypt import Bcrypt
 from flask_sqlalchemy import SQLAlchemy
+from sqlalchemy import DDL, case, delete, event, func, literal, select, text, tuple_, union_all, update
+from sqlalchemy.dialects.postgresql import JSONB, TSVECTOR, insert
+from sqlalchemy.orm import Session, load_only, with_loader_criteria
 
-bcrypt = Bcrypt()
-db = SQLAlchemy()
+from passwords import hasher
+from replicas import RoutingSession
+
+db = SQLAlchemy(session_options={'class_': RoutingSession})
+
+
+class CounterMixin:
+    """Denormalized `*_count` columns updated in place."""
+
+    @classmethod
+    def changed_values(cls):
+        """Extra column values to set whenever a row's counters change."""
+
+        return {}
+
+    @classmethod
+    def adjust_counts(cls, row_id, **deltas):
+        """Add `deltas` to a row's counters, e.g. `adjust_counts(1, likes_count=-1)`.
+
+        Runs as a single UPDATE in the current transaction, so the counters
+        commit (or roll back) together with the change they count.
+        """
+
+        values = {getattr(cls, name): getattr(cls, name) + delta for name, delta in deltas.items()}
+        values.update(cls.changed_values())
+        cls.query.filter(cls.id == row_id).update(values)
 
 
 class Follows(db.Model):
@@ -17,6 +44,12 @@ class Follows(db.Model):
     user_being_followed_id = db.Column( db.Integer, db.ForeignKey('users.id', ondelete="cascade"), primary_key=True)
     user_following_id = db.Column(db.Integer, db.ForeignKey('users.id', ondelete="cascade"), primary_key=True)
 
+    # The primary key already leads with user_being_followed_id (followers
+    # lookups); this covers the other direction (who a user is following).
+    __table_args__ = (
+        db.Index('ix_follows_user_following_id', 'user_following_id', 'user_being_followed_id'),
+    )
+
 
 class Likes(db.Model):
     """Mapping user likes to warbles."""
@@ -25,10 +58,52 @@ class Likes(db.Model):
 
     id = db.Column(db.Integer, primary_key=True)
     user_id = db.Column(db.Integer, db.ForeignKey('users.id', ondelete='cascade') )
-    message_id = db.Column( db.Integer, db.ForeignKey('messages.id', ondelete='cascade'), unique=True)
+    message_id = db.Column( db.Integer, db.ForeignKey('messages.id', ondelete='cascade'))
+
+    # A user likes a message at most once. The unique index also serves
+    # lookups by user_id (messages_show_likes, User.liked_ids).
+    __table_args__ = (
+        db.Index('ix_likes_user_id_message_id', 'user_id', 'message_id', unique=True),
+        db.Index('ix_likes_message_id', 'message_id'),
+    )
+
+    @classmethod
+    def toggle(cls, user_id, message_id):
+        """Like `message_id` as `user_id`, or take the like back if there is one.
+
+        An INSERT ... ON CONFLICT DO NOTHING, then a DELETE only if nothing
+        was inserted: a couple of single-row statements, however many likes
+        the user has. Keeps the liker's and the message's counters in step.
 
+        Returns True if the message is liked afterwards.
+        """
 
-class User(db.Model):
+        inserted = db.session.execute(
+            insert(cls)
+            .values(user_id=user_id, message_id=message_id)
+            .on_conflict_do_nothing(index_elements=['user_id', 'message_id'])
+            .returning(cls.id)).first()
+
+        if inserted is not None:
+            delta = 1
+        else:
+            deleted = db.session.execute(
+                delete(cls).where(cls.user_id == user_id, cls.message_id == message_id),
+                execution_options={'synchronize_session': False})
+            if not deleted.rowcount:
+                # taken back concurrently; nothing left to count
+                return False
+            delta = -1
+
+        User.adjust_counts(user_id, likes_count=delta)
+        # the author's row isn't touched: likes on a popular author's
+        # messages would all queue on its lock. Pages showing like counts
+        # validate on the messages' own likes_count instead.
+        Message.adjust_counts(message_id, likes_count=delta)
+        return delta > 0
+
+
+class User(CounterMixin, db.Model):
     """User in the system."""
 
     __tablename__ = 'users'
@@ -42,7 +117,41 @@ class User(db.Model):
     bio = db.Column(db.Text)
     location = db.Column(db.Text)
     password = db.Column(db.Text, nullable=False)
-    messages = db.relationship('Message')
+
+    # full-text search over profile fields, maintained by Postgres
+    search_vector = db.deferred(db.Column(TSVECTOR, db.Computed(
+        "to_tsvector('simple'::regconfig, "
+        "coalesce(username, '') || ' ' || coalesce(bio, '') || ' ' || coalesce(location, ''))",
+        persisted=True)))
+
+    # Denormalized counts, kept in step with the source tables by the
+    # routes that change them (see `CounterMixin.adjust_counts`) and
+    # recomputable with `reconcile_counts`.
+    messages_count = db.Column(db.Integer, nullable=False, default=0, server_default='0')
+    following_count = db.Column(db.Integer, nullable=False, default=0, server_default='0')
+    followers_count = db.Column(db.Integer, nullable=False, default=0, server_default='0')
+    likes_count = db.Column(db.Integer, nullable=False, default=0, server_default='0')
+
+    # Bumped (see `touch`) whenever anything shown on this user's pages
+    # changes: profile, counters, messages, who follows them, but not likes
+    # of their messages (pages validate on `Message.likes_count`). Pages
+    # use it for ETags (see conditional.py).
+    version = db.Column(db.Integer, nullable=False, default=0, server_default='0')
+    updated_at = db.Column(db.DateTime, nullable=False, default=datetime.utcnow, server_default=func.now())
+
+    # Direct messages not read yet, summed over this user's conversations
+    # (see `Conversation`). Only the navbar shows it, so changing it doesn't
+    # bump `version`.
+    unread_count = db.Column(db.Integer, nullable=False, default=0, server_default='0')
+
+    # Set when the user deletes their account. From then on queries leave
+    # the user out (see `hide_deleted_users`) while `AccountDeletion`
+    # purges their rows in the background.
+    deleted_at = db.Column(db.DateTime)
+
+    # the database cascades deletes to these rows (ON DELETE CASCADE);
+    # don't let the ORM null out their foreign keys first
+    messages = db.relationship('Message', passive_deletes='all')
 
     followers = db.relationship("User", secondary="follows",
         primaryjoin=(Follows.user_being_followed_id == id),
@@ -56,23 +165,164 @@ class User(db.Model):
 
     likes = db.relationship('Message', secondary="likes")
     
-    senders_msg = db.relationship('DirectMessage', back_populates='sender', foreign_keys='DirectMessage.sender_id')
-    receivers_msg = db.relationship('DirectMessage', back_populates='receiver', foreign_keys='DirectMessage.receiver_id')
+    senders_msg = db.relationship('DirectMessage', back_populates='sender', foreign_keys='DirectMessage.sender_id', passive_deletes='all')
+    receivers_msg = db.relationship('DirectMessage', back_populates='receiver', foreign_keys='DirectMessage.receiver_id', passive_deletes='all')
+
+    __table_args__ = (
+        db.Index('ix_users_search_vector', 'search_vector', postgresql_using='gin'),
+        # the few accounts being purged, which every query excludes
+        db.Index('ix_users_deleted', 'id', postgresql_where=text("deleted_at IS NOT NULL")),
+    )
 
     def __repr__(self):
         return f"<User #{self.id}: {self.username}, {self.email}>"
 
+    @classmethod
+    def changed_values(cls):
+        return {cls.version: cls.version + 1, cls.updated_at: func.timezone('utc', func.now())}
+
+    @classmethod
+    def version_of(cls, user_id):
+        """Get `(version, updated_at)` of a user, or None if there's no such user."""
+
+        return db.session.query(cls.version, cls.updated_at).filter(cls.id == user_id).first()
+
+    # what fragments/user_card.html renders
+    CARD_COLUMNS = ('id', 'version', 'username', 'image_url', 'header_image_url', 'bio')
+
+    @classmethod
+    def follow_list(cls, user_id, listing):
+        """Query the users on `user_id`'s 'following' or 'followers' list,
+        loading only their card columns.
+
+        Returns the query and the `follows` column holding the listed users'
+        ids; paginate by that column so each page is a seek on the follows
+        primary key (or its reverse index), however long the list is.
+        """
+
+        if listing == 'following':
+            owner, member = Follows.user_following_id, Follows.user_being_followed_id
+        else:
+            owner, member = Follows.user_being_followed_id, Follows.user_following_id
+
+        query = (cls.query
+                 .join(Follows, member == cls.id)
+                 .filter(owner == user_id)
+                 .options(load_only(*[getattr(cls, column) for column in cls.CARD_COLUMNS])))
+        return query, member
+
+    # pg_notify channel telling every web process which users' cached
+    # snapshots (see identity.py) changed
+    IDENTITY_CHANNEL = 'identity'
+
+    @classmethod
+    def identity_changed(cls, user_ids):
+        """Invalidate the cached snapshots of `user_ids` in every process,
+        once the current transaction commits."""
+
+        user_ids = [str(user_id) for user_id in user_ids]
+        # pg_notify payloads are limited to 8000 bytes
+        for start in range(0, len(user_ids), 500):
+            db.session.execute(func.pg_notify(cls.IDENTITY_CHANNEL, ','.join(user_ids[start:start + 500])).select())
+
+    @classmethod
+    def touch(cls, user_ids):
+        """Bump the version of `user_ids` (a list or a select of ids)."""
+
+        cls.query.filter(cls.id.in_(user_ids)).update(cls.changed_values(), synchronize_session=False)
+
+    @classmethod
+    def release_likes(cls, message_ids):
+        """Take likes of `message_ids` out of the likers' counters.
+
+        Call before deleting those messages; `message_ids` may be a list or
+        a select of ids.
+        """
+
+        likers = (select(Likes.user_id, func.count().label('n'))
+                  .where(Likes.message_id.in_(message_ids))
+                  .group_by(Likes.user_id)
+                  .subquery())
+
+        db.session.execute(update(cls)
+                           .where(cls.id == likers.c.user_id)
+                           .values({cls.likes_count: cls.likes_count - likers.c.n, **cls.changed_values()}),
+                           execution_options={'synchronize_session': False})
+
+    @classmethod
+    def subtract(cls, column, user_ids):
+        """Subtract one from `column` of `user_ids` for every time a user is
+        listed, e.g. `subtract(User.followers_count, followed_ids)`."""
+
+        by_amount = defaultdict(list)
+        for user_id, amount in Counter(user_ids).items():
+            by_amount[amount].append(user_id)
+
+        for amount, ids in by_amount.items():
+            cls.query.filter(cls.id.in_(ids)).update({column: column - amount, **cls.changed_values()},
+                                                     synchronize_session=False)
+
+    @classmethod
+    def reconcile_counts(cls, user_ids):
+        """Recompute the counters of `user_ids` from the source tables.
+
+        Returns the number of users updated.
+        """
+
+        def count(*criteria):
+            return select(func.count()).where(*criteria).scalar_subquery()
+
+        return cls.query.filter(cls.id.in_(user_ids)).update({
+            cls.messages_count: count(Message.user_id == cls.id),
+            cls.following_count: count(Follows.user_following_id == cls.id),
+            cls.followers_count: count(Follows.user_being_followed_id == cls.id),
+            cls.likes_count: count(Likes.user_id == cls.id),
+            **cls.changed_values(),
+        }, synchronize_session=False)
+
     def is_followed_by(self, other_user):
         """Is this user followed by `other_user`?"""
 
-        found_user_list = [user for user in self.followers if user == other_user]
-        return len(found_user_list) == 1
+        return other_user.is_following(self)
 
     def is_following(self, other_user):
         """Is this user following `other_use`?"""
 
-        found_user_list = [user for user in self.following if user == other_user]
-        return len(found_user_list) == 1
+        return other_user.id in self.following_ids([other_user.id])
+
+    def following_ids(self, user_ids):
+        """Which of `user_ids` is this user following?
+
+        Returns a set of ids, found with one indexed query however many ids
+        are asked about -- use it when rendering a list of user cards.
+        """
+
+        user_ids = list(user_ids)
+        if not user_ids:
+            return set()
+
+        followed = (db.session
+                    .query(Follows.user_being_followed_id)
+                    .filter(Follows.user_following_id == self.id,
+                            Follows.user_being_followed_id.in_(user_ids)))
+        return {user_id for (user_id,) in followed}
+
+    def liked_ids(self, message_ids):
+        """Which of `message_ids` has this user liked?
+
+        Returns a set of ids, found with one indexed query -- use it for the
+        like buttons of a page of messages.
+        """
+
+        message_ids = list(message_ids)
+        if not message_ids:
+            return set()
+
+        liked = (db.session
+                 .query(Likes.message_id)
+                 .filter(Likes.user_id == self.id,
+                         Likes.message_id.in_(message_ids)))
+        return {message_id for (message_id,) in liked}
 
     @classmethod
     def signup(cls, username, email, password, image_url):
@@ -81,7 +331,7 @@ class User(db.Model):
         Hashes password and adds user to system.
         """
 
-        hashed_pwd = bcrypt.generate_password_hash(password).decode('UTF-8')
+        hashed_pwd = hasher.hash(password)
 
         user = User( username=username, email=email, password=hashed_pwd, image_url=image_url )
 
@@ -97,13 +347,19 @@ class User(db.Model):
         and, if it finds such a user, returns that user object.
 
         If can't find matching user (or if password is wrong), returns False.
+
+        If the stored hash was made with a different bcrypt cost than the one
+        configured, it is re-hashed; the caller commits.
         """
 
         user = cls.query.filter_by(username=username).first()
 
         if user:
-            is_auth = bcrypt.check_password_hash(user.password, password)
+            is_auth = hasher.check(user.password, password)
             if is_auth:
+                if hasher.needs_rehash(user.password):
+                    # the configured cost changed since this hash was made
+                    user.password = hasher.hash(password)
                 return user
 
         return False
@@ -115,25 +371,194 @@ class User(db.Model):
         Hashes password and adds user to system.
         """
 
-        hashed_pwd = bcrypt.generate_password_hash(password).decode('UTF-8')
+        hashed_pwd = hasher.hash(password)
         
         user = cls.query.filter_by(username=username).first()
         user.password = hashed_pwd
         
         return user
 
-class Message(db.Model):
+class Message(CounterMixin, db.Model):
     """An individual message ("warble")."""
 
     __tablename__ = 'messages'
 
     id = db.Column(db.Integer,primary_key=True )
     text = db.Column(db.String(140), nullable=False)
-    timestamp = db.Column(db.DateTime, nullable=False, default=datetime.utcnow())
+    timestamp = db.Column(db.DateTime, nullable=False, default=datetime.utcnow)
     user_id = db.Column(db.Integer, db.ForeignKey('users.id', ondelete='CASCADE'), nullable=False)
 
+    # kept in step by Likes.toggle, recomputable with `reconcile_counts`
+    likes_count = db.Column(db.Integer, nullable=False, default=0, server_default='0')
+
+    # full-text search over the message, maintained by Postgres
+    search_vector = db.deferred(db.Column(TSVECTOR, db.Computed(
+        "to_tsvector('english'::regconfig, text)", persisted=True)))
+
     user = db.relationship('User')
 
+    __table_args__ = (
+        db.Index('ix_messages_user_id_timestamp', 'user_id', 'timestamp', 'id'),
+        db.Index('ix_messages_search_vector', 'search_vector', postgresql_using='gin'),
+    )
+
+    @classmethod
+    def version_of(cls, message_id):
+        """Get `(likes_count, author version, author updated_at)` of a
+        message, or None if there's no such message.
+
+        The text never changes; the rest is what its page shows.
+        """
+
+        return (db.session
+                .query(cls.likes_count, User.version, User.updated_at)
+                .join(cls.user)
+                .filter(cls.id == message_id)
+                .first())
+
+    @classmethod
+    def reconcile_counts(cls, message_ids):
+        """Recompute the like counts of `message_ids` from `likes`.
+
+        Returns the number of messages updated.
+        """
+
+        likes = select(func.count()).where(Likes.message_id == cls.id).scalar_subquery()
+
+        return cls.query.filter(cls.id.in_(message_ids)).update(
+            {cls.likes_count: likes}, synchronize_session=False)
+
+
+class TimelineEntry(db.Model):
+    """A message fanned out to one follower's home timeline.
+
+    Rows are written when a message is posted (one per follower of the
+    author), so the homepage reads a user's feed with a single range scan
+    instead of joining follows against every message.
+    """
+
+    __tablename__ = 'home_timeline'
+
+    user_id = db.Column(db.Integer, db.ForeignKey('users.id', ondelete='cascade'), primary_key=True)
+    message_id = db.Column(db.Integer, db.ForeignKey('messages.id', ondelete='cascade'), primary_key=True)
+    author_id = db.Column(db.Integer, db.ForeignKey('users.id', ondelete='cascade'), nullable=False)
+    timestamp = db.Column(db.DateTime, nullable=False)
+
+    __table_args__ = (
+        db.Index('ix_home_timeline_user_id_timestamp', 'user_id', 'timestamp', 'message_id'),
+        # deleting a message cascades here
+        db.Index('ix_home_timeline_message_id', 'message_id'),
+    )
+
+    COLUMNS = ['user_id', 'message_id', 'author_id', 'timestamp']
+
+    # How many of an author's newest messages are copied into a timeline
+    # when a follow starts or when timelines are rebuilt.
+    BACKFILL_LIMIT = 500
+
+    # first key of the advisory locks taken by `lock` and `lock_author`
+    ADVISORY_LOCK_CLASS = 1
+    AUTHOR_LOCK_CLASS = 2
+
+    @classmethod
+    def messages_for(cls, user_id):
+        """Query for the messages on `user_id`'s timeline, newest first."""
+
+        return (Message
+                .query
+                .join(cls, cls.message_id == Message.id)
+                .filter(cls.user_id == user_id)
+                .order_by(cls.timestamp.desc()))
+
+    @classmethod
+    def fan_out(cls, message):
+        """Add a freshly posted `message` to the timelines of its author's followers.
+
+        The message must already be flushed so that it has an id. Take
+        `lock_author` first if follows may change meanwhile.
+        """
+
+        followers = select(Follows.user_following_id,
+                           literal(message.id),
+                           literal(message.user_id),
+                           literal(message.timestamp)
+                           ).where(Follows.user_being_followed_id == message.user_id)
+
+        # a follow backfill may have copied it already
+        db.session.execute(insert(cls).from_select(cls.COLUMNS, followers).on_conflict_do_nothing())
+
+    @classmethod
+    def lock(cls, user_id):
+        """Serialize changes to `user_id`'s timeline until the transaction ends.
+
+        Follow and unfollow backfills run as jobs, possibly at the same time;
+        each takes this lock and then acts on whether the follow exists by then.
+        """
+
+        db.session.execute(select(func.pg_advisory_xact_lock(cls.ADVISORY_LOCK_CLASS, user_id)))
+
+    @classmethod
+    def lock_author(cls, author_id, shared=False):
+        """Serialize fan-out of `author_id`'s messages against follow backfills
+        for them until the transaction ends.
+
+        `fan_out` copies a message to whoever follows the author when its
+        INSERT starts. Without this, a follow ending meanwhile could have its
+        `remove_follow` run before the fan-out commits and miss the new row.
+        Fan-out takes the lock exclusively and backfills take it shared, so
+        follows of one author don't wait on each other. Whichever comes
+        second sees the other's committed follows and timeline rows.
+        """
+
+        lock = func.pg_advisory_xact_lock_shared if shared else func.pg_advisory_xact_lock
+        db.session.execute(select(lock(cls.AUTHOR_LOCK_CLASS, author_id)))
+
+    @classmethod
+    def add_follow(cls, follower_id, followed_id):
+        """Copy the newest messages of `followed_id` into `follower_id`'s timeline,
+        if `follower_id` still follows them."""
+
+        recent = (select(literal(follower_id), Message.id, Message.user_id, Message.timestamp)
+                  .where(Message.user_id == followed_id,
+                         select(Follows).where(Follows.user_following_id == follower_id,
+                                               Follows.user_being_followed_id == followed_id).exists())
+                  .order_by(Message.timestamp.desc())
+                  .limit(cls.BACKFILL_LIMIT))
+
+        db.session.execute(insert(cls).from_select(cls.COLUMNS, recent).on_conflict_do_nothing())
+
+    @classmethod
+    def remove_follow(cls, follower_id, followed_id):
+        """Drop every message of `followed_id` from `follower_id`'s timeline,
+        unless `follower_id` follows them again."""
+
+        following = select(Follows).where(Follows.user_following_id == follower_id,
+                                          Follows.user_being_followed_id == followed_id).exists()
+        cls.query.filter(cls.user_id == follower_id, cls.author_id == followed_id, ~following).delete(
+            synchronize_session=False)
+
+    @classmethod
+    def rebuild(cls, user_ids):
+        """Rebuild the timelines of `user_ids` from follows and messages.
+
+        Returns the number of timeline entries written.
+        """
+
+        cls.query.filter(cls.user_id.in_(user_ids)).delete()
+
+        recent = (select(Message.id, Message.user_id, Message.timestamp)
+                  .join(Follows, Follows.user_being_followed_id == Message.user_id)
+                  .where(Follows.user_following_id == User.id)
+                  .order_by(Message.timestamp.desc())
+                  .limit(cls.BACKFILL_LIMIT)
+                  .lateral())
+
+        entries = (select(User.id, recent.c.id, recent.c.user_id, recent.c.timestamp)
+                   .where(User.id.in_(user_ids)))
+
+        result = db.session.execute(insert(cls).from_select(cls.COLUMNS, entries))
+        return result.rowcount
+
 
 class DirectMessage(db.Model):
     """Mapping user likes to warbles."""
@@ -146,18 +571,390 @@ class DirectMessage(db.Model):
     receiver_id = db.Column(db.Integer, db.ForeignKey('users.id', ondelete='cascade'), nullable=False )
     receiver = db.relationship("User", foreign_keys=receiver_id)
     message_text = db.Column(db.String(300), nullable=False)
-    timestamp = db.Column(db.DateTime, nullable=False, default=datetime.utcnow())
-
+    timestamp = db.Column(db.DateTime, nullable=False, default=datetime.utcnow)
+
+    __table_args__ = (
+        db.Index('ix_direct_msg_receiver_id_timestamp', 'receiver_id', 'timestamp', 'id'),
+        db.Index('ix_direct_msg_sender_id', 'sender_id'),
+        # a thread, either direction (see `thread`)
+        db.Index('ix_direct_msg_pair_timestamp',
+                 func.least(sender_id, receiver_id), func.greatest(sender_id, receiver_id), 'timestamp', 'id'),
+    )
     
     @classmethod
     def sentMessage(cls, sender_id, receiver_id, message_text):
-        """Sign up user."""
+        """Add a direct message and flush it.
+
+        Record it in both sides' conversations with `Conversation.add_message`
+        (the send route queues that as a job); the caller commits.
+        """
 
         directMessage = cls( sender_id=sender_id, receiver_id=receiver_id, message_text=message_text )
 
         db.session.add(directMessage)
+        db.session.flush()
         return directMessage
 
+    @classmethod
+    def thread(cls, user_id, other_id):
+        """Query the messages between two users, in either direction."""
+
+        return cls.query.filter(func.least(cls.sender_id, cls.receiver_id) == min(user_id, other_id),
+                                func.greatest(cls.sender_id, cls.receiver_id) == max(user_id, other_id))
+
+
+class Conversation(db.Model):
+    """One user's side of their direct-message thread with another user.
+
+    Each pair who have exchanged messages has a row per participant, with
+    the latest message and how many of the other user's messages this side
+    hasn't read. `add_message` and `mark_read` keep them (and
+    `User.unread_count`) up to date, so the inbox reads a page of these
+    rows instead of every message ever received.
+    """
+
+    __tablename__ = 'conversations'
+
+    user_id = db.Column(db.Integer, db.ForeignKey('users.id', ondelete='cascade'), primary_key=True)
+    other_id = db.Column(db.Integer, db.ForeignKey('users.id', ondelete='cascade'), primary_key=True)
+    other = db.relationship('User', foreign_keys=other_id)
+    last_message_id = db.Column(db.Integer, db.ForeignKey('direct_msg.id', ondelete='set null'))
+    last_message = db.relationship('DirectMessage')
+    last_message_at = db.Column(db.DateTime, nullable=False)
+    unread_count = db.Column(db.Integer, nullable=False, default=0, server_default='0')
+
+    __table_args__ = (
+        db.Index('ix_conversations_user_id_last_message_at', 'user_id', 'last_message_at', 'other_id'),
+        # deleting a direct message sets these to null
+        db.Index('ix_conversations_last_message_id', 'last_message_id'),
+    )
+
+    COLUMNS = ['user_id', 'other_id', 'last_message_id', 'last_message_at']
+
+    @classmethod
+    def add_message(cls, message):
+        """Point both sides at a freshly sent (and flushed) `message` and count
+        it as unread for the receiver."""
+
+        sides = [dict(user_id=message.sender_id, other_id=message.receiver_id, unread_count=0)]
+        if message.receiver_id != message.sender_id:
+            sides.append(dict(user_id=message.receiver_id, other_id=message.sender_id, unread_count=1))
+
+        upsert = insert(cls).values([dict(side, last_message_id=message.id, last_message_at=message.timestamp)
+                                     for side in sides])
+        # messages may be added out of order (as jobs); keep the latest
+        newer = upsert.excluded.last_message_at >= cls.last_message_at
+        db.session.execute(upsert.on_conflict_do_update(
+            index_elements=[cls.user_id, cls.other_id],
+            set_={'last_message_id': case((newer, upsert.excluded.last_message_id), else_=cls.last_message_id),
+                  'last_message_at': func.greatest(cls.last_message_at, upsert.excluded.last_message_at),
+                  'unread_count': cls.unread_count + upsert.excluded.unread_count}))
+
+        if len(sides) > 1:
+            User.query.filter(User.id == message.receiver_id).update({User.unread_count: User.unread_count + 1})
+            User.identity_changed([message.receiver_id])
+
+    @classmethod
+    def mark_read(cls, user_id, other_id):
+        """Mark `user_id`'s side of the thread with `other_id` as read.
+
+        Returns how many messages that cleared; the caller commits.
+        """
+
+        unread = (db.session
+                  .query(cls.unread_count)
+                  .filter(cls.user_id == user_id, cls.other_id == other_id)
+                  .with_for_update()
+                  .scalar())
+        if not unread:
+            return 0
+
+        cls.query.filter(cls.user_id == user_id, cls.other_id == other_id).update({cls.unread_count: 0})
+        User.query.filter(User.id == user_id).update({User.unread_count: User.unread_count - unread})
+        User.identity_changed([user_id])
+        return unread
+
+    @classmethod
+    def rebuild(cls, user_ids):
+        """Rebuild the conversations of `user_ids` from direct messages, all read.
+
+        Returns the number of conversations written.
+        """
+
+        cls.query.filter(cls.user_id.in_(user_ids)).delete()
+        User.query.filter(User.id.in_(user_ids)).update({User.unread_count: 0})
+        User.identity_changed(user_ids)
+
+        sides = union_all(
+            select(DirectMessage.sender_id.label('user_id'), DirectMessage.receiver_id.label('other_id'),
+                   DirectMessage.id, DirectMessage.timestamp),
+            select(DirectMessage.receiver_id, DirectMessage.sender_id,
+                   DirectMessage.id, DirectMessage.timestamp),
+        ).subquery()
+
+        latest = (select(sides.c.user_id, sides.c.other_id, sides.c.id, sides.c.timestamp)
+                  .where(sides.c.user_id.in_(user_ids))
+                  .distinct(sides.c.user_id, sides.c.other_id)
+                  .order_by(sides.c.user_id, sides.c.other_id, sides.c.timestamp.desc(), sides.c.id.desc()))
+
+        result = db.session.execute(insert(cls).from_select(cls.COLUMNS, latest))
+        return result.rowcount
+
+class Job(db.Model):
+    """A queued unit of deferred work (see jobs.py).
+
+    Rows are deleted when their job succeeds; a job that keeps failing is
+    kept with status 'failed' and its last error.
+    """
+
+    __tablename__ = 'jobs'
+
+    id = db.Column(db.BigInteger, primary_key=True)
+    kind = db.Column(db.Text, nullable=False)
+    payload = db.Column(JSONB, nullable=False, default=dict)
+    status = db.Column(db.Text, nullable=False, default='queued', server_default='queued')
+    attempts = db.Column(db.Integer, nullable=False, default=0, server_default='0')
+    max_attempts = db.Column(db.Integer, nullable=False, default=5, server_default='5')
+    run_at = db.Column(db.DateTime, nullable=False, default=datetime.utcnow)
+    last_error = db.Column(db.Text)
+    created_at = db.Column(db.DateTime, nullable=False, default=datetime.utcnow)
+
+    __table_args__ = (
+        # what workers poll: the due, queued jobs, oldest first
+        db.Index('ix_jobs_queued_run_at', 'run_at', 'id', postgresql_where=text("status = 'queued'")),
+    )
+
+
+class AccountDeletion(db.Model):
+    """A deleted account whose rows are being purged.
+
+    `start` marks the user deleted, which hides them at once. The
+    `purge_account` job (see jobs.py) then calls `purge` over and over, each
+    call deleting at most a batch of rows in its own transaction, so a big
+    account never holds long locks on the shared tables. It works through
+    STEPS in order and deletes the user row last. `step` and `rows_deleted`
+    record how far it got; the row is kept, with `finished_at`, afterwards.
+    """
+
+    __tablename__ = 'account_deletions'
+
+    # no foreign key: this outlives the user
+    user_id = db.Column(db.Integer, primary_key=True, autoincrement=False)
+    step = db.Column(db.Text)
+    rows_deleted = db.Column(db.BigInteger, nullable=False, default=0, server_default='0')
+    requested_at = db.Column(db.DateTime, nullable=False, default=datetime.utcnow)
+    finished_at = db.Column(db.DateTime)
+
+    STEPS = ('likes', 'following', 'followers', 'timeline', 'messages', 'conversations', 'direct_messages', 'user')
+
+    @classmethod
+    def start(cls, user_id):
+        """Mark `user_id` deleted and record the purge to come; the caller
+        commits and queues the job."""
+
+        User.query.filter(User.id == user_id).update(
+            {User.deleted_at: func.timezone('utc', func.now()), **User.changed_values()})
+
+        deletion = cls(user_id=user_id, step=cls.STEPS[0])
+        db.session.add(deletion)
+        return deletion
+
+    def purge(self, batch_size):
+        """Delete up to `batch_size` rows of the current step, moving on to the
+        next step once one has nothing left.
+
+        Returns `(step, rows deleted)`, or None once the user is gone.
+        """
+
+        while self.step is not None:
+            deleted = getattr(self, f'purge_{self.step}')(batch_size)
+            if deleted:
+                self.rows_deleted += deleted
+                return self.step, deleted
+
+            following = self.STEPS.index(self.step) + 1
+            self.step = self.STEPS[following] if following < len(self.STEPS) else None
+
+        self.finished_at = datetime.utcnow()
+        return None
+
+    @staticmethod
+    def delete_batch(model, key, batch, *columns):
+        """Delete the rows of `model` whose `key` is in `batch` (a limited
+        select, or a list); return their `columns`."""
+
+        return db.session.execute(delete(model).where(key.in_(batch)).returning(*columns),
+                                  execution_options={'synchronize_session': False}).all()
+
+    def purge_likes(self, batch_size):
+        """Likes given: uncount them on the liked messages."""
+
+        liked = [message_id for (message_id,) in self.delete_batch(
+            Likes, Likes.id,
+            select(Likes.id).where(Likes.user_id == self.user_id).limit(batch_size),
+            Likes.message_id)]
+
+        if liked:
+            Message.query.filter(Message.id.in_(liked)).update(
+                {Message.likes_count: Message.likes_count - 1}, synchronize_session=False)
+            User.touch(select(Message.user_id).where(Message.id.in_(liked)))
+        return len(liked)
+
+    def purge_following(self, batch_size):
+        """Follows of other users: uncount them as followers."""
+
+        followed = [followed_id for (followed_id,) in self.delete_batch(
+            Follows, tuple_(Follows.user_following_id, Follows.user_being_followed_id),
+            select(Follows.user_following_id, Follows.user_being_followed_id)
+            .where(Follows.user_following_id == self.user_id)
+            .limit(batch_size),
+            Follows.user_being_followed_id)]
+
+        User.subtract(User.followers_count, followed)
+        return len(followed)
+
+    def purge_followers(self, batch_size):
+        """Followers: uncount the follows. Their timeline entries go with the messages."""
+
+        followers = [follower_id for (follower_id,) in self.delete_batch(
+            Follows, tuple_(Follows.user_being_followed_id, Follows.user_following_id),
+            select(Follows.user_being_followed_id, Follows.user_following_id)
+            .where(Follows.user_being_followed_id == self.user_id)
+            .limit(batch_size),
+            Follows.user_following_id)]
+
+        User.subtract(User.following_count, followers)
+        return len(followers)
+
+    def purge_timeline(self, batch_size):
+        """The user's own home timeline."""
+
+        return len(self.delete_batch(
+            TimelineEntry, tuple_(TimelineEntry.user_id, TimelineEntry.message_id),
+            select(TimelineEntry.user_id, TimelineEntry.message_id)
+            .where(TimelineEntry.user_id == self.user_id)
+            .limit(batch_size),
+            TimelineEntry.message_id))
+
+    def purge_messages(self, batch_size):
+        """Messages, oldest first. A batch of messages is deleted only once
+        the timeline entries and likes they'd cascade to are gone, a batch of
+        those at a time, so no statement deletes more than `batch_size` rows.
+        """
+
+        oldest = (select(Message.id)
+                  .where(Message.user_id == self.user_id)
+                  .order_by(Message.timestamp, Message.id)
+                  .limit(batch_size))
+
+        entries = self.delete_batch(
+            TimelineEntry, tuple_(TimelineEntry.user_id, TimelineEntry.message_id),
+            select(TimelineEntry.user_id, TimelineEntry.message_id)
+            .where(TimelineEntry.message_id.in_(oldest))
+            .limit(batch_size),
+            TimelineEntry.message_id)
+        if entries:
+            return len(entries)
+
+        likers = [user_id for (user_id,) in self.delete_batch(
+            Likes, Likes.id,
+            select(Likes.id).where(Likes.message_id.in_(oldest)).limit(batch_size),
+            Likes.user_id)]
+        if likers:
+            User.subtract(User.likes_count, likers)
+            return len(likers)
+
+        return len(self.delete_batch(Message, Message.id, oldest, Message.id))
+
+    def purge_conversations(self, batch_size):
+        """Conversations, on both sides. What the user sent and the other side
+        hasn't read comes out of the other side's unread count."""
+
+        others = [other_id for (other_id,) in self.delete_batch(
+            Conversation, tuple_(Conversation.user_id, Conversation.other_id),
+            select(Conversation.user_id, Conversation.other_id)
+            .where(Conversation.user_id == self.user_id)
+            .limit(batch_size),
+            Conversation.other_id)]
+        if not others:
+            return 0
+
+        theirs = self.delete_batch(
+            Conversation, tuple_(Conversation.user_id, Conversation.other_id),
+            [(other_id, self.user_id) for other_id in others],
+            Conversation.user_id, Conversation.unread_count)
+        for other_id, unread in theirs:
+            if unread:
+                User.query.filter(User.id == other_id).update({User.unread_count: User.unread_count - unread})
+        User.identity_changed(other_id for other_id, unread in theirs if unread)
+
+        return len(others) + len(theirs)
+
+    def purge_direct_messages(self, batch_size):
+        """Direct messages sent or received."""
+
+        return len(self.delete_batch(
+            DirectMessage, DirectMessage.id,
+            select(DirectMessage.id)
+            .where((DirectMessage.sender_id == self.user_id) | (DirectMessage.receiver_id == self.user_id))
+            .limit(batch_size),
+            DirectMessage.id))
+
+    def purge_user(self, batch_size):
+        """The user row itself; nothing is left to cascade to."""
+
+        return len(self.delete_batch(User, User.id, [self.user_id], User.id))
+
+
+# Deleted users disappear from every ORM query at once, with what they
+# wrote: their profile, messages and direct messages, and conversations
+# with them. Pass execution option include_deleted=True to see them.
+deleted_user_ids = (select(User.__table__.c.id)
+                    .where(User.__table__.c.deleted_at.isnot(None))
+                    .scalar_subquery())
+
+
+def without_deleted_users():
+    """Loader options that leave deleted users (and what they wrote) out of a query."""
+
+    return (
+        with_loader_criteria(User, User.deleted_at.is_(None), include_aliases=True),
+        with_loader_criteria(Message, Message.user_id.not_in(deleted_user_ids), include_aliases=True),
+        with_loader_criteria(DirectMessage, DirectMessage.sender_id.not_in(deleted_user_ids)
+                             & DirectMessage.receiver_id.not_in(deleted_user_ids), include_aliases=True),
+        with_loader_criteria(Conversation, Conversation.other_id.not_in(deleted_user_ids), include_aliases=True),
+    )
+
+
+@event.listens_for(Session, 'do_orm_execute')
+def hide_deleted_users(execute_state):
+    if (not execute_state.is_select
+            or execute_state.is_column_load
+            or execute_state.is_relationship_load
+            or execute_state.execution_options.get('include_deleted', False)):
+        return
+
+    execute_state.statement = execute_state.statement.options(*without_deleted_users())
+
+
+def pg_trgm_available(ddl, target, bind, **kw):
+    """Does this Postgres server ship the pg_trgm (contrib) extension?"""
+
+    return bind.execute(text(
+        "SELECT 1 FROM pg_available_extensions WHERE name = 'pg_trgm'")).first() is not None
+
+
+# Substring search on usernames (ILIKE '%q%') uses a trigram index. It needs
+# the pg_trgm extension, so create_all() only builds it where the server has
+# contrib installed; searches still work (more slowly) without it.
+create_pg_trgm = DDL("CREATE EXTENSION IF NOT EXISTS pg_trgm").execute_if(callable_=pg_trgm_available)
+create_username_trgm_index = DDL("CREATE INDEX ix_users_username_trgm ON users "
+                                 "USING gin (username gin_trgm_ops)").execute_if(callable_=pg_trgm_available)
+
+event.listen(db.metadata, 'before_create', create_pg_trgm)
+event.listen(User.__table__, 'after_create', create_username_trgm_index)
+
+
 def connect_db(app):
     """Connect this database to provided Flask app.
 
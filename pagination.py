@@ -0,0 +1,135 @@
+"""Keyset (cursor) pagination for Warbler's lists.
+
+Pages are fetched with an indexed seek past the last row the client saw,
+instead of OFFSET, so every page costs the same no matter how deep it is.
+
+A cursor is an opaque, URL-safe encoding of the ordering key of a row
+(for messages: timestamp and id). Lists are ordered newest first:
+`older` continues after a cursor and `newer` goes back towards the top.
+"""
+
+import base64
+import binascii
+import json
+from datetime import datetime
+
+from flask import abort, current_app, request
+from sqlalchemy import BigInteger, Integer, SmallInteger, tuple_
+
+
+class Page:
+    """One page of results plus the cursors needed to move from it."""
+
+    def __init__(self, items, older=None, newer=None):
+        self.items = items
+        self.older = older
+        self.newer = newer
+
+    def __iter__(self):
+        return iter(self.items)
+
+    def __len__(self):
+        return len(self.items)
+
+
+def encode_cursor(values):
+    """Encode a row's ordering key as an opaque cursor string."""
+
+    raw = [value.isoformat() if isinstance(value, datetime) else value
+           for value in values]
+    return base64.urlsafe_b64encode(json.dumps(raw).encode()).decode().rstrip('=')
+
+
+def integer_bound(column_type):
+    """Integers of `column_type` (int2/int4/int8) lie in [-bound, bound)."""
+
+    if isinstance(column_type, BigInteger):
+        return 2 ** 63
+    if isinstance(column_type, SmallInteger):
+        return 2 ** 15
+    return 2 ** 31
+
+
+def decode_cursor(cursor, columns):
+    """Decode `cursor` into values typed for `columns`.
+
+    Raises ValueError if the cursor is malformed.
+    """
+
+    try:
+        padded = cursor + '=' * (-len(cursor) % 4)
+        raw = json.loads(base64.urlsafe_b64decode(padded.encode()))
+    except (binascii.Error, UnicodeDecodeError, json.JSONDecodeError) as exc:
+        raise ValueError("Invalid cursor.") from exc
+
+    if not isinstance(raw, list) or len(raw) != len(columns):
+        raise ValueError("Invalid cursor.")
+
+    values = []
+    for column, value in zip(columns, raw):
+        python_type = column.type.python_type
+        try:
+            if python_type is datetime:
+                values.append(datetime.fromisoformat(value))
+            else:
+                values.append(python_type(value))
+        except (TypeError, OverflowError) as exc:
+            raise ValueError("Invalid cursor.") from exc
+
+        # out of the column's range, Postgres would fail the query
+        if isinstance(column.type, Integer):
+            bound = integer_bound(column.type)
+            if not -bound <= values[-1] < bound:
+                raise ValueError("Invalid cursor.")
+    return tuple(values)
+
+
+def cursor_args():
+    """Get the `older` / `newer` cursors from the query string."""
+
+    return dict(older=request.args.get('older'), newer=request.args.get('newer'))
+
+
+def paginate(query, columns, older=None, newer=None, per_page=None, key=None):
+    """Return a `Page` of `query` ordered by `columns`, newest first.
+
+    `columns` must be backed by an index in that order (e.g. timestamp, id)
+    so each page is a single index seek. `key` extracts the ordering values
+    from a result row; by default it reads attributes named like `columns`.
+
+    A malformed cursor aborts the request with a 400.
+    """
+
+    per_page = per_page or current_app.config['MESSAGES_PER_PAGE']
+    key = key or (lambda row: tuple(getattr(row, column.key) for column in columns))
+    query = query.order_by(None)
+
+    try:
+        if newer:
+            after = decode_cursor(newer, columns)
+            rows = (query
+                    .filter(tuple_(*columns) > tuple_(*after))
+                    .order_by(*[column.asc() for column in columns])
+                    .limit(per_page + 1)
+                    .all())
+            has_more = len(rows) > per_page
+            items = rows[:per_page][::-1]
+            return Page(items,
+                        older=encode_cursor(key(items[-1])) if items else None,
+                        newer=encode_cursor(key(items[0])) if has_more else None)
+
+        if older:
+            before = decode_cursor(older, columns)
+            query = query.filter(tuple_(*columns) < tuple_(*before))
+    except ValueError:
+        abort(400)
+
+    rows = (query
+            .order_by(*[column.desc() for column in columns])
+            .limit(per_page + 1)
+            .all())
+    has_more = len(rows) > per_page
+    items = rows[:per_page]
+    return Page(items,
+                older=encode_cursor(key(items[-1])) if has_more else None,
+                newer=encode_cursor(key(items[0])) if older and items else None)
@@ -0,0 +1,141 @@
+"""Password hashing and checking on a bounded process pool.
+
+bcrypt is deliberately slow and CPU-bound; run on the request thread, a
+burst of logins pins every web worker. Here the work runs in a pool of
+BCRYPT_POOL_SIZE processes, and at most BCRYPT_MAX_PENDING jobs may be
+queued or running at once. Past that, and when a job doesn't finish
+within BCRYPT_TIMEOUT seconds, callers get PasswordHashingBusy, which
+the app turns into a 503 with Retry-After instead of piling up requests.
+
+The cost factor is BCRYPT_LOG_ROUNDS. `needs_rehash` tells whether a
+stored hash was made with a different cost, so User.authenticate can
+upgrade it on the next successful login.
+
+A pool size of 0 hashes inline on the calling thread (still bounded).
+"""
+
+import multiprocessing
+import os
+import threading
+from concurrent.futures import ProcessPoolExecutor, TimeoutError
+
+import bcrypt
+
+from metrics import Counter, timed
+
+REJECTED = Counter('warbler_bcrypt_rejected_total',
+                   "Password hashing jobs refused because the pool was busy.", label='operation')
+
+
+class PasswordHashingBusy(Exception):
+    """Too much password hashing is already queued; try again shortly."""
+
+
+def hash_in_worker(password, rounds):
+    """Hash `password` (bytes) with cost `rounds`; runs in a pool process."""
+
+    return bcrypt.hashpw(password, bcrypt.gensalt(rounds)).decode('UTF-8')
+
+
+def check_in_worker(hashed, password):
+    """Check `password` (bytes) against `hashed`; runs in a pool process."""
+
+    return bcrypt.checkpw(password, hashed.encode('UTF-8'))
+
+
+class PasswordHasher:
+    """Submits bcrypt work to a lazily started process pool, with back-pressure."""
+
+    def __init__(self, rounds=12, pool_size=0, max_pending=32, timeout=10):
+        self.configure(rounds, pool_size, max_pending, timeout)
+
+    def configure(self, rounds, pool_size, max_pending, timeout):
+        self.rounds = rounds
+        self.pool_size = pool_size
+        self.timeout = timeout
+        self._slots = threading.BoundedSemaphore(max_pending)
+        self._executor = None
+        self._lock = threading.Lock()
+
+    def executor(self):
+        """The process pool, started on first use (so after any fork)."""
+
+        with self._lock:
+            if self._executor is None:
+                self._executor = ProcessPoolExecutor(
+                    max_workers=self.pool_size,
+                    mp_context=multiprocessing.get_context('spawn'))
+            return self._executor
+
+    def run(self, operation, fn, *args):
+        """Run `fn(*args)` in the pool, or raise PasswordHashingBusy."""
+
+        slots = self._slots
+        if not slots.acquire(blocking=False):
+            REJECTED.inc(operation)
+            raise PasswordHashingBusy()
+
+        if not self.pool_size:
+            try:
+                with timed('bcrypt'):
+                    return fn(*args)
+            finally:
+                slots.release()
+
+        try:
+            future = self.executor().submit(fn, *args)
+        except BaseException:
+            slots.release()
+            raise
+        # the slot is held until the job is done, not just until we stop
+        # waiting for it, so timed-out jobs still count against max_pending
+        future.add_done_callback(lambda future: slots.release())
+
+        try:
+            with timed('bcrypt'):
+                return future.result(timeout=self.timeout)
+        except TimeoutError:
+            future.cancel()
+            REJECTED.inc(operation)
+            raise PasswordHashingBusy()
+
+    def hash(self, password):
+        """Hash `password` with the configured cost."""
+
+        if not password:
+            raise ValueError("Password must be non-empty.")
+
+        return self.run('hash', hash_in_worker, password.encode('UTF-8'), self.rounds)
+
+    def check(self, hashed, password):
+        """Is `password` the one `hashed` was made from?"""
+
+        if not password:
+            return False
+
+        return self.run('check', check_in_worker, hashed, password.encode('UTF-8'))
+
+    def needs_rehash(self, hashed):
+        """Was `hashed` made with a cost other than the configured one?"""
+
+        try:
+            return int(hashed.split('$')[2]) != self.rounds
+        except (IndexError, ValueError):
+            return True
+
+
+hasher = PasswordHasher()
+
+
+def init_app(app):
+    """Configure the shared hasher from the app config."""
+
+    app.config.setdefault('BCRYPT_LOG_ROUNDS', 12)
+    app.config.setdefault('BCRYPT_POOL_SIZE', os.cpu_count() or 1)
+    app.config.setdefault('BCRYPT_MAX_PENDING', 4 * app.config['BCRYPT_POOL_SIZE'] or 32)
+    app.config.setdefault('BCRYPT_TIMEOUT', 10)
+
+    hasher.configure(rounds=app.config['BCRYPT_LOG_ROUNDS'],
+                     pool_size=app.config['BCRYPT_POOL_SIZE'],
+                     max_pending=app.config['BCRYPT_MAX_PENDING'],
+                     timeout=app.config['BCRYPT_TIMEOUT'])
@@ -0,0 +1,245 @@
+"""Push new warbles to open home timelines.
+
+`messages_add` calls `notify_message` before it commits. That sends the
+message's id and author with pg_notify, so it's only delivered if the
+message commits. The payload stays small whatever the message and its
+author hold: Postgres refuses payloads over 8000 bytes, and failing that
+would fail the post. Each worker process runs a `Listener` thread that
+LISTENs on the channel. When the author has subscribers in that process,
+the listener renders the message's timeline item (from the fragment
+cache, so once per process) and hands it to the in-process `Hub`. The hub
+passes it to the subscriptions of that author's followers.
+
+Browsers on the homepage hold a `/stream/timeline` Server-Sent Events
+connection (see `timeline_stream` in app.py and static/js/timeline.js)
+that yields events from one subscription; the page prepends them to the
+list instead of reloading. A subscription knows who its user followed when it
+opened. Streams end after EVENTS_STREAM_TIMEOUT seconds and the browser
+reconnects, which picks up new follows. Slow clients whose queue fills up
+are disconnected rather than buffered without bound.
+
+The listener also LISTENs on User.IDENTITY_CHANNEL, where writers (e.g.
+the job that counts a new direct message as unread) announce changed
+users, and drops their cached snapshots from this process's identity
+cache. It starts on a process's first request. After a reconnect it
+clears that cache, since it may have missed notifications meanwhile.
+
+Each open stream occupies a worker thread for its lifetime, so serve the
+app with a threaded (or gevent) worker class.
+"""
+
+import json
+import queue
+import select
+import threading
+from collections import defaultdict
+from time import sleep
+
+from flask import current_app
+from sqlalchemy import func
+from sqlalchemy.orm import joinedload
+
+import fragments
+import identity
+from metrics import Counter
+from models import db, Message, User
+
+EVENTS = Counter('warbler_timeline_events_total',
+                 "Timeline events published, delivered to subscribers, or dropped (subscriber too slow).",
+                 label='outcome')
+
+
+class Subscription:
+    """Events for one open stream: new messages by any of `author_ids`."""
+
+    def __init__(self, user_id, author_ids, maxsize=100):
+        self.user_id = user_id
+        self.author_ids = frozenset(author_ids)
+        self.closed = False
+        self._queue = queue.Queue(maxsize)
+
+    def get(self, timeout):
+        """Wait up to `timeout` seconds for the next event; None if there's none."""
+
+        try:
+            return self._queue.get(timeout=timeout)
+        except queue.Empty:
+            return None
+
+
+class Hub:
+    """In-process fan-out of events to subscriptions, indexed by author."""
+
+    def __init__(self):
+        self._by_author = defaultdict(set)
+        self._lock = threading.Lock()
+
+    def subscribe(self, user_id, author_ids, maxsize=100):
+        subscription = Subscription(user_id, author_ids, maxsize)
+        with self._lock:
+            for author_id in subscription.author_ids:
+                self._by_author[author_id].add(subscription)
+        return subscription
+
+    def unsubscribe(self, subscription):
+        with self._lock:
+            for author_id in subscription.author_ids:
+                subscribers = self._by_author.get(author_id)
+                if subscribers is not None:
+                    subscribers.discard(subscription)
+                    if not subscribers:
+                        del self._by_author[author_id]
+
+    def publish(self, author_id, event):
+        """Queue `event` for every subscription following `author_id`.
+
+        A subscription whose queue is full is closed and dropped; its client
+        reconnects and reloads.
+        """
+
+        with self._lock:
+            subscribers = list(self._by_author.get(author_id, ()))
+
+        for subscription in subscribers:
+            try:
+                subscription._queue.put_nowait(event)
+                EVENTS.inc('delivered')
+            except queue.Full:
+                subscription.closed = True
+                self.unsubscribe(subscription)
+                EVENTS.inc('dropped')
+
+    def subscribed(self, author_id):
+        """Does any subscription follow `author_id`?"""
+
+        with self._lock:
+            return bool(self._by_author.get(author_id))
+
+    def count(self):
+        """Number of open subscriptions."""
+
+        with self._lock:
+            return len({subscription for subscribers in self._by_author.values() for subscription in subscribers})
+
+
+hub = Hub()
+
+
+class Listener(threading.Thread):
+    """LISTENs on `channel` and publishes each notified message that
+someone here follows to `hub`; invalidates cached identities notified on
+User.IDENTITY_CHANNEL. Reconnects after errors."""
+
+    def __init__(self, app, channel, hub):
+        super().__init__(name=f"pubsub-{channel}", daemon=True)
+        self.app = app
+        self.channel = channel
+        self.hub = hub
+        self.logger = app.logger
+        self.ready = threading.Event()
+
+    def run(self):
+        while True:
+            try:
+                self.listen()
+            except Exception:
+                self.ready.clear()
+                self.logger.exception("pubsub listener failed; reconnecting")
+                sleep(1)
+
+    def listen(self):
+        # a connection of its own, outside the pool: it's held for as long
+        # as the process runs
+        with self.app.app_context():
+            proxied = db.engine.raw_connection()
+        conn = proxied.driver_connection
+        proxied.detach()
+        try:
+            conn.autocommit = True
+            conn.cursor().execute(f'LISTEN "{self.channel}"; LISTEN "{User.IDENTITY_CHANNEL}"')
+            # changes while we weren't listening went unannounced
+            identity.clear()
+            self.ready.set()
+
+            while True:
+                if select.select([conn], [], [], 5) == ([], [], []):
+                    continue
+                conn.poll()
+                while conn.notifies:
+                    notification = conn.notifies.pop(0)
+                    if notification.channel == User.IDENTITY_CHANNEL:
+                        for user_id in notification.payload.split(','):
+                            identity.forget(int(user_id))
+                    else:
+                        self.deliver(json.loads(notification.payload))
+        finally:
+            conn.close()
+
+    def deliver(self, notification):
+        """Render and publish a notified message, if anyone here follows its author."""
+
+        if not self.hub.subscribed(notification['author_id']):
+            return
+
+        with self.app.app_context():
+            event = message_event(notification['id'])
+        if event is not None:
+            self.hub.publish(event['author_id'], event)
+
+
+_listener = None
+_listener_lock = threading.Lock()
+
+
+def listen(app):
+    """Start this process's listener thread, if it isn't running yet.
+
+    Called on each request (so it starts after a forking server has
+    forked). Returns the `Listener`.
+    """
+
+    global _listener
+
+    with _listener_lock:
+        if _listener is None or not _listener.is_alive():
+            _listener = Listener(app, app.config['EVENTS_CHANNEL'], hub)
+            _listener.start()
+        return _listener
+
+
+def notify_message(message):
+    """Announce a new, flushed `message` to its author's followers once the
+    current transaction commits."""
+
+    payload = json.dumps(dict(id=message.id, author_id=message.user_id))
+    db.session.execute(func.pg_notify(current_app.config['EVENTS_CHANNEL'], payload).select())
+    EVENTS.inc('published')
+
+
+def message_event(message_id):
+    """The stream event for a new message: its timeline item, without the
+    viewer's like; None if the message is gone."""
+
+    message = db.session.get(Message, message_id, options=[joinedload(Message.user)])
+    if message is None:
+        return None
+
+    buttons = current_app.jinja_env.get_template('fragments/buttons.html').module
+    html = fragments.fragment('fragments/timeline_message.html',
+                              (message.id, message.user.version),
+                              message=message, slot=buttons.like_button(message, ()))
+    return dict(id=message.id, author_id=message.user_id, html=str(html))
+
+
+def init_app(app):
+    """Configure the channel, heartbeat and stream limits for `app`."""
+
+    app.config.setdefault('EVENTS_CHANNEL', 'warbles')
+    app.config.setdefault('EVENTS_HEARTBEAT', 15)
+    app.config.setdefault('EVENTS_STREAM_TIMEOUT', 300)
+    app.config.setdefault('EVENTS_QUEUE_SIZE', 100)
+
+    @app.before_request
+    def start_listener():
+        # identity invalidations must arrive whether or not a stream is open
+        listen(app)
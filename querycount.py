@@ -0,0 +1,54 @@
+"""Per-request SQL statement counting.
+
+Set SQL_STATEMENT_LIMIT in the app config (tests, local development) and
+any request that runs more statements than that fails with
+TooManyQueries, so N+1 query regressions show up in test_*_views.py
+instead of in production. Leave it as None to only count.
+"""
+
+from flask import current_app, g, has_request_context, request
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+
+
+class TooManyQueries(RuntimeError):
+    """A request ran more SQL statements than SQL_STATEMENT_LIMIT allows."""
+
+
+def count_statement(conn, cursor, statement, parameters, context, executemany):
+    """Engine hook: count a statement against the current request."""
+
+    if not has_request_context() or 'sql_statements' not in g:
+        return
+
+    g.sql_statements += 1
+
+    limit = current_app.config['SQL_STATEMENT_LIMIT']
+    if limit is not None and g.sql_statements > limit:
+        raise TooManyQueries(
+            f"{request.method} {request.path} ran more than {limit} SQL statements")
+
+
+def statement_count():
+    """How many SQL statements the current request has run so far."""
+
+    if not has_request_context():
+        return 0
+    return g.get('sql_statements', 0)
+
+
+def init_app(app):
+    """Count the SQL statements each request on `app` runs.
+
+    Call before registering other before_request hooks so their queries
+    are counted too.
+    """
+
+    app.config.setdefault('SQL_STATEMENT_LIMIT', None)
+
+    @app.before_request
+    def reset_statement_count():
+        g.sql_statements = 0
+
+    if not event.contains(Engine, 'before_cursor_execute', count_statement):
+        event.listen(Engine, 'before_cursor_execute', count_statement)
@@ -0,0 +1,108 @@
+"""Read replicas for GET requests.
+
+With REPLICA_DATABASE_URIS set, each GET (or HEAD) request picks one of
+those servers at random and reads from it; every other request, the CLI
+and the job workers use the primary (SQLALCHEMY_DATABASE_URI) only.
+`RoutingSession` does the routing statement by statement:
+
+- a plain SELECT goes to the request's replica;
+- anything else (a flush, INSERT/UPDATE/DELETE, SELECT ... FOR UPDATE,
+  raw SQL) goes to the primary, and so does everything after it in that
+  session, so a GET that writes reads its own writes.
+
+A browser that has just written (any non-GET request, or a GET that wrote)
+reads from the primary for REPLICA_STICKY_SECONDS afterwards, so it sees
+what it did despite replication lag. Keep the window above the replicas'
+usual lag.
+"""
+
+import random
+import threading
+from time import time
+
+from flask import current_app, request, session
+from flask_sqlalchemy.session import Session
+from sqlalchemy import create_engine
+from sqlalchemy.sql import Select
+
+from metrics import Counter
+
+ROUTED = Counter('warbler_db_routed_total', "ORM statements and flushes, by the server they were sent to.",
+                 label='target')
+
+# Flask session key: read from the primary until this time
+STICKY_KEY = '_primary_until'
+
+_engines = {}
+_engines_lock = threading.Lock()
+
+
+def is_read(clause):
+    """Can `clause` run on a replica?"""
+
+    return isinstance(clause, Select) and clause._for_update_arg is None
+
+
+class RoutingSession(Session):
+    """A session that sends reads to `info['replica']`, if set, and the rest
+    to the primary (see the module docstring)."""
+
+    def get_bind(self, mapper=None, clause=None, bind=None, **kwargs):
+        if bind is None:
+            if self._flushing or not is_read(clause):
+                # stay on the primary from here on
+                self.info['replica'] = None
+                self.info['wrote'] = True
+            elif self.info.get('replica') is not None:
+                ROUTED.inc('replica')
+                return self.info['replica']
+
+        ROUTED.inc('primary')
+        return super().get_bind(mapper=mapper, clause=clause, bind=bind, **kwargs)
+
+
+def engines():
+    """The replica engines of the current app, created on first use."""
+
+    uris = current_app.config['REPLICA_DATABASE_URIS']
+
+    with _engines_lock:
+        for uri in uris:
+            if uri not in _engines:
+                options = {**current_app.config.get('SQLALCHEMY_ENGINE_OPTIONS', {}), 'pool_logging_name': 'replica'}
+                _engines[uri] = create_engine(uri, **options)
+        return [_engines[uri] for uri in uris]
+
+
+def init_app(app):
+    """Route `app`'s GET requests to its replicas.
+
+    Call before registering other before_request hooks, so that their
+    queries (e.g. loading the logged-in user) are routed too.
+    """
+
+    app.config.setdefault('REPLICA_DATABASE_URIS', [])
+    app.config.setdefault('REPLICA_STICKY_SECONDS', 5)
+
+    db_session = app.extensions['sqlalchemy'].session
+
+    @app.before_request
+    def choose_database():
+        db_session.info['wrote'] = False
+        if (app.config['REPLICA_DATABASE_URIS']
+                and request.method in ('GET', 'HEAD')
+                and session.get(STICKY_KEY, 0) <= time()):
+            db_session.info['replica'] = random.choice(engines())
+
+    @app.after_request
+    def stick_to_primary(response):
+        if (app.config['REPLICA_DATABASE_URIS']
+                and (request.method not in ('GET', 'HEAD') or db_session.info.get('wrote'))):
+            session[STICKY_KEY] = time() + app.config['REPLICA_STICKY_SECONDS']
+        return response
+
+    @app.teardown_request
+    def forget_replica(exc):
+        # the session can outlive the request (e.g. in an app context the
+        # CLI or a test pushed around several requests)
+        db_session.info['replica'] = None
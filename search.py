@@ -0,0 +1,119 @@
+"""Ranked, paginated search over users and messages.
+
+Users match on a username substring (served by the pg_trgm index on
+users.username) or on words and prefixes in their username, bio and
+location (the users.search_vector GIN index). Messages match on words in
+their text (messages.search_vector, English stemming).
+
+Every match has to be ranked before a page can be cut, so results are
+paged by number, capped at MAX_PAGES.
+"""
+
+import re
+
+from sqlalchemy import case, func, or_
+from sqlalchemy.orm import joinedload
+
+from models import User, Message
+
+PER_PAGE = 30
+MAX_PAGES = 20
+
+
+class Results:
+    """One page of search results."""
+
+    def __init__(self, items, page, has_next):
+        self.items = items
+        self.page = page
+        self.has_next = has_next
+
+    @property
+    def has_prev(self):
+        return self.page > 1
+
+    def __iter__(self):
+        return iter(self.items)
+
+    def __len__(self):
+        return len(self.items)
+
+
+def clamp_page(page):
+    """Turn a `page` query string value into a page number in range."""
+
+    try:
+        page = int(page)
+    except (TypeError, ValueError):
+        return 1
+    return min(max(page, 1), MAX_PAGES)
+
+
+def fetch_page(query, page, per_page):
+    """Fetch page `page` of `query`, noting whether another page follows."""
+
+    rows = query.offset((page - 1) * per_page).limit(per_page + 1).all()
+    return Results(rows[:per_page], page, len(rows) > per_page and page < MAX_PAGES)
+
+
+def prefix_tsquery(search):
+    """Build a tsquery matching every word of `search` as a prefix, or None."""
+
+    words = re.findall(r'\w+', search.lower())
+    if not words:
+        return None
+    return func.to_tsquery('simple', ' & '.join(f"{word}:*" for word in words))
+
+
+def escape_like(search):
+    """Escape LIKE wildcards so `search` matches literally."""
+
+    return search.replace('\\', '\\\\').replace('%', '\\%').replace('_', '\\_')
+
+
+def user_query(search):
+    """Query for users whose username contains `search` or whose profile matches its words.
+
+    Exact and prefix username matches rank first, then full-text rank.
+    """
+
+    pattern = escape_like(search)
+    tsquery = prefix_tsquery(search)
+
+    matches = [User.username.ilike(f"%{pattern}%", escape='\\')]
+    rank = (case((func.lower(User.username) == search.lower(), 2.0), else_=0.0)
+            + case((User.username.ilike(f"{pattern}%", escape='\\'), 1.0), else_=0.0))
+
+    if tsquery is not None:
+        matches.append(User.search_vector.op('@@')(tsquery))
+        rank = rank + func.ts_rank(User.search_vector, tsquery)
+
+    return (User
+            .query
+            .filter(or_(*matches))
+            .order_by(rank.desc(), User.id))
+
+
+def message_query(search):
+    """Query for messages whose text matches `search` (web search syntax), best first."""
+
+    tsquery = func.websearch_to_tsquery('english', search)
+
+    return (Message
+            .query
+            .filter(Message.search_vector.op('@@')(tsquery))
+            .options(joinedload(Message.user).load_only(User.username, User.image_url))
+            .order_by(func.ts_rank(Message.search_vector, tsquery).desc(),
+                      Message.timestamp.desc()))
+
+
+def search_users(search, page=1, per_page=PER_PAGE):
+    """Page `page` of the users matching `search`."""
+
+    return fetch_page(user_query(search), clamp_page(page), per_page)
+
+
+def search_messages(search, page=1, per_page=PER_PAGE):
+    """Page `page` of the messages matching `search`."""
+
+    return fetch_page(message_query(search), clamp_page(page), per_page)
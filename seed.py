@@ -1,20 +1,39 @@
-"""Seed database with sample data from CSV Files."""
+"""Seed database with sample data from CSV Files.
+
+Fine for the small CSVs in generator/; for big ones use
+`flask --app app load-seed`, which streams them in with COPY.
+"""
 
 from csv import DictReader
+
+from sqlalchemy import select
+
 from app import db
-from models import User, Message, Follows
+from commands import reset_sequences
+from models import User, Message, Follows, Likes, DirectMessage, Conversation, TimelineEntry
 
 
 db.drop_all()
 db.create_all()
 
-with open('generator/users.csv') as users:
-    db.session.bulk_insert_mappings(User, DictReader(users))
+for model, filename in [(User, 'users.csv'),
+                        (Message, 'messages.csv'),
+                        (Follows, 'follows.csv'),
+                        (Likes, 'likes.csv'),
+                        (DirectMessage, 'direct_msg.csv')]:
+    with open(f'generator/{filename}') as rows:
+        db.session.bulk_insert_mappings(model, DictReader(rows))
 
-with open('generator/messages.csv') as messages:
-    db.session.bulk_insert_mappings(Message, DictReader(messages))
+# the CSVs carry their own ids
+reset_sequences(db.session.connection())
+db.session.commit()
 
-with open('generator/follows.csv') as follows:
-    db.session.bulk_insert_mappings(Follows, DictReader(follows))
+# Home timelines, conversations and counters are derived data: build them
+# from the seeded follows/messages/likes/direct messages
 
+user_ids = [user_id for (user_id,) in db.session.query(User.id)]
+TimelineEntry.rebuild(user_ids)
+Conversation.rebuild(user_ids)
+User.reconcile_counts(user_ids)
+Message.reconcile_counts(select(Message.id))
 db.session.commit()
@@ -0,0 +1,20 @@
+// Prepend new warbles from followed users to the home timeline as they're
+// posted, from the /stream/timeline Server-Sent Events stream (see pubsub.py).
+(function () {
+  var list = document.getElementById('messages');
+  if (!list || !list.dataset.stream || !window.EventSource) {
+    return;
+  }
+
+  var seen = {};
+  var source = new EventSource(list.dataset.stream);
+
+  source.addEventListener('warble', function (event) {
+    var warble = JSON.parse(event.data);
+    if (seen[warble.id]) {
+      return;
+    }
+    seen[warble.id] = true;
+    list.insertAdjacentHTML('afterbegin', warble.html);
+  });
+})();
@@ -0,0 +1,139 @@
+"""JSON API tests."""
+
+# run these tests like:
+#
+#    python -m unittest test_api.py
+
+import os
+from datetime import datetime, timedelta
+from unittest import TestCase
+
+os.environ['DATABASE_URL'] = "postgresql:///warbler_test"
+
+from flask import g
+
+from app import app, CURR_USER_KEY
+from models import db, User, Message, Follows, Likes, DirectMessage, TimelineEntry
+import fragments
+import identity
+
+db.create_all()
+
+app.config['WTF_CSRF_ENABLED'] = False
+app.config['SQL_STATEMENT_LIMIT'] = 20
+
+
+class ApiTestCase(TestCase):
+    """Test the /api/v1 endpoints."""
+
+    def setUp(self):
+        User.query.delete()
+        identity.clear()
+        fragments.clear()
+
+        self.user = User.signup("testuser", "test@test.com", "password", None)
+        self.other = User.signup("otheruser", "other@test.com", "password", None)
+        self.user.id, self.other.id = 100, 200
+        db.session.commit()
+
+        start = datetime(2023, 1, 1)
+        for i in range(5):
+            db.session.add(Message(id=i + 1, text=f"warble {i + 1}", user_id=200,
+                                   timestamp=start + timedelta(minutes=i)))
+        db.session.flush()
+        for i in range(5):
+            db.session.add(TimelineEntry(user_id=100, message_id=i + 1, author_id=200,
+                                         timestamp=start + timedelta(minutes=i)))
+        db.session.add(Follows(user_being_followed_id=200, user_following_id=100))
+        db.session.add(Likes(user_id=100, message_id=3))
+        db.session.add(DirectMessage(sender_id=200, receiver_id=100, message_text="psst", timestamp=start))
+        db.session.commit()
+
+        self.client = app.test_client()
+        with self.client.session_transaction() as sess:
+            sess[CURR_USER_KEY] = 100
+
+    def tearDown(self):
+        db.session.rollback()
+
+    def test_login_required(self):
+        resp = app.test_client().get('/api/v1/timeline')
+
+        self.assertEqual(resp.status_code, 401)
+        self.assertIn('error', resp.json)
+
+    def test_timeline_pages(self):
+        resp = self.client.get('/api/v1/timeline?limit=2')
+
+        self.assertEqual(resp.status_code, 200)
+        self.assertEqual([m['id'] for m in resp.json['data']], [5, 4])
+        self.assertEqual(resp.json['data'][0]['username'], "otheruser")
+        self.assertEqual(resp.json['data'][0]['timestamp'], "2023-01-01T00:04:00")
+        self.assertEqual(resp.headers['Cache-Control'], 'no-store')
+
+        resp = self.client.get(f"/api/v1/timeline?limit=2&older={resp.json['paging']['older']}")
+        self.assertEqual([m['id'] for m in resp.json['data']], [3, 2])
+
+    def test_fields(self):
+        resp = self.client.get('/api/v1/timeline?fields=id,text&limit=1')
+        self.assertEqual(resp.json['data'], [{'id': 5, 'text': "warble 5"}])
+
+        resp = self.client.get('/api/v1/users/200?fields=username,followers_count')
+        self.assertEqual(resp.json['data'], {'username': "otheruser", 'followers_count': 0})
+
+        resp = self.client.get('/api/v1/timeline?fields=id,password')
+        self.assertEqual(resp.status_code, 400)
+        self.assertIn("password", resp.json['error'])
+
+    def test_since(self):
+        since = self.client.get('/api/v1/timeline').json['paging']['since']
+
+        resp = self.client.get(f'/api/v1/timeline?since={since}')
+        self.assertEqual(resp.json['data'], [])
+        self.assertEqual(resp.json['paging']['since'], since)
+
+        start = datetime(2023, 1, 2)
+        for i in (6, 7, 8):
+            db.session.add(Message(id=i, text=f"warble {i}", user_id=200, timestamp=start + timedelta(minutes=i)))
+            db.session.flush()
+            db.session.add(TimelineEntry(user_id=100, message_id=i, author_id=200,
+                                         timestamp=start + timedelta(minutes=i)))
+        db.session.commit()
+
+        resp = self.client.get(f'/api/v1/timeline?since={since}&limit=2')
+        self.assertEqual([m['id'] for m in resp.json['data']], [7, 6])
+        self.assertIsNotNone(resp.json['paging']['newer'])
+
+        resp = self.client.get(f"/api/v1/timeline?since={resp.json['paging']['since']}&limit=2")
+        self.assertEqual([m['id'] for m in resp.json['data']], [8])
+        self.assertIsNone(resp.json['paging']['newer'])
+
+    def test_lists(self):
+        resp = self.client.get('/api/v1/users/200/followers')
+        self.assertEqual(resp.json['data'], [{'id': 100, 'username': "testuser",
+                                              'image_url': "/static/images/default-pic.png", 'bio': None}])
+
+        resp = self.client.get('/api/v1/users/100/following?fields=id')
+        self.assertEqual(resp.json['data'], [{'id': 200}])
+
+        resp = self.client.get('/api/v1/users/100/likes?fields=id')
+        self.assertEqual(resp.json['data'], [{'id': 3}])
+
+        resp = self.client.get('/api/v1/users/200/messages?fields=id&limit=1')
+        self.assertEqual(resp.json['data'], [{'id': 5}])
+
+        resp = self.client.get('/api/v1/dms?fields=text,sender_username')
+        self.assertEqual(resp.json['data'], [{'text': "psst", 'sender_username': "otheruser"}])
+
+    def test_one_query(self):
+        self.client.get('/api/v1/timeline')  # caches the logged-in user
+
+        with self.client as c:
+            c.get('/api/v1/timeline')
+            self.assertEqual(g.sql_statements, 1)
+
+    def test_errors(self):
+        self.assertEqual(self.client.get('/api/v1/users/999').status_code, 404)
+        self.assertEqual(self.client.get('/api/v1/users/999').json, {'error': "No such user."})
+        self.assertEqual(self.client.get('/api/v1/timeline?older=garbage').status_code, 400)
+        self.assertEqual(self.client.get('/api/v1/timeline?limit=x').status_code, 400)
@@ -0,0 +1,70 @@
+"""Static asset build and serving tests."""
+
+# run these tests like:
+#
+#    python -m unittest test_assets.py
+
+import gzip
+import os
+import tempfile
+from unittest import TestCase
+
+os.environ['DATABASE_URL'] = "postgresql:///warbler_test"
+
+from app import app
+import assets
+
+
+class AssetsTestCase(TestCase):
+    """Test build-assets output and the /assets/ route."""
+
+    def setUp(self):
+        self.dist = tempfile.TemporaryDirectory()
+        self.names = assets.build(app.static_folder, self.dist.name)
+
+        self.saved = (app.config['ASSETS_DIST_DIR'], dict(assets.manifest))
+        app.config['ASSETS_DIST_DIR'] = self.dist.name
+        assets.manifest.clear()
+        assets.manifest.update(self.names)
+
+        self.client = app.test_client()
+
+    def tearDown(self):
+        app.config['ASSETS_DIST_DIR'], manifest = self.saved
+        assets.manifest.clear()
+        assets.manifest.update(manifest)
+        self.dist.cleanup()
+
+    def test_build(self):
+        css_name = self.names['stylesheets/style.css']
+        self.assertRegex(css_name, r'^stylesheets/style\.[0-9a-f]{12}\.css$')
+
+        with open(os.path.join(self.dist.name, css_name)) as css:
+            self.assertIn(f"/assets/{self.names['images/nav-bg.png']}", css.read())
+
+        with gzip.open(os.path.join(self.dist.name, css_name + '.gz')) as compressed:
+            self.assertIn(b'background-image', compressed.read())
+
+        self.assertFalse(os.path.exists(os.path.join(self.dist.name, self.names['images/nav-bg.png'] + '.gz')))
+
+    def test_serving(self):
+        css_url = f"/assets/{self.names['stylesheets/style.css']}"
+        self.assertIn(css_url, self.client.get("/").get_data(as_text=True))
+
+        resp = self.client.get(css_url, headers={'Accept-Encoding': 'gzip, deflate'})
+        self.assertEqual(resp.status_code, 200)
+        self.assertEqual(resp.headers['Content-Encoding'], 'gzip')
+        self.assertEqual(resp.headers['Cache-Control'], 'public, max-age=31536000, immutable')
+        self.assertIn('Accept-Encoding', resp.headers['Vary'])
+        self.assertTrue(resp.content_type.startswith('text/css'))
+        self.assertIn(b'background-image', gzip.decompress(resp.get_data()))
+        resp.close()
+
+        resp = self.client.get(css_url)
+        self.assertNotIn('Content-Encoding', resp.headers)
+        self.assertIn(b'background-image', resp.get_data())
+        resp.close()
+
+        resp = self.client.get("/assets/stylesheets/style.000000000000.css")
+        self.assertEqual(resp.status_code, 404)
+        self.assertEqual(resp.headers['Cache-Control'], 'no-store')
@@ -0,0 +1,92 @@
+"""Connection pool telemetry and statement timeout tests."""
+
+# run these tests like:
+#
+#    python -m unittest test_dbpool.py
+
+import os
+from unittest import TestCase
+
+from sqlalchemy import create_engine, exc, text
+
+os.environ['DATABASE_URL'] = "postgresql:///warbler_test"
+
+from app import app
+from models import db
+import dbpool
+import metrics
+
+db.create_all()
+
+
+class PoolTelemetryTestCase(TestCase):
+    """Test checkout, overflow and timeout recording."""
+
+    def test_overflow_and_timeout(self):
+        engine = create_engine(app.config['SQLALCHEMY_DATABASE_URI'], poolclass=dbpool.InstrumentedQueuePool,
+                               pool_logging_name='test', pool_size=1, max_overflow=1, pool_timeout=.1)
+        try:
+            first = engine.connect()
+            second = engine.connect()
+            self.assertEqual(dbpool.pool_stats(dbpool.QueuePool.checkedout)['test'], 2)
+
+            with self.assertRaises(exc.TimeoutError):
+                engine.connect()
+
+            self.assertEqual(dbpool.OVERFLOWS._series['test'], 1)
+            self.assertEqual(dbpool.TIMEOUTS._series['test'], 1)
+            self.assertEqual(dbpool.CHECKOUT_DURATION.totals()['test'][0], 3)
+
+            exposed = metrics.expose()
+            self.assertIn('warbler_db_pool_checked_out{pool="test"} 2', exposed)
+            self.assertIn('warbler_db_pool_overflowing{pool="test"} 1', exposed)
+
+            first.close()
+            second.close()
+
+            # a recreated pool counts its own overflow, once
+            engine.dispose()
+            first = engine.connect()
+            second = engine.connect()
+            self.assertEqual(dbpool.OVERFLOWS._series['test'], 2)
+            first.close()
+            second.close()
+        finally:
+            engine.dispose()
+
+    def test_app_pool(self):
+        self.assertIsInstance(db.engine.pool, dbpool.InstrumentedQueuePool)
+        self.assertEqual(db.engine.pool.label, 'primary')
+
+
+class StatementTimeoutTestCase(TestCase):
+    """Test per-endpoint statement_timeout."""
+
+    def tearDown(self):
+        db.session.rollback()
+
+    def show_timeout(self, path):
+        db.session.rollback()
+        with app.test_request_context(path):
+            timeout = db.session.execute(text("SHOW statement_timeout")).scalar()
+            db.session.rollback()
+        return timeout
+
+    def test_per_endpoint(self):
+        self.assertEqual(self.show_timeout('/users'), '1s')
+        self.assertEqual(self.show_timeout('/'), '5s')
+
+        # only requests are limited, and only for their own transactions
+        self.assertEqual(db.session.execute(text("SHOW statement_timeout")).scalar(), '0')
+
+    def test_slow_statement_cancelled(self):
+        app.config['STATEMENT_TIMEOUTS']['homepage'] = 50
+        try:
+            with app.test_request_context('/'):
+                with self.assertRaises(exc.OperationalError) as raised:
+                    db.session.execute(text("SELECT pg_sleep(1)"))
+                db.session.rollback()
+        finally:
+            del app.config['STATEMENT_TIMEOUTS']['homepage']
+
+        self.assertIsInstance(raised.exception.orig, dbpool.QueryCanceled)
@@ -0,0 +1,191 @@
+"""Background job queue tests."""
+
+# run these tests like:
+#
+#    python -m unittest test_jobs.py
+
+import os
+import threading
+from datetime import datetime, timedelta
+from unittest import TestCase
+
+os.environ['DATABASE_URL'] = "postgresql:///warbler_test"
+
+from app import app
+from models import db, User, Message, Follows, Job, TimelineEntry, AccountDeletion
+import jobs
+
+db.create_all()
+
+calls = []
+
+
+@jobs.handler('test_record')
+def record(value):
+    calls.append(value)
+
+
+@jobs.handler('test_fail')
+def fail():
+    raise RuntimeError("boom")
+
+
+class JobsTestCase(TestCase):
+    """Test enqueueing, claiming, retrying and running jobs."""
+
+    def setUp(self):
+        Job.query.delete()
+        User.query.delete()
+        AccountDeletion.query.delete()
+        db.session.commit()
+        calls.clear()
+        app.config['JOBS_INLINE'] = False
+
+    def tearDown(self):
+        db.session.rollback()
+        Job.query.delete()
+        db.session.commit()
+
+    def test_enqueue_and_run(self):
+        author = User.signup('author', 'author@email.com', 'password', None)
+        reader = User.signup('reader', 'reader@email.com', 'password', None)
+        db.session.commit()
+        db.session.add(Follows(user_being_followed_id=author.id, user_following_id=reader.id))
+        message = Message(text="queued warble", user_id=author.id)
+        db.session.add(message)
+        db.session.flush()
+        jobs.enqueue('fan_out', message_id=message.id)
+        db.session.commit()
+
+        self.assertEqual(Job.query.one().payload, {'message_id': message.id})
+        self.assertEqual(TimelineEntry.query.count(), 0)
+
+        self.assertTrue(jobs.run_one())
+        self.assertFalse(jobs.run_one())
+
+        self.assertEqual(Job.query.count(), 0)
+        self.assertEqual(TimelineEntry.query.one().user_id, reader.id)
+        self.assertGreaterEqual(jobs.JOBS_SUCCEEDED._series['fan_out'], 1)
+
+    def test_inline(self):
+        app.config['JOBS_INLINE'] = True
+        self.assertIsNone(jobs.enqueue('test_record', value=1))
+        self.assertEqual(calls, [1])
+        self.assertEqual(Job.query.count(), 0)
+
+        with self.assertRaises(ValueError):
+            jobs.enqueue('no_such_job')
+
+    def test_inline_purge_loops(self):
+        user = User.signup('gone', 'gone@email.com', 'password', None)
+        db.session.flush()
+        for number in range(5):
+            db.session.add(Message(text=f"warble {number}", user_id=user.id))
+        deletion = AccountDeletion.start(user.id)
+        db.session.commit()
+
+        purge, runs = jobs.HANDLERS['purge_account'], []
+
+        def counted(**payload):
+            runs.append(payload)
+            purge(**payload)
+
+        app.config['JOBS_INLINE'] = True
+        app.config['ACCOUNT_PURGE_BATCH_SIZE'] = 1
+        jobs.HANDLERS['purge_account'] = counted
+        try:
+            jobs.enqueue('purge_account', user_id=user.id)
+        finally:
+            jobs.HANDLERS['purge_account'] = purge
+            app.config['ACCOUNT_PURGE_BATCH_SIZE'] = 1000
+        db.session.commit()
+
+        # every batch in one call, none queued
+        self.assertEqual(len(runs), 1)
+        self.assertIsNotNone(deletion.finished_at)
+        self.assertEqual(deletion.rows_deleted, 6)
+        self.assertEqual(Job.query.count(), 0)
+
+    def test_retry_with_backoff(self):
+        job = jobs.enqueue('test_fail')
+        job.max_attempts = 2
+        db.session.commit()
+        job_id = job.id
+
+        self.assertTrue(jobs.run_one())
+        job = Job.query.get(job_id)
+        self.assertEqual((job.status, job.attempts), ('queued', 1))
+        self.assertIn("boom", job.last_error)
+        self.assertGreater(job.run_at, datetime.utcnow())
+
+        # not due yet
+        self.assertFalse(jobs.run_one())
+
+        job.run_at = datetime.utcnow() - timedelta(seconds=1)
+        db.session.commit()
+        self.assertTrue(jobs.run_one())
+
+        job = Job.query.get(job_id)
+        self.assertEqual((job.status, job.attempts), ('failed', 2))
+        self.assertFalse(jobs.run_one())
+        self.assertGreaterEqual(jobs.JOBS_DEAD._series['test_fail'], 1)
+
+    def test_claims_skip_locked_jobs(self):
+        for value in (1, 2):
+            jobs.enqueue('test_record', value=value)
+        db.session.commit()
+
+        claimed = jobs.claim()
+        other = []
+
+        def claim_elsewhere():
+            with app.app_context():
+                other.append(jobs.claim().payload['value'])
+                db.session.rollback()
+
+        thread = threading.Thread(target=claim_elsewhere)
+        thread.start()
+        thread.join(timeout=10)
+
+        self.assertEqual(claimed.payload['value'], 1)
+        self.assertEqual(other, [2])
+        db.session.rollback()
+
+    def test_unfollow_waits_for_fan_out(self):
+        author = User.signup('author', 'author@email.com', 'password', None)
+        reader = User.signup('reader', 'reader@email.com', 'password', None)
+        db.session.commit()
+        author_id, reader_id = author.id, reader.id
+        db.session.add(Follows(user_being_followed_id=author_id, user_following_id=reader_id))
+        message = Message(text="racing warble", user_id=author_id)
+        db.session.add(message)
+        db.session.commit()
+
+        # the fan-out has inserted but not committed when the unfollow lands
+        jobs.fan_out(message_id=message.id)
+
+        def unfollow():
+            with app.app_context():
+                Follows.query.filter_by(user_being_followed_id=author_id, user_following_id=reader_id).delete()
+                db.session.commit()
+                jobs.remove_follow(follower_id=reader_id, followed_id=author_id)
+                db.session.commit()
+
+        thread = threading.Thread(target=unfollow)
+        thread.start()
+        thread.join(timeout=1)
+        db.session.commit()
+        thread.join(timeout=10)
+
+        self.assertFalse(thread.is_alive())
+        self.assertEqual(TimelineEntry.query.filter_by(user_id=reader_id).count(), 0)
+
+    def test_worker_burst(self):
+        for value in range(10):
+            jobs.enqueue('test_record', value=value)
+        db.session.commit()
+
+        jobs.Worker(app, threads=3, poll_interval=.1).run(burst=True)
+
+        self.assertEqual(sorted(calls), list(range(10)))
+        self.assertEqual(Job.query.count(), 0)
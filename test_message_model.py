@@ -7,7 +7,7 @@
 import os
 from unittest import TestCase
 from sqlalchemy import exc
-from models import db, User, Message, Likes
+from models import db, User, Message, Likes, DirectMessage, Conversation, AccountDeletion
 
 # BEFORE we import our app, let's set an environmental variable
 # to use a different database for tests (we need to do this
@@ -93,4 +93,85 @@ class MessageModelTestCase(TestCase):
         db.session.delete(msg)
         db.session.commit()
         
-        self.assertEqual(len(reader.likes), 0)
\ No newline at end of file
+        self.assertEqual(len(reader.likes), 0)
+
+    def test_toggle_like(self):
+
+        msg = Message(text="liked by many", user_id=self.user.id)
+        db.session.add(msg)
+        readers = [User.signup(f'reader{i}', f'reader{i}@email.com', 'password', None) for i in range(2)]
+        db.session.commit()
+
+        # every reader can like the same message, once
+        for reader in readers:
+            self.assertTrue(Likes.toggle(reader.id, msg.id))
+        db.session.commit()
+
+        self.assertEqual(msg.likes_count, 2)
+        self.assertEqual(readers[0].likes_count, 1)
+        self.assertEqual(readers[0].liked_ids([msg.id, 12345]), {msg.id})
+
+        self.assertFalse(Likes.toggle(readers[0].id, msg.id))
+        db.session.commit()
+
+        self.assertEqual(msg.likes_count, 1)
+        self.assertEqual(readers[0].likes_count, 0)
+        self.assertEqual(readers[0].liked_ids([msg.id]), set())
+        self.assertEqual(Likes.query.filter_by(message_id=msg.id).count(), 1)
+
+        msg.likes_count = 7
+        db.session.commit()
+        Message.reconcile_counts([msg.id])
+        db.session.commit()
+        self.assertEqual(msg.likes_count, 1)
+
+
+    def test_conversation_counts(self):
+
+        other = User.signup('other', 'other@email.com', 'password', None)
+        db.session.commit()
+
+        for sender, receiver, text in [(self.user, other, "hello"),
+                                       (self.user, other, "are you there?"),
+                                       (other, self.user, "yes")]:
+            reply = DirectMessage.sentMessage(sender.id, receiver.id, text)
+            Conversation.add_message(reply)
+        db.session.commit()
+
+        mine = Conversation.query.get((self.user.id, other.id))
+        theirs = Conversation.query.get((other.id, self.user.id))
+        self.assertEqual(mine.last_message_id, reply.id)
+        self.assertEqual(theirs.last_message_id, reply.id)
+        self.assertEqual((mine.unread_count, theirs.unread_count), (1, 2))
+        self.assertEqual((self.user.unread_count, other.unread_count), (1, 2))
+
+        self.assertEqual(Conversation.mark_read(other.id, self.user.id), 2)
+        self.assertEqual(Conversation.mark_read(other.id, self.user.id), 0)
+        db.session.commit()
+        self.assertEqual((theirs.unread_count, other.unread_count), (0, 0))
+        self.assertEqual([m.message_text for m in DirectMessage.thread(other.id, self.user.id)
+                                                                .order_by(DirectMessage.id)],
+                         ["hello", "are you there?", "yes"])
+
+        # purging the sender takes their messages out of the unread total
+        deletion = AccountDeletion.start(other.id)
+        while deletion.purge(batch_size=100) is not None:
+            pass
+        db.session.commit()
+        self.assertEqual(self.user.unread_count, 0)
+        self.assertEqual(Conversation.query.count(), 0)
+
+    def test_rebuild_conversations(self):
+
+        other = User.signup('other', 'other@email.com', 'password', None)
+        db.session.commit()
+        db.session.add_all([DirectMessage(sender_id=self.user.id, receiver_id=other.id, message_text="a"),
+                            DirectMessage(sender_id=other.id, receiver_id=self.user.id, message_text="b")])
+        db.session.commit()
+
+        self.assertEqual(Conversation.rebuild([self.user.id, other.id]), 2)
+        db.session.commit()
+
+        mine = Conversation.query.get((self.user.id, other.id))
+        self.assertEqual(mine.last_message.message_text, "b")
+        self.assertEqual(mine.unread_count, 0)
@@ -4,10 +4,14 @@
 #
 #    FLASK_ENV=production python -m unittest test_message_views.py
 
+import base64
 import os
+import re
+import time
+from datetime import datetime
 from unittest import TestCase
 
-from models import db, connect_db, Message, User
+from models import db, connect_db, Message, User, Follows, TimelineEntry, DirectMessage, Conversation
 
 # BEFORE we import our app, let's set an environmental variable
 # to use a different database for tests (we need to do this
@@ -19,7 +23,12 @@ os.environ['DATABASE_URL'] = "postgresql:///warbler_test"
 
 # Now we can import app
 
+from flask import g
+
 from app import app, CURR_USER_KEY
+import fragments
+import identity
+import jobs
 
 # Create our tables (we do this here, so we only create the tables
 # once for all tests --- in each test, we'll delete the data
@@ -31,6 +40,16 @@ db.create_all()
 
 app.config['WTF_CSRF_ENABLED'] = False
 
+# Fail any request that runs more SQL statements than this, so N+1 queries
+# in the views show up as test failures
+
+app.config['SQL_STATEMENT_LIMIT'] = 20
+
+# Run background jobs (timeline fan-out, ...) inside the request, so views
+# can be checked without a worker
+
+app.config['JOBS_INLINE'] = True
+
 class MessageViewTestCase(TestCase):
     """Test views for messages."""
 
@@ -38,6 +57,8 @@ class MessageViewTestCase(TestCase):
         """Create test client, add sample data."""
 
         User.query.delete()
+        identity.clear()
+        fragments.clear()
         Message.query.delete()
 
         self.client = app.test_client()
@@ -163,3 +184,269 @@ class MessageViewTestCase(TestCase):
             
             msg = Message.query.get(5678)
             self.assertIsNotNone(msg)
+
+
+    def test_add_message_fans_out(self):
+        """Does a new message land on the followers' home timelines?"""
+
+        follower = User.signup('follower', 'follower@email.com', 'password', None)
+        follower.id = 300
+        db.session.commit()
+        db.session.add(Follows(user_being_followed_id=self.testuser_id, user_following_id=300))
+        db.session.commit()
+
+        with self.client as c:
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = self.testuser_id
+
+            c.post("/messages/new", data={"text": "Fanned out warble"})
+
+            msg = Message.query.one()
+            entry = TimelineEntry.query.one()
+            self.assertEqual(entry.user_id, 300)
+            self.assertEqual(entry.message_id, msg.id)
+            self.assertEqual(entry.author_id, self.testuser_id)
+
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = 300
+
+            resp = c.get("/")
+            self.assertIn("Fanned out warble", str(resp.data))
+
+    def test_message_delete_clears_timelines(self):
+        self.setup_messages()
+
+        follower = User.signup('follower', 'follower@email.com', 'password', None)
+        follower.id = 300
+        db.session.commit()
+        db.session.add(Follows(user_being_followed_id=self.testuser_id, user_following_id=300))
+        db.session.commit()
+        TimelineEntry.rebuild([300])
+        db.session.commit()
+        self.assertEqual(TimelineEntry.query.count(), 2)
+
+        with self.client as c:
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = self.testuser_id
+
+            c.post("/messages/5678/delete")
+
+            entries = TimelineEntry.query.all()
+            self.assertEqual([e.message_id for e in entries], [1234])
+
+
+    def test_user_messages_pagination(self):
+        """Can we walk a user's messages with older/newer cursors?"""
+
+        db.session.add_all([
+            Message(text=f"warble number {i}", user_id=self.testuser_id,
+                    timestamp=datetime(2023, 1, i + 1))
+            for i in range(3)
+        ])
+        db.session.commit()
+
+        app.config['MESSAGES_PER_PAGE'] = 2
+        try:
+            with self.client as c:
+                resp = c.get(f"/users/{self.testuser_id}")
+                html = resp.get_data(as_text=True)
+                self.assertIn("warble number 2", html)
+                self.assertIn("warble number 1", html)
+                self.assertNotIn("warble number 0", html)
+
+                older = re.search(r'href="([^"]*older=[^"]*)"', html).group(1)
+                html = c.get(older).get_data(as_text=True)
+                self.assertIn("warble number 0", html)
+                self.assertNotIn("warble number 1", html)
+
+                newer = re.search(r'href="([^"]*newer=[^"]*)"', html).group(1)
+                html = c.get(newer).get_data(as_text=True)
+                self.assertIn("warble number 2", html)
+                self.assertIn("warble number 1", html)
+                self.assertNotIn("warble number 0", html)
+        finally:
+            app.config['MESSAGES_PER_PAGE'] = 100
+
+    def test_invalid_cursor(self):
+        with self.client as c:
+            resp = c.get(f"/users/{self.testuser_id}?older=not-a-cursor")
+            self.assertEqual(resp.status_code, 400)
+
+            # an infinite id, and one beyond int4
+            for raw in ('["2020-01-01T00:00:00", 1e400]', '["2020-01-01T00:00:00", 2147483648]'):
+                cursor = base64.urlsafe_b64encode(raw.encode()).decode()
+                resp = c.get(f"/users/{self.testuser_id}?older={cursor}")
+                self.assertEqual(resp.status_code, 400)
+
+    def test_timelines_do_not_query_per_row(self):
+        """Do the homepage and DM inbox load authors without a query per row?"""
+
+        authors = [User.signup(f'author{i}', f'author{i}@email.com', 'password', None)
+                   for i in range(30)]
+        db.session.commit()
+        db.session.add_all([Follows(user_being_followed_id=author.id, user_following_id=self.testuser_id)
+                            for author in authors])
+        db.session.add_all([Message(text=f"warble by {author.username}", user_id=author.id)
+                            for author in authors])
+        for author in authors:
+            Conversation.add_message(DirectMessage.sentMessage(author.id, self.testuser_id,
+                                                               f"hi from {author.username}"))
+        db.session.commit()
+        TimelineEntry.rebuild([self.testuser_id])
+        db.session.commit()
+
+        app.config['SQL_STATEMENT_LIMIT'] = 8
+        try:
+            with self.client as c:
+                with c.session_transaction() as sess:
+                    sess[CURR_USER_KEY] = self.testuser_id
+
+                resp = c.get("/")
+                self.assertEqual(resp.status_code, 200)
+                self.assertIn("@author29", str(resp.data))
+
+                resp = c.get("/messages/private")
+                self.assertEqual(resp.status_code, 200)
+                self.assertIn("@author29", str(resp.data))
+        finally:
+            app.config['SQL_STATEMENT_LIMIT'] = 20
+
+    def test_message_show_conditional_get(self):
+        """Does a repeat view get a 304 from one query, until the message is liked?"""
+
+        self.setup_messages()
+        reader = User.signup("reader", "reader@test.com", "password", None)
+        db.session.commit()
+        reader_id = reader.id
+
+        with self.client as c:
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = reader_id
+
+            resp = c.get("/messages/1234")
+            etag = resp.headers['ETag']
+            self.assertEqual(resp.headers['Cache-Control'], 'private, no-cache')
+            self.assertIn('Cookie', resp.headers['Vary'])
+
+            resp = c.get("/messages/1234", headers={'If-None-Match': etag})
+            self.assertEqual(resp.status_code, 304)
+            self.assertEqual(resp.get_data(), b'')
+            self.assertEqual(g.sql_statements, 1)
+
+            c.post("/users/add_like/1234")
+            resp = c.get("/messages/1234", headers={'If-None-Match': etag})
+            self.assertEqual(resp.status_code, 200)
+            self.assertNotEqual(resp.headers['ETag'], etag)
+
+    def test_cache_control_by_route(self):
+        self.assertEqual(self.client.get("/static/stylesheets/style.css").headers['Cache-Control'],
+                         'public, max-age=3600')
+        self.assertEqual(self.client.get("/").headers['Cache-Control'], 'no-store')
+
+    def test_timeline_fragments(self):
+        """Are message fragments reused across viewers, with each viewer's own like button?"""
+
+        self.setup_messages()
+        readers = [User.signup(f"reader{i}", f"reader{i}@test.com", "password", None) for i in range(2)]
+        db.session.commit()
+        reader_ids = [reader.id for reader in readers]
+        for reader_id in reader_ids:
+            db.session.add(Follows(user_being_followed_id=self.testuser_id, user_following_id=reader_id))
+        db.session.commit()
+        TimelineEntry.rebuild(reader_ids)
+        db.session.commit()
+
+        with self.client as c:
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = reader_ids[0]
+            c.post("/users/add_like/1234")
+            html = c.get("/").get_data(as_text=True)
+            self.assertEqual(html.count("btn-primary"), 1)
+            self.assertEqual(fragments.cache.misses, 2)
+
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = reader_ids[1]
+            html = c.get("/").get_data(as_text=True)
+            self.assertNotIn("btn-primary", html)
+            self.assertIn("something about warble", html)
+            self.assertEqual(fragments.cache.hits, 2)
+
+            # the count is in the like button, so a like doesn't re-render the item
+            c.post("/users/add_like/1234")
+            html = c.get("/").get_data(as_text=True)
+            self.assertIn('<i class="fa fa-thumbs-up"></i> 2', html)
+            self.assertEqual(fragments.cache.misses, 2)
+
+    def test_fragment_cache_eviction(self):
+        cache = fragments.FragmentCache(maxsize=2)
+        for key in range(3):
+            cache.put(key, f"<li>{key}</li>")
+
+        self.assertIsNone(cache.get(0))
+        self.assertEqual(cache.get(2), "<li>2</li>")
+
+
+    def test_conversations(self):
+        """Does the inbox list conversations with unread counts that reading the thread clears?"""
+
+        other = User.signup('olga', 'olga@email.com', 'password', None)
+        db.session.commit()
+        other_id = other.id
+
+        with self.client as c:
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = other_id
+            c.post(f"/users/sendTo/{self.testuser_id}", data={"text": "first"})
+            resp = c.post(f"/users/sendTo/{self.testuser_id}", data={"text": "second"})
+            self.assertEqual(resp.location, f"/messages/private/{self.testuser_id}")
+
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = self.testuser_id
+
+            html = c.get("/messages/private").get_data(as_text=True)
+            self.assertIn("@olga", html)
+            self.assertIn("2 new", html)
+            self.assertIn("second", html)
+            self.assertNotIn("first", html)
+            self.assertIn('id="unread-count">2<', html)
+
+            html = c.get(f"/messages/private/{other_id}").get_data(as_text=True)
+            self.assertIn("first", html)
+            self.assertIn("second", html)
+            self.assertNotIn('id="unread-count"', html)
+
+            self.assertNotIn("new</span>", c.get("/messages/private").get_data(as_text=True))
+            self.assertEqual(User.query.get(self.testuser_id).unread_count, 0)
+
+    def test_unread_count_after_worker(self):
+        """Does the navbar show a direct message the worker counted after the
+        receiver's snapshot was cached?"""
+
+        other = User.signup('olga', 'olga@email.com', 'password', None)
+        db.session.commit()
+        other_id = other.id
+
+        app.config['JOBS_INLINE'] = False
+        try:
+            with self.client as c:
+                with c.session_transaction() as sess:
+                    sess[CURR_USER_KEY] = self.testuser_id
+                self.assertNotIn('id="unread-count"', c.get("/users").get_data(as_text=True))
+
+                with c.session_transaction() as sess:
+                    sess[CURR_USER_KEY] = other_id
+                c.post(f"/users/sendTo/{self.testuser_id}", data={"text": "queued"})
+
+                with c.session_transaction() as sess:
+                    sess[CURR_USER_KEY] = self.testuser_id
+                self.assertNotIn('id="unread-count"', c.get("/users").get_data(as_text=True))
+
+                jobs.Worker(app, threads=1, poll_interval=.1).run(burst=True)
+                # the worker's notification reaches this process's listener
+                for _ in range(50):
+                    if identity.cache.get(self.testuser_id) is None:
+                        break
+                    time.sleep(.1)
+                self.assertIn('id="unread-count">1<', c.get("/users").get_data(as_text=True))
+        finally:
+            app.config['JOBS_INLINE'] = True
@@ -0,0 +1,100 @@
+"""Request metrics tests."""
+
+# run these tests like:
+#
+#    python -m unittest test_metrics.py
+
+import os
+from unittest import TestCase
+
+from flask import g
+
+from models import db, User
+from metrics import Histogram, REGISTRY, SQL_STATEMENTS
+
+# BEFORE we import our app, let's set an environmental variable
+# to use a different database for tests (we need to do this
+# before we import our app, since that will have already
+# connected to the database
+
+os.environ['DATABASE_URL'] = "postgresql:///warbler_test"
+
+
+# Now we can import app
+
+from app import app
+import identity
+
+db.create_all()
+
+app.config['WTF_CSRF_ENABLED'] = False
+
+
+class MetricsTestCase(TestCase):
+    """Test request instrumentation and the /metrics endpoint."""
+
+    def setUp(self):
+        User.query.delete()
+        identity.clear()
+
+        self.client = app.test_client()
+
+        self.testuser = User.signup(username="testuser",
+                                    email="test@test.com",
+                                    password="testuser",
+                                    image_url=None)
+        self.testuser.id = 340
+        db.session.commit()
+
+    def tearDown(self):
+        db.session.rollback()
+
+    def test_histogram(self):
+        histogram = Histogram('test_seconds', "A test histogram.", (0.1, 1))
+        REGISTRY.remove(histogram)
+
+        histogram.observe('home', 0.05)
+        histogram.observe('home', 0.5)
+        histogram.observe('home', 5)
+
+        lines = list(histogram.expose())
+        self.assertIn('# TYPE test_seconds histogram', lines)
+        self.assertIn('test_seconds_bucket{endpoint="home",le="0.1"} 1', lines)
+        self.assertIn('test_seconds_bucket{endpoint="home",le="1"} 2', lines)
+        self.assertIn('test_seconds_bucket{endpoint="home",le="+Inf"} 3', lines)
+        self.assertIn('test_seconds_sum{endpoint="home"} 5.55', lines)
+        self.assertIn('test_seconds_count{endpoint="home"} 3', lines)
+        self.assertEqual(histogram.totals(), {'home': (3, 5.55)})
+
+    def test_metrics_endpoint(self):
+        """Are SQL, render and bcrypt timings recorded per endpoint?"""
+
+        with self.client as c:
+            c.get(f"/users/{self.testuser.id}")
+            c.post("/login/", data={"username": "testuser", "password": "testuser"})
+
+            resp = c.get("/metrics")
+            self.assertEqual(resp.status_code, 200)
+            self.assertTrue(resp.content_type.startswith("text/plain"))
+
+            text = resp.get_data(as_text=True)
+            self.assertIn('warbler_request_duration_seconds_count{endpoint="users_show"}', text)
+            self.assertIn('warbler_request_sql_statements_count{endpoint="users_show"}', text)
+            self.assertIn('warbler_request_render_seconds_count{endpoint="users_show"}', text)
+            self.assertIn('warbler_response_size_bytes_count{endpoint="users_show"}', text)
+
+            bcrypt_sum = [line for line in text.splitlines()
+                          if line.startswith('warbler_request_bcrypt_seconds_sum{endpoint="login"}')]
+            self.assertTrue(bcrypt_sum)
+            self.assertGreater(float(bcrypt_sum[0].split()[-1]), 0)
+
+    def test_sql_statements_match_querycount(self):
+        """Is each statement counted once, the same as querycount sees it?"""
+
+        with self.client as c:
+            before = SQL_STATEMENTS.totals().get('users_show', (0, 0))[1]
+            c.get(f"/users/{self.testuser.id}")
+            counted = g.sql_statements
+
+        self.assertGreater(counted, 0)
+        self.assertEqual(SQL_STATEMENTS.totals()['users_show'][1] - before, counted)
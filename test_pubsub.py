@@ -0,0 +1,137 @@
+"""Timeline push (pub/sub hub, LISTEN/NOTIFY and SSE stream) tests."""
+
+# run these tests like:
+#
+#    python -m unittest test_pubsub.py
+
+import json
+import os
+from unittest import TestCase
+
+os.environ['DATABASE_URL'] = "postgresql:///warbler_test"
+
+from app import app, CURR_USER_KEY
+from models import db, User, Message, Follows
+import fragments
+import identity
+import pubsub
+
+db.create_all()
+
+app.config['WTF_CSRF_ENABLED'] = False
+app.config['SQL_STATEMENT_LIMIT'] = 20
+
+
+class HubTestCase(TestCase):
+    """Test in-process fan-out."""
+
+    def test_publish_to_followers(self):
+        hub = pubsub.Hub()
+        follower = hub.subscribe(1, [10, 11])
+        other = hub.subscribe(2, [12])
+
+        hub.publish(10, {'id': 5})
+
+        self.assertEqual(follower.get(timeout=0), {'id': 5})
+        self.assertIsNone(other.get(timeout=0))
+
+        hub.unsubscribe(follower)
+        hub.publish(11, {'id': 6})
+        self.assertIsNone(follower.get(timeout=0))
+        self.assertEqual(hub.count(), 1)
+
+    def test_slow_subscriber_dropped(self):
+        hub = pubsub.Hub()
+        slow = hub.subscribe(1, [10], maxsize=1)
+
+        hub.publish(10, {'id': 1})
+        hub.publish(10, {'id': 2})
+
+        self.assertTrue(slow.closed)
+        self.assertEqual(hub.count(), 0)
+
+
+class TimelineStreamTestCase(TestCase):
+    """Test that posted messages reach followers' streams."""
+
+    def setUp(self):
+        User.query.delete()
+        identity.clear()
+        fragments.clear()
+
+        self.author = User.signup("author", "author@test.com", "password", None)
+        self.reader = User.signup("reader", "reader@test.com", "password", None)
+        db.session.commit()
+        db.session.add(Follows(user_being_followed_id=self.author.id, user_following_id=self.reader.id))
+        db.session.commit()
+        self.author_id, self.reader_id = self.author.id, self.reader.id
+
+        self.client = app.test_client()
+
+    def tearDown(self):
+        db.session.rollback()
+
+    def test_anonymous(self):
+        self.assertEqual(self.client.get('/stream/timeline').status_code, 401)
+
+    def test_posted_message_notifies_followers(self):
+        pubsub.listen(app).ready.wait(5)
+        subscription = pubsub.hub.subscribe(self.reader_id, [self.author_id])
+        try:
+            with self.client.session_transaction() as sess:
+                sess[CURR_USER_KEY] = self.author_id
+            self.client.post("/messages/new", data={"text": "hot off the press"})
+
+            event = subscription.get(timeout=5)
+        finally:
+            pubsub.hub.unsubscribe(subscription)
+
+        message = Message.query.one()
+        self.assertEqual(event['id'], message.id)
+        self.assertEqual(event['author_id'], self.author_id)
+        self.assertIn("hot off the press", event['html'])
+        self.assertIn("@author", event['html'])
+
+    def test_long_author_fields(self):
+        """Does a post still go out when the rendered item would overflow pg_notify?"""
+
+        self.author.image_url = "/static/images/" + "x" * 9000 + ".png"
+        db.session.commit()
+
+        pubsub.listen(app).ready.wait(5)
+        subscription = pubsub.hub.subscribe(self.reader_id, [self.author_id])
+        try:
+            with self.client.session_transaction() as sess:
+                sess[CURR_USER_KEY] = self.author_id
+            resp = self.client.post("/messages/new", data={"text": "long avatar"})
+
+            event = subscription.get(timeout=5)
+        finally:
+            pubsub.hub.unsubscribe(subscription)
+
+        self.assertEqual(resp.status_code, 302)
+        self.assertEqual(Message.query.one().text, "long avatar")
+        self.assertIn("x" * 9000, event['html'])
+
+    def test_stream(self):
+        app.config['EVENTS_STREAM_TIMEOUT'] = 0.5
+        app.config['EVENTS_HEARTBEAT'] = 0.2
+        try:
+            with self.client.session_transaction() as sess:
+                sess[CURR_USER_KEY] = self.reader_id
+            resp = self.client.get('/stream/timeline')
+
+            self.assertEqual(resp.mimetype, 'text/event-stream')
+            self.assertEqual(resp.headers['Cache-Control'], 'no-store')
+
+            pubsub.hub.publish(self.author_id, dict(id=42, author_id=self.author_id, html="<li>hi</li>"))
+            body = resp.get_data(as_text=True)
+        finally:
+            app.config['EVENTS_STREAM_TIMEOUT'] = 300
+            app.config['EVENTS_HEARTBEAT'] = 15
+
+        self.assertTrue(body.startswith("retry: 3000\n\n"))
+        self.assertIn(f"id: 42\nevent: warble\ndata: {json.dumps(dict(id=42, author_id=self.author_id, html='<li>hi</li>'))}\n\n",
+                      body)
+        self.assertIn(": keep-alive\n\n", body)
+        self.assertEqual(pubsub.hub.count(), 0)
@@ -0,0 +1,294 @@
+"""Query plan tests for the hot read paths."""
+
+# run these tests like:
+#
+#    python -m unittest test_query_plans.py
+
+import os
+from unittest import TestCase, skipUnless
+
+from sqlalchemy import create_engine, inspect, text
+from sqlalchemy.dialects import postgresql
+from sqlalchemy.engine import make_url
+
+from models import db, User, Message, Likes, DirectMessage, Conversation, TimelineEntry, without_deleted_users
+from search import user_query, message_query
+
+# BEFORE we import our app, let's set an environmental variable
+# to use a different database for tests (we need to do this
+# before we import our app, since that will have already
+# connected to the database
+
+os.environ['DATABASE_URL'] = "postgresql:///warbler_test"
+
+
+# Now we can import app
+
+from app import app
+from commands import apply_migrations
+
+NUM_USERS = 20000
+NUM_MESSAGES = 100000
+FOLLOWS_PER_USER = 10
+LIKES_PER_USER = 5
+NUM_DIRECT_MESSAGES = 20000
+
+# the user whose pages we EXPLAIN
+USER_ID = 7
+
+
+def has_pg_trgm():
+    """Is the trigram index on users.username there (needs contrib)?"""
+
+    with app.app_context():
+        return db.session.execute(text(
+            "SELECT 1 FROM pg_available_extensions WHERE name = 'pg_trgm'")).first() is not None
+
+
+def seq_scans(plan):
+    """Yield the relation names of every Seq Scan node in an EXPLAIN plan."""
+
+    if plan.get('Node Type') == 'Seq Scan':
+        yield plan['Relation Name']
+    for child in plan.get('Plans', []):
+        yield from seq_scans(child)
+
+
+class QueryPlanTestCase(TestCase):
+    """Do the hot queries use indexes on a seeded database?"""
+
+    @classmethod
+    def setUpClass(cls):
+        """Seed a database big enough for the planner to prefer indexes."""
+
+        db.drop_all()
+        db.create_all()
+
+        db.session.execute(text(
+            "INSERT INTO users (email, username, password) "
+            "SELECT 'user' || g || '@email.com', 'user' || g, 'HASHED_PASSWORD' "
+            "FROM generate_series(1, :users) g"), dict(users=NUM_USERS))
+        db.session.execute(text(
+            "INSERT INTO messages (text, timestamp, user_id) "
+            "SELECT 'warble ' || g || ' about ' || (ARRAY['birds', 'coffee', 'rain', 'music', 'code'])[1 + g % 5], "
+            "now() - g * interval '1 minute', 1 + g % :users "
+            "FROM generate_series(1, :messages) g"), dict(users=NUM_USERS, messages=NUM_MESSAGES))
+        db.session.execute(text(
+            "INSERT INTO follows (user_being_followed_id, user_following_id) "
+            "SELECT 1 + (u + k * 37) % :users, u "
+            "FROM generate_series(1, :users) u, generate_series(1, :follows) k"),
+            dict(users=NUM_USERS, follows=FOLLOWS_PER_USER))
+        db.session.execute(text(
+            "INSERT INTO likes (user_id, message_id) "
+            "SELECT u, (u - 1) * :likes + k "
+            "FROM generate_series(1, :users) u, generate_series(1, :likes) k"),
+            dict(users=NUM_USERS, likes=LIKES_PER_USER))
+        db.session.execute(text(
+            "INSERT INTO direct_msg (sender_id, receiver_id, message_text, timestamp) "
+            "SELECT 1 + g % :users, 1 + (g * 7) % :users, 'hello ' || g, now() - g * interval '1 minute' "
+            "FROM generate_series(1, :dms) g"), dict(users=NUM_USERS, dms=NUM_DIRECT_MESSAGES))
+        TimelineEntry.rebuild(list(range(1, 201)))
+        Conversation.rebuild(list(range(1, NUM_USERS + 1)))
+        db.session.commit()
+
+        db.session.execute(text("ANALYZE"))
+
+    @classmethod
+    def tearDownClass(cls):
+        db.session.rollback()
+        db.drop_all()
+        db.create_all()
+
+    def assertIndexed(self, query, *tables):
+        """Fail if the plan for `query` sequentially scans any of `tables`."""
+
+        compiled = query.statement.compile(dialect=postgresql.psycopg2.dialect())
+        sql = str(compiled)
+        [[explain]] = (db.session
+                       .connection()
+                       .exec_driver_sql(f"EXPLAIN (FORMAT JSON) {sql}", compiled.params)
+                       .fetchall())
+        scanned = set(seq_scans(explain[0]['Plan']))
+
+        self.assertFalse(scanned & set(tables),
+                         f"Sequential scan on {scanned & set(tables)} for:\n{sql}")
+
+    def test_homepage_without_deleted_users(self):
+        """Hiding deleted users costs a probe of their (small) partial index."""
+
+        query = (TimelineEntry
+                 .messages_for(USER_ID)
+                 .options(*without_deleted_users())
+                 .order_by(None)
+                 .order_by(TimelineEntry.timestamp.desc(), TimelineEntry.message_id.desc())
+                 .limit(101))
+        self.assertIndexed(query, 'home_timeline', 'messages', 'users')
+
+    def test_users_show(self):
+        query = (Message
+                 .query
+                 .filter(Message.user_id == USER_ID)
+                 .order_by(Message.timestamp.desc(), Message.id.desc())
+                 .limit(101))
+        self.assertIndexed(query, 'messages')
+
+    def test_homepage(self):
+        query = (TimelineEntry
+                 .messages_for(USER_ID)
+                 .order_by(None)
+                 .order_by(TimelineEntry.timestamp.desc(), TimelineEntry.message_id.desc())
+                 .limit(101))
+        self.assertIndexed(query, 'home_timeline', 'messages')
+
+    def test_direct_messages(self):
+        query = (DirectMessage
+                 .query
+                 .filter(DirectMessage.receiver_id == USER_ID)
+                 .order_by(DirectMessage.timestamp.desc(), DirectMessage.id.desc())
+                 .limit(101))
+        self.assertIndexed(query, 'direct_msg')
+
+    def test_conversations(self):
+        query = (Conversation
+                 .query
+                 .filter(Conversation.user_id == USER_ID)
+                 .order_by(Conversation.last_message_at.desc(), Conversation.other_id.desc())
+                 .limit(61))
+        self.assertIndexed(query, 'conversations')
+
+    def test_thread(self):
+        query = (DirectMessage
+                 .thread(USER_ID, USER_ID + 1)
+                 .order_by(DirectMessage.timestamp.desc(), DirectMessage.id.desc())
+                 .limit(101))
+        self.assertIndexed(query, 'direct_msg')
+
+    def test_likes(self):
+        query = (Message
+                 .query
+                 .join(Likes, Likes.message_id == Message.id)
+                 .filter(Likes.user_id == USER_ID)
+                 .order_by(Message.timestamp.desc(), Message.id.desc())
+                 .limit(101))
+        self.assertIndexed(query, 'likes', 'messages')
+
+    def test_followers(self):
+        query, member = User.follow_list(USER_ID, 'followers')
+        self.assertIndexed(query.order_by(member.desc()).limit(61), 'follows', 'users')
+
+    def test_following(self):
+        query, member = User.follow_list(USER_ID, 'following')
+        self.assertIndexed(query.order_by(member.desc()).limit(61), 'follows', 'users')
+
+    def test_message_search(self):
+        self.assertIndexed(message_query('4242').limit(31), 'messages')
+
+    @skipUnless(has_pg_trgm(), "pg_trgm is not installed on this server")
+    def test_user_search(self):
+        self.assertIndexed(user_query('user4242').limit(31), 'users')
+
+
+# The schema db.create_all() built before migrations/ existed: what every
+# migration starts from.
+BASELINE_SCHEMA = """
+CREATE TABLE users (
+    id SERIAL PRIMARY KEY,
+    email TEXT NOT NULL UNIQUE,
+    username TEXT NOT NULL UNIQUE,
+    image_url TEXT,
+    header_image_url TEXT,
+    bio TEXT,
+    location TEXT,
+    password TEXT NOT NULL
+);
+CREATE TABLE direct_msg (
+    id SERIAL PRIMARY KEY,
+    sender_id INTEGER NOT NULL REFERENCES users (id) ON DELETE CASCADE,
+    receiver_id INTEGER NOT NULL REFERENCES users (id) ON DELETE CASCADE,
+    message_text VARCHAR(300) NOT NULL,
+    timestamp TIMESTAMP NOT NULL
+);
+CREATE TABLE follows (
+    user_being_followed_id INTEGER NOT NULL REFERENCES users (id) ON DELETE CASCADE,
+    user_following_id INTEGER NOT NULL REFERENCES users (id) ON DELETE CASCADE,
+    PRIMARY KEY (user_being_followed_id, user_following_id)
+);
+CREATE TABLE messages (
+    id SERIAL PRIMARY KEY,
+    text VARCHAR(140) NOT NULL,
+    timestamp TIMESTAMP NOT NULL,
+    user_id INTEGER NOT NULL REFERENCES users (id) ON DELETE CASCADE
+);
+CREATE TABLE likes (
+    id SERIAL PRIMARY KEY,
+    user_id INTEGER REFERENCES users (id) ON DELETE CASCADE,
+    message_id INTEGER UNIQUE REFERENCES messages (id) ON DELETE CASCADE
+)
+"""
+
+
+def describe_schema(engine):
+    """The tables, columns, keys and indexes of `engine`'s database, leaving
+    out defaults (migrations add columns with server defaults that create_all
+    leaves to the ORM)."""
+
+    inspector = inspect(engine)
+    schema = {}
+
+    for table in inspector.get_table_names():
+        if table == 'schema_migrations':
+            continue
+        schema[table] = dict(
+            columns={(column['name'], str(column['type']), column['nullable'])
+                     for column in inspector.get_columns(table)},
+            primary_key=tuple(inspector.get_pk_constraint(table)['constrained_columns']),
+            foreign_keys={(tuple(fk['constrained_columns']), fk['referred_table'],
+                           tuple(fk['referred_columns']), fk['options'].get('ondelete', '').lower())
+                          for fk in inspector.get_foreign_keys(table)},
+            unique={tuple(unique['column_names']) for unique in inspector.get_unique_constraints(table)},
+            indexes={(index['name'], tuple(index['column_names']), tuple(index.get('expressions', ())),
+                      index['unique'])
+                     for index in inspector.get_indexes(table)},
+        )
+
+    return schema
+
+
+class MigrationsTestCase(TestCase):
+    """Do the migrations bring a baseline database to the schema of create_all()?
+
+    Creates (and drops) two scratch databases, so the test role needs CREATEDB.
+    """
+
+    DATABASES = ['warbler_test_migrated', 'warbler_test_created']
+
+    def setUp(self):
+        url = make_url(app.config['SQLALCHEMY_DATABASE_URI'])
+        self.admin = create_engine(url, isolation_level='AUTOCOMMIT')
+        self.engines = {}
+
+        with self.admin.connect() as conn:
+            for name in self.DATABASES:
+                conn.execute(text(f"DROP DATABASE IF EXISTS {name}"))
+                conn.execute(text(f"CREATE DATABASE {name}"))
+                self.engines[name] = create_engine(url.set(database=name), isolation_level='AUTOCOMMIT')
+
+    def tearDown(self):
+        with self.admin.connect() as conn:
+            for name, engine in self.engines.items():
+                engine.dispose()
+                conn.execute(text(f"DROP DATABASE IF EXISTS {name}"))
+        self.admin.dispose()
+
+    def test_migrations_match_create_all(self):
+        migrated = self.engines['warbler_test_migrated']
+        with migrated.connect() as conn:
+            conn.execute(text(BASELINE_SCHEMA))
+            list(apply_migrations(conn))
+            # re-running is a no-op
+            self.assertEqual(list(apply_migrations(conn)), [])
+
+        created = self.engines['warbler_test_created']
+        db.metadata.create_all(created)
+
+        self.assertEqual(describe_schema(migrated), describe_schema(created))
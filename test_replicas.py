@@ -0,0 +1,111 @@
+"""Read-replica routing tests."""
+
+# run these tests like:
+#
+#    createdb warbler_test_replica
+#    python -m unittest test_replicas.py
+#
+# The replica is any second database: by default warbler_test_replica on the
+# same server, or set REPLICA_TEST_DATABASE_URL to one on a second Postgres
+# instance. Nothing replicates between the two here, so the tests tell
+# which server answered by giving the same rows different contents.
+
+import os
+from unittest import TestCase, skipUnless
+
+from sqlalchemy import create_engine, delete, insert, select, update
+from sqlalchemy.exc import OperationalError
+
+os.environ['DATABASE_URL'] = "postgresql:///warbler_test"
+
+from app import app, CURR_USER_KEY
+from models import db, User, Follows, Job
+import fragments
+import identity
+import replicas
+
+db.create_all()
+
+app.config['WTF_CSRF_ENABLED'] = False
+app.config['SQL_STATEMENT_LIMIT'] = 20
+
+REPLICA_URL = os.environ.get('REPLICA_TEST_DATABASE_URL', "postgresql:///warbler_test_replica")
+
+
+def replica_available():
+    try:
+        create_engine(REPLICA_URL).connect().close()
+    except OperationalError:
+        return False
+    return True
+
+
+@skipUnless(replica_available(), f"no replica database at {REPLICA_URL}")
+class ReplicaRoutingTestCase(TestCase):
+    """Do GETs read from the replica, and everything else from the primary?"""
+
+    @classmethod
+    def setUpClass(cls):
+        app.config['REPLICA_DATABASE_URIS'] = [REPLICA_URL]
+        [cls.replica] = replicas.engines()
+        db.metadata.create_all(cls.replica)
+
+    @classmethod
+    def tearDownClass(cls):
+        app.config['REPLICA_DATABASE_URIS'] = []
+
+    def setUp(self):
+        Job.query.delete()
+        User.query.delete()
+        db.session.commit()
+        identity.clear()
+        fragments.clear()
+
+        for engine, where in ((db.engine, "primary"), (self.replica, "replica")):
+            with engine.begin() as conn:
+                conn.execute(delete(User))
+                conn.execute(insert(User), [
+                    dict(id=1, username="reader", email="reader@test.com", password="x", bio=f"bio on the {where}"),
+                    dict(id=2, username="writer", email="writer@test.com", password="x", bio=None),
+                ])
+
+        self.client = app.test_client()
+        with self.client.session_transaction() as sess:
+            sess[CURR_USER_KEY] = 1
+
+    def tearDown(self):
+        db.session.rollback()
+
+    def test_get_reads_replica_until_a_write(self):
+        self.assertIn("bio on the replica", self.client.get("/users/1").get_data(as_text=True))
+
+        self.client.post("/users/follow/2")
+
+        self.assertEqual(Follows.query.count(), 1)
+        with self.replica.connect() as conn:
+            self.assertEqual(conn.execute(select(Follows)).all(), [])
+
+        # read-your-writes: this browser reads from the primary for a while
+        self.assertIn("bio on the primary", self.client.get("/users/1").get_data(as_text=True))
+
+        with self.client.session_transaction() as sess:
+            sess[replicas.STICKY_KEY] = 0
+        self.assertIn("bio on the replica", self.client.get("/users/1").get_data(as_text=True))
+
+    def test_writes_pin_session_to_primary(self):
+        with app.test_request_context("/users/1"):
+            app.preprocess_request()
+
+            self.assertIs(db.session.get_bind(clause=select(User)), self.replica)
+            self.assertIs(db.session.get_bind(clause=select(User).with_for_update()), db.engine)
+            self.assertIs(db.session.get_bind(clause=select(User)), db.engine)
+            self.assertTrue(db.session.info['wrote'])
+
+        with app.test_request_context("/users/1"):
+            app.preprocess_request()
+            self.assertIs(db.session.get_bind(clause=update(User)), db.engine)
+            self.assertIs(db.session.get_bind(clause=select(User)), db.engine)
+
+        with app.test_request_context("/users/follow/2", method="POST"):
+            app.preprocess_request()
+            self.assertIs(db.session.get_bind(clause=select(User)), db.engine)
@@ -6,9 +6,10 @@
 
 
 import os
+import time
 from unittest import TestCase
 from sqlalchemy import exc
-from models import db, User, Message, Follows
+from models import db, User, Message, Follows, Likes, DirectMessage, Conversation, TimelineEntry, AccountDeletion
 
 # BEFORE we import our app, let's set an environmental variable
 # to use a different database for tests (we need to do this
@@ -21,6 +22,8 @@ os.environ['DATABASE_URL'] = "postgresql:///warbler_test"
 # Now we can import app
 
 from app import app
+import identity
+from passwords import hasher, PasswordHasher, PasswordHashingBusy
 
 # Create our tables (we do this here, so we only create the tables
 # once for all tests --- in each test, we'll delete the data
@@ -105,6 +108,20 @@ class UserModelTestCase(TestCase):
         self.assertFalse(self.user2.is_following(self.user1))
 
 
+######## User.following_ids ##########
+
+    def test_following_ids(self):
+
+        user3 = User.signup('user3', 'user3@email.com', 'password', None)
+        db.session.commit()
+        self.user1.following.append(self.user2)
+        db.session.commit()
+
+        self.assertEqual(self.user1.following_ids([self.user2.id, user3.id, 999]), {self.user2.id})
+        self.assertEqual(self.user2.following_ids([self.user1.id, user3.id]), set())
+        self.assertEqual(self.user1.following_ids([]), set())
+
+
 ######## User.is_followed_by  ########## 
 
     def test_is_followed_by(self):
@@ -164,4 +181,161 @@ class UserModelTestCase(TestCase):
         self.assertFalse(User.authenticate("wrongusername", "password")) 
         
     def test_invalid_password(self):
-        self.assertFalse(User.authenticate(self.user1.username, "wrongpassword"))    
\ No newline at end of file
+        self.assertFalse(User.authenticate(self.user1.username, "wrongpassword"))    
+
+    def test_authenticate_rehashes_on_cost_change(self):
+        self.assertFalse(hasher.needs_rehash(self.user1.password))
+
+        hasher.rounds = 4
+        try:
+            self.assertTrue(hasher.needs_rehash(self.user1.password))
+            user = User.authenticate(self.user1.username, 'password')
+            self.assertTrue(user.password.startswith("$2b$04$"))
+            self.assertTrue(User.authenticate(self.user1.username, 'password'))
+        finally:
+            hasher.rounds = app.config['BCRYPT_LOG_ROUNDS']
+
+    def test_password_hashing_back_pressure(self):
+        busy = PasswordHasher(rounds=4, pool_size=0, max_pending=1)
+        busy._slots.acquire()
+
+        with self.assertRaises(PasswordHashingBusy):
+            busy.hash('password')
+
+        busy._slots.release()
+        self.assertTrue(busy.check(busy.hash('password'), 'password'))
+
+    def test_timed_out_hashing_holds_its_slot(self):
+        slow = PasswordHasher(rounds=4, pool_size=1, max_pending=1, timeout=10)
+        try:
+            slow.hash('password')  # start the pool
+
+            slow.timeout = .05
+            with self.assertRaises(PasswordHashingBusy):
+                slow.run('check', time.sleep, 1)
+            # still running in the pool, so its slot is still taken
+            self.assertFalse(slow._slots.acquire(blocking=False))
+
+            slow.timeout = 10
+            for _ in range(50):
+                if slow._slots.acquire(blocking=False):
+                    slow._slots.release()
+                    break
+                time.sleep(.1)
+            self.assertTrue(slow.check(slow.hash('password'), 'password'))
+        finally:
+            slow.executor().shutdown()
+
+
+######## User counters ##########
+
+    def test_adjust_counts(self):
+        User.adjust_counts(self.user1.id, followers_count=2, likes_count=1)
+        User.adjust_counts(self.user1.id, followers_count=-1)
+        db.session.commit()
+
+        self.assertEqual(self.user1.followers_count, 1)
+        self.assertEqual(self.user1.likes_count, 1)
+        self.assertEqual(self.user1.messages_count, 0)
+
+    def test_reconcile_counts(self):
+        self.user1.following.append(self.user2)
+        self.user2.messages.append(Message(text="counted"))
+        db.session.commit()
+        self.assertEqual(self.user2.followers_count, 0)
+
+        User.reconcile_counts([self.user1.id, self.user2.id])
+        db.session.commit()
+
+        self.assertEqual(self.user1.following_count, 1)
+        self.assertEqual(self.user1.followers_count, 0)
+        self.assertEqual(self.user2.followers_count, 1)
+        self.assertEqual(self.user2.messages_count, 1)
+
+
+######## account deletion ##########
+
+    def test_deleted_user_hidden(self):
+        message = Message(text="soon gone", user_id=self.user2.id)
+        db.session.add(message)
+        db.session.commit()
+        message_id = message.id
+
+        AccountDeletion.start(self.user2.id)
+        db.session.commit()
+        db.session.expunge_all()
+
+        self.assertIsNone(User.query.get(80))
+        self.assertEqual([user.id for user in User.query], [40])
+        self.assertFalse(User.authenticate('user2', 'password'))
+        self.assertIsNone(Message.query.get(message_id))
+        self.assertIsNone(identity.load(80))
+        self.assertIsNotNone(User.query.execution_options(include_deleted=True).get(80))
+
+    def test_purge_in_batches(self):
+        user3 = User.signup('user3', 'user3@email.com', 'password', None)
+        db.session.commit()
+        gone, keep = self.user2.id, self.user1.id
+
+        for text in ("one", "two", "three"):
+            db.session.add(Message(text=text, user_id=gone))
+        db.session.add(Message(text="kept", user_id=keep))
+        db.session.add_all([Follows(user_being_followed_id=gone, user_following_id=keep),
+                            Follows(user_being_followed_id=gone, user_following_id=user3.id),
+                            Follows(user_being_followed_id=keep, user_following_id=gone)])
+        db.session.flush()
+        for message in Message.query.all():
+            Likes.toggle(gone if message.user_id == keep else keep, message.id)
+            Likes.toggle(user3.id, message.id)
+        Conversation.add_message(DirectMessage.sentMessage(gone, keep, "hi"))
+        User.reconcile_counts([keep, gone, user3.id])
+        TimelineEntry.rebuild([keep, gone, user3.id])
+        db.session.commit()
+
+        deletion = AccountDeletion.start(gone)
+        db.session.commit()
+
+        batches = 0
+        while deletion.purge(batch_size=2) is not None:
+            db.session.commit()
+            batches += 1
+        db.session.commit()
+
+        self.assertGreater(batches, len(AccountDeletion.STEPS))
+        self.assertIsNotNone(deletion.finished_at)
+        self.assertIsNone(User.query.execution_options(include_deleted=True).get(gone))
+        # follows, messages, likes, timeline entries, DM, conversations, user
+        self.assertEqual(deletion.rows_deleted, 3 + 3 + 7 + 7 + 1 + 2 + 1)
+
+        user1, user3 = User.query.get(keep), User.query.get(user3.id)
+        self.assertEqual((user1.followers_count, user1.following_count, user1.likes_count, user1.unread_count),
+                         (0, 0, 0, 0))
+        self.assertEqual((user3.following_count, user3.likes_count), (0, 1))
+        self.assertEqual(Message.query.filter_by(user_id=keep).one().likes_count, 1)
+        self.assertEqual(TimelineEntry.query.count(), 0)
+
+
+######## identity cache ##########
+
+    def test_identity_cache_expiry_and_eviction(self):
+        cache = identity.IdentityCache(maxsize=2, ttl=60)
+        for user_id in (1, 2, 3):
+            cache.put(identity.Identity(user_id, f"user{user_id}", None))
+
+        self.assertIsNone(cache.get(1))
+        self.assertEqual(cache.get(3).username, "user3")
+
+        cache.ttl = -1
+        cache.put(identity.Identity(4, "user4", None))
+        self.assertIsNone(cache.get(4))
+
+    def test_current_user_loads_lazily(self):
+        identity.clear()
+        current = identity.load(self.user1.id)
+
+        self.assertEqual(current.username, 'user1')
+        self.assertIsNone(current._user)
+
+        self.assertEqual(current.email, 'user1@email.com')
+        self.assertIs(current.orm, self.user1)
+        self.assertIsNone(identity.load(12345))
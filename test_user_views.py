@@ -5,9 +5,13 @@
 #    FLASK_ENV=production python -m unittest test_user_views.py
 
 import os
+import re
 from unittest import TestCase
 
-from models import db, connect_db, User, Message, Likes, Follows
+from flask import g
+from sqlalchemy import event
+
+from models import db, connect_db, User, Message, Likes, Follows, TimelineEntry, AccountDeletion
 
 # BEFORE we import our app, let's set an environmental variable
 # to use a different database for tests (we need to do this
@@ -20,6 +24,10 @@ os.environ['DATABASE_URL'] = "postgresql:///warbler_test"
 # Now we can import app
 
 from app import app, CURR_USER_KEY
+import fragments
+import jobs
+import identity
+from passwords import hasher
 
 # Create our tables (we do this here, so we only create the tables
 # once for all tests --- in each test, we'll delete the data
@@ -31,6 +39,16 @@ db.create_all()
 
 app.config['WTF_CSRF_ENABLED'] = False
 
+# Fail any request that runs more SQL statements than this, so N+1 queries
+# in the views show up as test failures
+
+app.config['SQL_STATEMENT_LIMIT'] = 20
+
+# Run background jobs (timeline fan-out, ...) inside the request, so views
+# can be checked without a worker
+
+app.config['JOBS_INLINE'] = True
+
 class UserViewTestCase(TestCase):
     """Test views for user."""
     
@@ -38,6 +56,9 @@ class UserViewTestCase(TestCase):
         """Create test user, add sample data."""
 
         User.query.delete()
+        AccountDeletion.query.delete()
+        identity.clear()
+        fragments.clear()
 
         self.client = app.test_client()
 
@@ -116,6 +137,8 @@ class UserViewTestCase(TestCase):
             likes = Likes.query.filter(Likes.message_id==1234).all()
             self.assertEqual(len(likes), 1)
             self.assertEqual(likes[0].user_id, self.testuser_id)
+            self.assertEqual(Message.query.get(1234).likes_count, 1)
+            self.assertEqual(User.query.get(self.testuser_id).likes_count, 1)
 
 
     def test_remove_like(self):
@@ -177,6 +200,31 @@ class UserViewTestCase(TestCase):
             self.assertNotIn("@marco", str(resp.data))
     
     
+    def test_following_pages(self):
+        """Is the following list paginated by user id and limited to the card columns?"""
+
+        self.setup_followers()
+        per_page = app.config['USERS_PER_PAGE']
+        app.config['USERS_PER_PAGE'] = 1
+        try:
+            with self.client as c:
+                with c.session_transaction() as sess:
+                    sess[CURR_USER_KEY] = self.testuser_id
+
+                first = c.get(f"/users/{self.testuser_id}/following").get_data(as_text=True)
+                self.assertIn("@katie", first)
+                self.assertNotIn("@olga", first)
+
+                older = re.search(r'href="([^"]*older=[^"]*)"', first).group(1)
+                second = c.get(older.replace('&amp;', '&')).get_data(as_text=True)
+                self.assertIn("@olga", second)
+                self.assertNotIn("@katie", second)
+
+                listed, member = User.follow_list(self.testuser_id, 'following')
+                self.assertNotIn("users.password", str(listed))
+        finally:
+            app.config['USERS_PER_PAGE'] = per_page
+
     def test_unauthorized_following_page_access(self):
         
         self.setup_followers()
@@ -214,4 +262,257 @@ class UserViewTestCase(TestCase):
             self.assertEqual(resp.status_code, 200)
             self.assertNotIn("@olga", str(resp.data))
             self.assertNotIn("@marco", str(resp.data))
-            self.assertIn("Access unauthorized", str(resp.data))
\ No newline at end of file
+            self.assertIn("Access unauthorized", str(resp.data))
+
+
+    def test_follow_and_unfollow_timeline(self):
+        """Following backfills the home timeline; unfollowing clears it."""
+
+        self.setup_likes()
+
+        with self.client as c:
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = self.user2id
+
+            c.post(f"/users/follow/{self.testuser_id}")
+            entries = TimelineEntry.query.filter_by(user_id=self.user2id).all()
+            self.assertEqual(len(entries), 2)
+            self.assertTrue(all(e.author_id == self.testuser_id for e in entries))
+
+            resp = c.get("/")
+            self.assertIn("Bla bla", str(resp.data))
+            self.assertNotIn("likable warble", str(resp.data))
+
+            c.post(f"/users/stop-following/{self.testuser_id}")
+            self.assertEqual(TimelineEntry.query.filter_by(user_id=self.user2id).count(), 0)
+
+
+    def test_counters_follow_post_like(self):
+        """Do the counters track follows, posts and likes?"""
+
+        self.setup_likes()
+
+        with self.client as c:
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = self.testuser_id
+
+            c.post(f"/users/follow/{self.user1id}")
+            c.post("/messages/new", data={"text": "counted warble"})
+            c.post("/users/add_like/1234")
+
+            testuser = User.query.get(self.testuser_id)
+            user1 = User.query.get(self.user1id)
+            self.assertEqual(testuser.following_count, 1)
+            self.assertEqual(testuser.messages_count, 1)
+            self.assertEqual(testuser.likes_count, 1)
+            self.assertEqual(user1.followers_count, 1)
+
+            c.post(f"/users/stop-following/{self.user1id}")
+            c.post("/users/add_like/1234")
+
+            self.assertEqual(User.query.get(self.testuser_id).following_count, 0)
+            self.assertEqual(User.query.get(self.testuser_id).likes_count, 0)
+            self.assertEqual(User.query.get(self.user1id).followers_count, 0)
+
+    def test_delete_user_releases_counts(self):
+        """Deleting a user hides them, then a job purges them and takes them
+        out of other users' counters."""
+
+        self.setup_likes()
+
+        with self.client as c:
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = self.testuser_id
+            c.post("/users/add_like/1234")
+
+            own_msg_id = Message.query.filter_by(user_id=self.testuser_id).first().id
+
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = self.user1id
+            c.post(f"/users/follow/{self.testuser_id}")
+            c.post(f"/users/add_like/{own_msg_id}")
+            self.assertEqual(User.query.get(self.user1id).following_count, 1)
+            self.assertEqual(Message.query.get(own_msg_id).likes_count, 1)
+
+            app.config['JOBS_INLINE'] = False
+            try:
+                c.post("/users/delete")
+            finally:
+                app.config['JOBS_INLINE'] = True
+
+            # hidden at once, purged by the worker
+            self.assertIsNone(User.query.filter_by(id=self.user1id).first())
+            self.assertEqual(c.get(f"/users/{self.user1id}").status_code, 404)
+            self.assertIsNone(AccountDeletion.query.get(self.user1id).finished_at)
+
+            jobs.Worker(app, threads=1).run(burst=True)
+
+            self.assertIsNotNone(AccountDeletion.query.get(self.user1id).finished_at)
+            self.assertEqual(User.query.get(self.testuser_id).followers_count, 0)
+            self.assertEqual(User.query.get(self.testuser_id).likes_count, 0)
+            self.assertEqual(Message.query.get(own_msg_id).likes_count, 0)
+
+    def test_users_index_follow_buttons(self):
+        """User cards show Unfollow only for users the viewer follows."""
+
+        self.setup_followers()
+        with self.client as c:
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = self.testuser_id
+
+            html = c.get("/users").get_data(as_text=True)
+            self.assertIn(f'action="/users/stop-following/{self.user1id}"', html)
+            self.assertIn(f'action="/users/stop-following/{self.user2id}"', html)
+            self.assertIn(f'action="/users/follow/{self.user4.id}"', html)
+
+    def test_users_search_profile_words(self):
+        """Does search also match words in the bio and location?"""
+
+        self.user2.bio = "Birdwatcher and coffee lover"
+        self.user3.location = "Lisbon"
+        db.session.commit()
+
+        with self.client as c:
+            html = c.get("/users?q=coffee").get_data(as_text=True)
+            self.assertIn("@katie", html)
+            self.assertNotIn("@willy", html)
+
+            html = c.get("/users?q=lisb").get_data(as_text=True)
+            self.assertIn("@willy", html)
+            self.assertNotIn("@katie", html)
+
+    def test_messages_search(self):
+        self.setup_likes()
+
+        with self.client as c:
+            html = c.get("/messages/search?q=warbles").get_data(as_text=True)
+            self.assertIn("something about warble", html)
+            self.assertIn("likable warble", html)
+            self.assertNotIn("Bla bla", html)
+
+            html = c.get('/messages/search?q=warble -likable').get_data(as_text=True)
+            self.assertIn("something about warble", html)
+            self.assertNotIn("likable warble", html)
+
+    def test_identity_cache(self):
+        """Is the navbar user served from the cache and refreshed on profile edits?"""
+
+        with self.client as c:
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = self.testuser_id
+
+            c.get("/users")
+            self.assertEqual(identity.cache.get(self.testuser_id).username, "testuser")
+
+            resp = c.post(f"/users/{self.testuser_id}/profile",
+                          data={"username": "renamed", "email": "test@test.com",
+                                "image_url": "/static/images/default-pic.png",
+                                "header_image_url": "", "bio": "", "password": "testuser"})
+            self.assertEqual(resp.status_code, 200)
+            self.assertIsNone(identity.cache.get(self.testuser_id))
+
+            html = c.get("/users").get_data(as_text=True)
+            self.assertIn('alt="renamed"', html)
+            self.assertEqual(identity.cache.get(self.testuser_id).username, "renamed")
+
+    def test_homepage_skips_user_row(self):
+        """Does the homepage render from the cached snapshot, without loading the User?"""
+
+        statements = []
+
+        def record(conn, cursor, statement, *args):
+            statements.append(statement)
+
+        with self.client as c:
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = self.testuser_id
+            c.post(f"/users/follow/{self.user1id}")
+            c.get("/")  # caches the snapshot
+
+            event.listen(db.engine, 'before_cursor_execute', record)
+            try:
+                html = c.get("/").get_data(as_text=True)
+            finally:
+                event.remove(db.engine, 'before_cursor_execute', record)
+
+            self.assertIsNone(g.user._user)
+
+        # the card still shows the counters
+        self.assertIn('<a href="/users/140/following">1</a>', html)
+        self.assertFalse([statement for statement in statements if 'users.password' in statement])
+
+    def test_login_when_hashing_busy(self):
+        """Does login answer 503 with Retry-After when the bcrypt pool is full?"""
+
+        slots = hasher._slots
+        while slots.acquire(blocking=False):
+            pass
+        try:
+            resp = self.client.post("/login/", data={"username": "testuser", "password": "testuser"})
+        finally:
+            hasher._slots = type(slots)(app.config['BCRYPT_MAX_PENDING'])
+
+        self.assertEqual(resp.status_code, 503)
+        self.assertEqual(resp.headers['Retry-After'], '1')
+        self.assertIn("busy", resp.get_data(as_text=True))
+
+    def test_profile_conditional_get(self):
+        """Do profile and follower pages revalidate, and change when someone follows?"""
+
+        with self.client as c:
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = self.testuser_id
+
+            show = c.get(f"/users/{self.user1id}")
+            followers = c.get(f"/users/{self.user1id}/followers")
+
+            for url, resp in [(f"/users/{self.user1id}", show), (f"/users/{self.user1id}/followers", followers)]:
+                again = c.get(url, headers={'If-None-Match': resp.headers['ETag']})
+                self.assertEqual(again.status_code, 304)
+
+            c.post(f"/users/follow/{self.user1id}")
+
+            for url, resp in [(f"/users/{self.user1id}", show), (f"/users/{self.user1id}/followers", followers)]:
+                again = c.get(url, headers={'If-None-Match': resp.headers['ETag']})
+                self.assertEqual(again.status_code, 200)
+                self.assertIn("Unfollow", again.get_data(as_text=True))
+
+    def test_like_revalidates_without_touching_author(self):
+        """Does a like change the author's profile ETag while leaving their row alone?"""
+
+        self.setup_likes()
+        version = User.query.get(self.user1id).version
+
+        with self.client as c:
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = self.testuser_id
+
+            etags = {url: c.get(url).headers['ETag'] for url in (f"/users/{self.user1id}", "/messages/1234")}
+            c.post("/users/add_like/1234")
+
+            for url, etag in etags.items():
+                again = c.get(url, headers={'If-None-Match': etag})
+                self.assertEqual(again.status_code, 200)
+
+        db.session.expire_all()
+        self.assertEqual(User.query.get(self.user1id).version, version)
+
+    def test_user_card_fragment_follows_profile_edits(self):
+        """Is a cached user card re-rendered after the user edits their profile?"""
+
+        with self.client as c:
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = self.testuser_id
+
+            self.assertIn("@testuser", c.get("/users").get_data(as_text=True))
+
+            c.post(f"/users/{self.testuser_id}/profile",
+                   data={"username": "renamed", "email": "test@test.com",
+                         "image_url": "/static/images/default-pic.png",
+                         "header_image_url": "", "bio": "new bio", "password": "testuser"})
+
+            html = c.get("/users").get_data(as_text=True)
+            self.assertIn("@renamed", html)
+            self.assertIn("new bio", html)
+            self.assertNotIn("@testuser", html)
+